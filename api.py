@@ -1,7 +1,19 @@
-from fastapi import FastAPI
-import pyodbc
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+import io
+import itertools
+import json
+import os
 import pandas as pd
-import re
+import db_pool
+import parquet_store
+from telegram_parser import parse_column
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional: without it /data answers Arrow and Parquet requests with JSON
+    pa = None
 
 # Hardcoded database connection details
 db_host = "carlitodatabase.database.windows.net"
@@ -19,136 +31,93 @@ connection_string = (
     f"PWD={db_password};"
 )
 
-# Initialize FastAPI app
-app = FastAPI()
-
-# Function to parse the data field
-# Function to parse the data field
-def parse_data(data):
-    parsed_data = {}
-    try:
-        # Extract total energy consumed (1-0:1.8.0)
-        match = re.search(r"1-0:1\.8\.0\((\d+\.\d+)\*kWh\)", data)
-        if match:
-            parsed_data["total_energy_consumed"] = float(match.group(1))
-        else:
-            parsed_data["total_energy_consumed"] = None  # Handle missing data
-
-        # Extract current power consumption (1-0:1.7.0)
-        match = re.search(r"1-0:1\.7\.0\((\d+\.\d+)\*kW\)", data)
-        if match:
-            parsed_data["current_power_consumption"] = float(match.group(1))
-        else:
-            parsed_data["current_power_consumption"] = None
-
-        # Extract phase 1, 2, and 3 energy (1-0:21.7.0, 1-0:41.7.0, 1-0:61.7.0)
-        match = re.search(r"1-0:21\.7\.0\((\d+\.\d+)\*kW\)", data)
-        if match:
-            parsed_data["phase1_energy"] = float(match.group(1))
-        else:
-            parsed_data["phase1_energy"] = None
-
-        match = re.search(r"1-0:41\.7\.0\((\d+\.\d+)\*kW\)", data)
-        if match:
-            parsed_data["phase2_energy"] = float(match.group(1))
-        else:
-            parsed_data["phase2_energy"] = None
-
-        match = re.search(r"1-0:61\.7\.0\((\d+\.\d+)\*kW\)", data)
-        if match:
-            parsed_data["phase3_energy"] = float(match.group(1))
-        else:
-            parsed_data["phase3_energy"] = None
-
-        # Extract phase 1, 2, and 3 voltage (1-0:32.7.0, 1-0:52.7.0, 1-0:72.7.0)
-        match = re.search(r"1-0:32\.7\.0\((\d+\.\d+)\*V\)", data)
-        if match:
-            parsed_data["phase1_voltage"] = float(match.group(1))
-        else:
-            parsed_data["phase1_voltage"] = None
-
-        match = re.search(r"1-0:52\.7\.0\((\d+\.\d+)\*V\)", data)
-        if match:
-            parsed_data["phase2_voltage"] = float(match.group(1))
-        else:
-            parsed_data["phase2_voltage"] = None
-
-        match = re.search(r"1-0:72\.7\.0\((\d+\.\d+)\*V\)", data)
-        if match:
-            parsed_data["phase3_voltage"] = float(match.group(1))
-        else:
-            parsed_data["phase3_voltage"] = None
-
-        # Extract phase 1, 2, and 3 current (1-0:31.7.0, 1-0:51.7.0, 1-0:71.7.0)
-        match = re.search(r"1-0:31\.7\.0\((\d+\.\d+)\*A\)", data)
-        if match:
-            parsed_data["phase1_current"] = float(match.group(1))
-        else:
-            parsed_data["phase1_current"] = None
-
-        match = re.search(r"1-0:51\.7\.0\((\d+\.\d+)\*A\)", data)
-        if match:
-            parsed_data["phase2_current"] = float(match.group(1))
-        else:
-            parsed_data["phase2_current"] = None
-
-        match = re.search(r"1-0:71\.7\.0\((\d+\.\d+)\*A\)", data)
-        if match:
-            parsed_data["phase3_current"] = float(match.group(1))
-        else:
-            parsed_data["phase3_current"] = None
-
-        # Extract reactive energy consumed (1-0:3.8.0)
-        match = re.search(r"1-0:3\.8\.0\((\d+\.\d+)\*kVArh\)", data)
-        if match:
-            parsed_data["reactive_energy_consumed"] = float(match.group(1))
-        else:
-            parsed_data["reactive_energy_consumed"] = None
-
-        # Extract tariff 1 and tariff 2 energy (1-0:1.8.0, 1-0:2.8.0)
-        match = re.search(r"1-0:1\.8\.0\((\d+\.\d+)\*kWh\)", data)
-        if match:
-            parsed_data["tariff1_energy"] = float(match.group(1))
-        else:
-            parsed_data["tariff1_energy"] = None
-
-        match = re.search(r"1-0:2\.8\.0\((\d+\.\d+)\*kWh\)", data)
-        if match:
-            parsed_data["tariff2_energy"] = float(match.group(1))
-        else:
-            parsed_data["tariff2_energy"] = None
-
-    except Exception as e:
-        print(f"Error parsing data: {e}")
-        parsed_data = {}  # Return an empty dict if parsing fails
+# Connection pool shared by all requests in this worker
+db_pool.register_pool("source", db_pool.pyodbc_backend(connection_string))
 
-    return parsed_data
+# Rows read and parsed at a time by a streamed /data response
+stream_chunk_rows = int(os.getenv("API_STREAM_CHUNK_ROWS", "5000"))
 
+# Initialize FastAPI app
+app = FastAPI()
 
-# Endpoint to fetch data
+# Function to turn fetched raw rows into response records with the parsed columns
+def build_records(df):
+    # Parse the whole data column at once into typed columns
+    parsed_df = parse_column(df["data"])
+
+    # Combine the parsed data with the original DataFrame (missing values become null in JSON)
+    result_df = pd.concat([df[["id", "device_id", "timestamp", "processed"]], parsed_df.astype(object).where(parsed_df.notna(), None)], axis=1)
+
+    # Convert DataFrame to JSON
+    return result_df.to_dict(orient="records")
+
+# Function to turn fetched raw rows into an Arrow record batch of the parsed readings
+def build_record_batch(df):
+    result_df = pd.concat([df[["id", "device_id", "timestamp", "processed"]], parse_column(df["data"])], axis=1)
+    result_df["timestamp"] = pd.to_datetime(result_df["timestamp"])
+    result_df["processed"] = result_df["processed"].astype("Int64")  # BIT columns arrive as booleans
+    return pa.RecordBatch.from_pandas(result_df, schema=parquet_store.arrow_schema(), preserve_index=False)
+
+# Function to read the rows of a query stream_chunk_rows at a time, as DataFrames.
+# The pooled connection is held until the last chunk has been read.
+def fetch_frames(query):
+    with db_pool.connection("source") as conn:
+        for df in pd.read_sql(query, conn, chunksize=stream_chunk_rows):
+            yield df.reset_index(drop=True)
+
+# Function to encode chunks of raw rows as NDJSON, one parsed record per line
+def encode_ndjson(frames):
+    for df in frames:
+        yield "".join(json.dumps(record, default=lambda value: value.isoformat()) + "\n" for record in build_records(df)).encode()
+
+# Function to encode chunks of raw rows as an Arrow IPC stream, one record batch per chunk, as they are read
+def encode_arrow_stream(frames):
+    buffer = io.BytesIO()
+    with pa.ipc.new_stream(buffer, parquet_store.arrow_schema()) as writer:
+        for df in frames:
+            writer.write_batch(build_record_batch(df))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()  # End-of-stream marker (and the schema, when there were no rows)
+
+# Function to encode chunks of raw rows as one Parquet file, one row group per chunk
+def encode_parquet(frames):
+    buffer = io.BytesIO()
+    with pq.ParquetWriter(buffer, parquet_store.arrow_schema(), compression="zstd") as writer:
+        for df in frames:
+            writer.write_batch(build_record_batch(df))
+    return buffer.getvalue()
+
+# Response formats other than JSON by media type, preferred in this order when a client accepts several
+media_types = {
+    "application/vnd.apache.arrow.stream": encode_arrow_stream,
+    "application/vnd.apache.parquet": encode_parquet,
+    "application/x-parquet": encode_parquet,
+    "application/x-ndjson": encode_ndjson,
+}
+
+# Endpoint to fetch data. Arrow, Parquet and NDJSON are negotiated with the Accept header (see media_types);
+# Arrow and NDJSON are streamed as the rows are parsed.
 @app.get("/data")
-def get_data():
-    conn = None
+def get_data(request: Request):
+    query = "SELECT id, device_id, timestamp, processed, data FROM mqtt_raw_data ORDER BY id DESC OFFSET 0 ROWS FETCH NEXT 10000 ROWS ONLY;"
+    accept = request.headers.get("accept", "")
     try:
-        # Connect to the database
-        conn = pyodbc.connect(connection_string)
-        query = "SELECT id, device_id, timestamp, processed, data FROM mqtt_raw_data ORDER BY id DESC OFFSET 0 ROWS FETCH NEXT 10000 ROWS ONLY;"
-        df = pd.read_sql(query, conn)
-
-        # Parse the data field
-        df["parsed_data"] = df["data"].apply(parse_data)
-        parsed_df = pd.json_normalize(df["parsed_data"])
-
-        # Combine the parsed data with the original DataFrame
-        result_df = pd.concat([df[["id", "device_id", "timestamp", "processed"]], parsed_df], axis=1)
-
-        # Convert DataFrame to JSON
-        return result_df.to_dict(orient="records")
+        for media_type, encode in media_types.items():
+            if media_type in accept and (encode is encode_ndjson or pa is not None):
+                if encode is encode_parquet:
+                    return Response(content=encode_parquet(fetch_frames(query)), media_type=media_type)
+                chunks = encode(fetch_frames(query))
+                first = next(chunks, b"")  # Runs the query now, so errors are still reported as JSON
+                return StreamingResponse(itertools.chain([first], chunks), media_type=media_type)
+
+        # Borrow a pooled connection
+        with db_pool.connection("source") as conn:
+            df = pd.read_sql(query, conn)
+            return build_records(df)
     except Exception as e:
         return {"error": str(e)}
-    finally:
-        if conn:
-            conn.close()
 
 # Run the API
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 import requests
-import pyodbc
+import db_pool
 from datetime import datetime
 
 # Function to format timestamp
@@ -23,33 +23,33 @@ conn_str = (
     "UID=amilath;"
     "PWD=Atth617QAQA;"
 )
-conn = pyodbc.connect(conn_str)
-cursor = conn.cursor()
+db_pool.register_pool("target", db_pool.pyodbc_backend(conn_str))
+with db_pool.connection("target") as conn:
+    cursor = conn.cursor()
 
-# Insert data into the table
-for item in data:
-    try:
-        cursor.execute("""
-            INSERT INTO mqtt_raw_data (
-                id, device_id, timestamp, processed,
-                total_energy_consumed, current_power_consumption,
-                phase1_energy, phase2_energy, phase3_energy,
-                phase1_voltage, phase2_voltage, phase3_voltage,
-                phase1_current, phase2_current, phase3_current,
-                reactive_energy_consumed, tariff1_energy, tariff2_energy
+    # Insert data into the table
+    for item in data:
+        try:
+            cursor.execute("""
+                INSERT INTO mqtt_raw_data (
+                    id, device_id, timestamp, processed,
+                    total_energy_consumed, current_power_consumption,
+                    phase1_energy, phase2_energy, phase3_energy,
+                    phase1_voltage, phase2_voltage, phase3_voltage,
+                    phase1_current, phase2_current, phase3_current,
+                    reactive_energy_consumed, tariff1_energy, tariff2_energy
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            item['id'], item['device_id'], format_timestamp(item['timestamp']), item['processed'],
+            item['total_energy_consumed'], item['current_power_consumption'],
+            item['phase1_energy'], item['phase2_energy'], item['phase3_energy'],
+            item['phase1_voltage'], item['phase2_voltage'], item['phase3_voltage'],
+            item['phase1_current'], item['phase2_current'], item['phase3_current'],
+            item['reactive_energy_consumed'], item['tariff1_energy'], item['tariff2_energy']
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        item['id'], item['device_id'], format_timestamp(item['timestamp']), item['processed'],
-        item['total_energy_consumed'], item['current_power_consumption'],
-        item['phase1_energy'], item['phase2_energy'], item['phase3_energy'],
-        item['phase1_voltage'], item['phase2_voltage'], item['phase3_voltage'],
-        item['phase1_current'], item['phase2_current'], item['phase3_current'],
-        item['reactive_energy_consumed'], item['tariff1_energy'], item['tariff2_energy']
-        )
-    except Exception as e:
-        print(f"Error inserting item: {e}")
+        except Exception as e:
+            print(f"Error inserting item: {e}")
 
-conn.commit()
-cursor.close()
-conn.close()
\ No newline at end of file
+    conn.commit()
+    cursor.close()
\ No newline at end of file
@@ -0,0 +1,54 @@
+import os
+
+import pandas as pd
+import requests
+
+try:
+    import pyarrow as pa
+except ImportError:  # Optional: without it the API is asked for JSON
+    pa = None
+
+# Client for the aggregation API (apiagg.py), shared by the Streamlit dashboard pages:
+#
+#     data = api_client.fetch_data()
+#     data = api_client.fetch_data(device_id=["a", "b"], start_day="2025-01-01", columns="day,hour,power_consumption")
+#
+# /data is requested as an Arrow stream, which loads into a DataFrame without decoding JSON row by row.
+# Results are kept with their ETag, so a rerun whose rows have not changed gets 304 and reuses them.
+
+api_url = os.getenv("ENERGY_API_URL", "https://energy-api-momentum-fnc2e5cseaezerh9.swedencentral-01.azurewebsites.net")
+timeout = float(os.getenv("ENERGY_API_TIMEOUT_SECONDS", "120"))
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+_session = requests.Session()
+_cache = {}  # (path, params) -> (ETag, DataFrame)
+
+
+# Function to load a response body into a DataFrame by its content type
+def _to_frame(response):
+    if response.headers.get("Content-Type", "").startswith(ARROW_STREAM):
+        # The record batches reference the response buffer; only the pandas conversion copies
+        table = pa.ipc.open_stream(pa.py_buffer(response.content)).read_all()
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    return pd.DataFrame(response.json())
+
+
+# Function to fetch /data (query parameters as for apiagg /data) as a DataFrame.
+# Raises requests.RequestException when the API cannot be reached or answers with an error.
+def fetch_data(path="/data", **params):
+    key = (path, tuple(sorted((name, str(value)) for name, value in params.items() if value is not None)))
+    headers = {"Accept": f"{ARROW_STREAM}, application/json;q=0.5" if pa is not None else "application/json"}
+    cached = _cache.get(key)
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
+
+    response = _session.get(api_url + path, params=params, headers=headers, timeout=timeout)
+    if response.status_code == 304 and cached is not None:
+        return cached[1].copy()  # Pages add and convert columns in place
+    response.raise_for_status()
+
+    data = _to_frame(response)
+    if "ETag" in response.headers:
+        _cache[key] = (response.headers["ETag"], data.copy())
+    return data
@@ -1,29 +1,78 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from typing import List
-import pyodbc
+from typing import List, Optional
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+import io
+import itertools
+import json
 import os
-from datetime import date  # Import date for type checking
+import shutil
+import tempfile
+import time
+import db_pool
+from datetime import date, datetime, timezone  # Import date for type checking
+from schema import METRICS_AMENDED, METRICS_REPROCESSED, METRICS_WATERMARK
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional: without it /data answers Arrow and Parquet requests with JSON
+    pa = None
 
 app = FastAPI()
 
-# Define a Pydantic model for your data
+# Define a Pydantic model for your data. Every field but id is optional, so /data can return a
+# projection of the columns; fields that were not selected are left out of the response.
 class EnergyData(BaseModel):
     id: int
-    device_id: str
-    day: str  # Ensure this is a string
-    hour: int
-    interval_start: int
-    power_consumption: float
-    reactive_energy_consumed: float
-    tariff1_energy: float
-    tariff2_energy: float
-    avg_phase1_voltage: float
-    avg_phase2_voltage: float
-    avg_phase3_voltage: float
-    avg_phase1_current: float
-    avg_phase2_current: float
-    avg_phase3_current: float
+    device_id: Optional[str] = None
+    day: Optional[str] = None  # Ensure this is a string
+    hour: Optional[int] = None
+    interval_start: Optional[int] = None
+    power_consumption: Optional[float] = None  # NULL when a register reset or the meter was replaced (see quality_flag)
+    reactive_energy_consumed: Optional[float] = None
+    tariff1_energy: Optional[float] = None
+    tariff2_energy: Optional[float] = None
+    avg_phase1_voltage: Optional[float] = None
+    avg_phase2_voltage: Optional[float] = None
+    avg_phase3_voltage: Optional[float] = None
+    avg_phase1_current: Optional[float] = None
+    avg_phase2_current: Optional[float] = None
+    avg_phase3_current: Optional[float] = None
+    quality_flag: Optional[int] = None
+
+# Columns /data can select
+data_columns = list(EnergyData.__fields__)
+
+# Integer and text columns of /data; the others are floats
+integer_columns = {"id", "hour", "interval_start", "quality_flag"}
+text_columns = {"device_id", "day"}
+
+# Response formats of /data by media type, preferred in this order when a client accepts several
+media_types = {
+    "application/vnd.apache.arrow.stream": "arrow",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+    "application/x-ndjson": "ndjson",
+}
+
+# Upper bound on the limit parameter of /data
+max_page_rows = int(os.getenv("API_MAX_PAGE_ROWS", "100000"))
+
+# Rows kept by /data/{data_id}, least recently used evicted first
+row_cache_size = int(os.getenv("API_ROW_CACHE_SIZE", "10000"))
+# How often the caches check whether metrics_calculator has written metrics since they were filled
+amended_check_seconds = float(os.getenv("API_AMENDED_CHECK_SECONDS", "5"))
+
+# Rows fetched and encoded at a time by a streamed /data response
+stream_chunk_rows = int(os.getenv("API_STREAM_CHUNK_ROWS", "5000"))
+
+# /data response bodies, shared by the workers on this host (one subdirectory per metrics version)
+response_cache_dir = os.getenv("API_RESPONSE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "apiagg-response-cache"))
 
 # Database connection details from environment variables
 db_host = os.getenv("DB_HOST", "mqttmomentum.database.windows.net")
@@ -41,88 +90,412 @@ connection_string = (
     f"PWD={db_password};"
 )
 
+# Connection pool shared by all requests in this worker
+db_pool.register_pool("target", db_pool.pyodbc_backend(connection_string))
+
 # Simple health check endpoint
 @app.get("/")
 async def root():
-    return {"message": "Energy API is running", "status": "online"}
+    return {"message": "Energy API is running", "status": "online", "pools": db_pool.pool_metrics()}
+
+# Recently fetched rows by id. The endpoints run on the event loop, so the cache is only touched
+# from one thread. Only closed intervals are cached: an open interval's row is rewritten in place
+# (same id) after every batch, while a closed one only changes when a reprocess run rewrites it.
+_row_cache = OrderedDict()
+_metrics_version = None  # METRICS_AMENDED: when metrics_calculator last wrote metrics rows
+_metrics_watermark = None  # METRICS_WATERMARK: intervals starting before it are closed
+_metrics_reprocessed = None  # METRICS_REPROCESSED: when closed intervals were last rewritten
+_metrics_version_checked = None
 
-# Function to fetch data from the database
-def fetch_data_from_db():
+# Function to read a process_metadata timestamp as a naive UTC datetime (SQLite returns text)
+def as_utc_datetime(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+# Function to get the time of the last metrics write, re-read with the metrics watermark at most every
+# amended_check_seconds. The row cache is dropped only when a reprocess run has rewritten closed intervals.
+def metrics_version():
+    global _metrics_version, _metrics_watermark, _metrics_reprocessed, _metrics_version_checked
+    now = time.monotonic()
+    if _metrics_version_checked is not None and now - _metrics_version_checked < amended_check_seconds:
+        return _metrics_version
     try:
-        # Connect to the database
-        conn = pyodbc.connect(connection_string)
-        cursor = conn.cursor()
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT process_name, last_fetched_timestamp FROM process_metadata WHERE process_name IN (?, ?, ?)",
+                (METRICS_AMENDED, METRICS_WATERMARK, METRICS_REPROCESSED),
+            )
+            markers = {name: as_utc_datetime(timestamp) for name, timestamp in cursor.fetchall()}
+            cursor.close()
+    except Exception as e:
+        print(f"Database connection error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if markers.get(METRICS_REPROCESSED) != _metrics_reprocessed:
+        _row_cache.clear()
+        _metrics_reprocessed = markers.get(METRICS_REPROCESSED)
+    _metrics_version = markers.get(METRICS_AMENDED)
+    _metrics_watermark = markers.get(METRICS_WATERMARK)
+    _metrics_version_checked = now
+    return _metrics_version
+
+# Function to tell whether a metrics row's interval is closed (starts before the metrics watermark)
+def interval_closed(item):
+    if _metrics_watermark is None:
+        return False
+    day = date.fromisoformat(item["day"]) if isinstance(item["day"], str) else item["day"]
+    start = datetime(day.year, day.month, day.day, item["hour"], item["interval_start"])
+    return start < _metrics_watermark
+
+# Function to build the /data query, filtered and projected in SQL and ordered by id: (query, params).
+# after_id and limit page through the rows by id (keyset), so a page costs the same at any depth.
+def build_data_query(device_ids=None, start_day=None, end_day=None, start_hour=None, end_hour=None,
+                     columns=None, after_id=None, limit=None):
+    # Parameterized predicates; (device_id, day, ...) and (day, hour) are indexed
+    conditions, params = [], []
+    if device_ids:
+        conditions.append(f"device_id IN ({', '.join('?' for _ in device_ids)})")
+        params += device_ids
+    for condition, value in (
+        ("day >= ?", start_day), ("day <= ?", end_day),
+        ("hour >= ?", start_hour), ("hour <= ?", end_hour),
+        ("id > ?", after_id),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+
+    query = f"SELECT {', '.join(columns or ['*'])} FROM device_consumption_metrics"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id"
+    if limit is not None:
+        query += " LIMIT ?" if db_pool.get_pool("target").dialect == "sqlite" else " OFFSET 0 ROWS FETCH NEXT ? ROWS ONLY"
+        params.append(limit)
+    return query, params
+
+# Function to fetch metrics rows from the database (arguments as for build_data_query)
+def fetch_data_from_db(*args):
+    try:
+        # Borrow a pooled connection
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+            cursor.execute(*build_data_query(*args))
+            names = [column[0] for column in cursor.description]
+
+            # Convert datetime.date to string in YYYY-MM-DD format
+            data = [
+                {name: value.isoformat() if isinstance(value, date) else value for name, value in zip(names, row)}
+                for row in cursor.fetchall()
+            ]
 
-        # Query to fetch data
-        query = "SELECT * FROM device_consumption_metrics"
-        cursor.execute(query)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
-
-        # Convert rows to a list of dictionaries
-        data = []
-        for row in rows:
-            # Convert datetime.date to string if necessary
-            day_value = row.day
-            if isinstance(day_value, date):
-                day_value = day_value.isoformat()  # Convert to string in YYYY-MM-DD format
-
-            data.append({
-                "id": row.id,
-                "device_id": row.device_id,
-                "day": day_value,  # Use the converted value
-                "hour": row.hour,
-                "interval_start": row.interval_start,
-                "power_consumption": row.power_consumption,
-                "reactive_energy_consumed": row.reactive_energy_consumed,
-                "tariff1_energy": row.tariff1_energy,
-                "tariff2_energy": row.tariff2_energy,
-                "avg_phase1_voltage": row.avg_phase1_voltage,
-                "avg_phase2_voltage": row.avg_phase2_voltage,
-                "avg_phase3_voltage": row.avg_phase3_voltage,
-                "avg_phase1_current": row.avg_phase1_current,
-                "avg_phase2_current": row.avg_phase2_current,
-                "avg_phase3_current": row.avg_phase3_current
-            })
-
-        # Close the connection
-        cursor.close()
-        conn.close()
-
-        return data
+            cursor.close()
+
+            return data
 
     except Exception as e:
         print(f"Database connection error: {str(e)}")  # Improved error logging
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-# Endpoint to get all data
-@app.get("/data", response_model=List[EnergyData])
-async def get_data():
+# Function to read metrics rows stream_chunk_rows at a time (arguments as for build_data_query), so memory
+# stays the same for any result size: yields (column names, rows) per chunk. The pooled connection is
+# held until the last chunk has been read.
+def fetch_batches_from_db(*args):
+    with db_pool.connection("target") as conn:
+        cursor = conn.cursor()
+        cursor.execute(*build_data_query(*args))
+        names = [column[0] for column in cursor.description]
+        try:
+            while True:
+                rows = cursor.fetchmany(stream_chunk_rows)
+                if not rows:
+                    break
+                yield names, rows
+        finally:
+            cursor.close()
+
+# Function to encode chunks of rows as NDJSON, one object per line
+def encode_ndjson(batches):
+    for names, rows in batches:
+        yield "".join(
+            json.dumps({name: value.isoformat() if isinstance(value, date) else value for name, value in zip(names, row)}) + "\n"
+            for row in rows
+        ).encode()
+
+# Function to get the Arrow schema of the given /data columns
+def arrow_schema(columns):
+    return pa.schema([
+        (column, pa.int64() if column in integer_columns else pa.string() if column in text_columns else pa.float64())
+        for column in columns
+    ])
+
+# Function to turn one chunk of rows into an Arrow record batch, column by column
+def record_batch(schema, rows):
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if pa.types.is_string(field.type):
+            values = [value.isoformat() if isinstance(value, date) else value for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+# Function to encode chunks of rows as an Arrow IPC stream, one record batch per chunk, as they are read
+def encode_arrow_stream(batches, columns):
+    schema = arrow_schema(columns)
+    buffer = io.BytesIO()
+    with pa.ipc.new_stream(buffer, schema) as writer:
+        for _, rows in batches:
+            writer.write_batch(record_batch(schema, rows))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()  # End-of-stream marker (and the schema, when there were no rows)
+
+# Function to encode chunks of rows as one Parquet file, one row group per chunk. The footer comes last,
+# so the file is built before it is sent; it is compressed, so it is also small enough to cache.
+def encode_parquet(batches, columns):
+    schema = arrow_schema(columns)
+    buffer = io.BytesIO()
+    last_id, count = None, 0
+    with pq.ParquetWriter(buffer, schema, compression="zstd") as writer:
+        for _, rows in batches:
+            writer.write_batch(record_batch(schema, rows))
+            last_id, count = rows[-1][0], count + len(rows)
+    return buffer.getvalue(), last_id, count
+
+# Function to pick the /data response format from an Accept header: (media type, format).
+# JSON unless the client asks for another format this server can produce.
+def negotiate(accept):
+    for media_type, response_format in media_types.items():
+        if media_type in accept and (response_format == "ndjson" or pa is not None):
+            return media_type, response_format
+    return "application/json", "json"
+
+# Function to get the HTTP validators of a /data query under a metrics version: (ETag, Last-Modified or None)
+def response_validators(query, version):
+    version_key = response_version_key(version)
+    query_key = hashlib.sha256(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()[:32]
+    last_modified = None
+    if version is not None:
+        last_modified = format_datetime(version.replace(tzinfo=timezone.utc), usegmt=True)
+    return f'"{version_key}-{query_key}"', last_modified
+
+# Function to tell whether the client already holds this version. If-None-Match decides when it is sent
+# and If-Modified-Since is then ignored (RFC 9110 13.2.2). Last-Modified only has whole seconds, so a
+# date is compared with the full version: a write later in the same second is still a change.
+def not_modified(request, etag, version):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and version is not None:
+        try:
+            return version.replace(tzinfo=timezone.utc) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+# Function to name a metrics version in ETags and the response cache; the names sort in version order
+def response_version_key(version):
+    return f"{version:%Y%m%d%H%M%S%f}" if version is not None else "0" * 20
+
+def _response_cache_path(etag):
+    version_key, query_key = etag.strip('"').split("-")
+    return os.path.join(response_cache_dir, version_key), os.path.join(response_cache_dir, version_key, query_key)
+
+# Function to read a cached /data response: (body bytes, headers) or None
+def read_cached_response(etag):
     try:
-        data = fetch_data_from_db()
-        return data
+        with open(_response_cache_path(etag)[1], "rb") as f:
+            headers = json.loads(f.readline())
+            return f.read(), headers
+    except (OSError, ValueError):
+        return None
+
+# Function to store a /data response for the other workers. The first write under a new metrics
+# version removes the directories of older versions; a worker whose version is already older than
+# a cached one (it re-reads the version every amended_check_seconds) does not cache. Failures only
+# cost a cache miss.
+def write_cached_response(etag, body, headers):
+    version_dir, path = _response_cache_path(etag)
+    version_key = os.path.basename(version_dir)
+    try:
+        if not os.path.isdir(version_dir):
+            os.makedirs(response_cache_dir, exist_ok=True)
+            names = [name for name in os.listdir(response_cache_dir) if name != version_key]
+            # Directories of another key format (older releases) count as older
+            older = [name for name in names if len(name) != len(version_key) or not name.isdigit() or name < version_key]
+            if len(older) < len(names):
+                return
+            os.makedirs(version_dir, exist_ok=True)
+            for name in older:
+                shutil.rmtree(os.path.join(response_cache_dir, name), ignore_errors=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(json.dumps(headers).encode() + b"\n")
+            f.write(body)
+        os.replace(temporary, path)  # Readers see the whole file or none
+    except OSError as e:
+        print(f"Could not cache the response: {str(e)}")
+
+# Endpoint to get data, optionally filtered, projected and paged:
+#     /data?device_id=a&device_id=b&start_day=2025-01-01&end_day=2025-01-31&start_hour=7&end_hour=9
+#     /data?columns=day,hour,power_consumption&limit=10000  (then &cursor=<X-Next-Cursor> for the next page)
+# Days and hours are inclusive. Without limit every matching row is returned.
+# Responses carry an ETag and Last-Modified that change only when metrics_calculator writes; a client
+# sending them back gets 304 without a query, and other clients get the cached body.
+# Other formats, by Accept header (see media_types):
+#     application/vnd.apache.arrow.stream  Arrow IPC stream, one record batch per chunk read
+#     application/vnd.apache.parquet       Parquet file, one row group per chunk read
+#     application/x-ndjson                 one JSON object per line
+# Arrow and NDJSON are streamed as the rows are read and have no X-Next-Cursor (the last id is the
+# cursor of a full page); use them for large exports.
+@app.get("/data", response_model=List[EnergyData], response_model_exclude_unset=True)
+async def get_data(
+    request: Request,
+    device_id: Optional[List[str]] = Query(None),
+    start_day: Optional[date] = None,
+    end_day: Optional[date] = None,
+    start_hour: Optional[int] = Query(None, ge=0, le=23),
+    end_hour: Optional[int] = Query(None, ge=0, le=23),
+    columns: Optional[str] = Query(None, description="Comma-separated columns to return; id is always included"),
+    cursor: Optional[int] = Query(None, description="Return rows after this id (X-Next-Cursor of the previous page)"),
+    limit: Optional[int] = Query(None, ge=1, le=max_page_rows),
+):
+    selected = None
+    if columns:
+        selected = ["id", *dict.fromkeys(column.strip() for column in columns.split(",") if column.strip() and column.strip() != "id")]
+        unknown = [column for column in selected if column not in data_columns]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown columns {unknown}, expected some of {data_columns}")
+    try:
+        # Queries that select the same rows share a cache entry
+        media_type, response_format = negotiate(request.headers.get("accept", ""))
+        query = {
+            "format": response_format,
+            "device_id": sorted(set(device_id)) if device_id else None,
+            "start_day": start_day, "end_day": end_day, "start_hour": start_hour, "end_hour": end_hour,
+            "columns": selected, "cursor": cursor, "limit": limit,
+        }
+        version = metrics_version()
+        etag, last_modified = response_validators(query, version)
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}  # Clients revalidate on every use
+        if last_modified is not None:
+            headers["Last-Modified"] = last_modified
+        if not_modified(request, etag, version):
+            return Response(status_code=304, headers=headers)
+
+        # Binary and NDJSON responses have the model's columns (id first), as a JSON response would
+        projection = selected or data_columns
+        args = (query["device_id"], start_day, end_day, start_hour, end_hour, projection, cursor, limit)
+        if response_format == "ndjson":
+            chunks = encode_ndjson(fetch_batches_from_db(*args))
+        elif response_format == "arrow":
+            chunks = encode_arrow_stream(fetch_batches_from_db(*args), projection)
+        if response_format in ("ndjson", "arrow"):
+            try:
+                first = next(chunks, b"")  # Runs the query now, so a database error is still a 500
+            except Exception as e:
+                print(f"Database connection error: {str(e)}")
+                raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+            return StreamingResponse(itertools.chain([first], chunks), media_type=media_type, headers=headers)
+
+        cached = read_cached_response(etag)
+        if cached is not None:
+            body, cached_headers = cached
+            return Response(content=body, media_type=media_type, headers={**headers, **cached_headers})
+
+        if response_format == "parquet":
+            body, last_id, count = encode_parquet(fetch_batches_from_db(*args), projection)
+        else:
+            data = fetch_data_from_db(query["device_id"], start_day, end_day, start_hour, end_hour, selected, cursor, limit)
+            body = JSONResponse(jsonable_encoder([EnergyData(**item) for item in data], exclude_unset=True)).body
+            last_id, count = (data[-1]["id"] if data else None), len(data)
+        # A full page may have more rows after it
+        page_headers = {"X-Next-Cursor": str(last_id)} if limit is not None and count == limit else {}
+        write_cached_response(etag, body, page_headers)
+        return Response(content=body, media_type=media_type, headers={**headers, **page_headers})
     except HTTPException as e:
         raise e
     except Exception as e:
         print(f"Error in get_data endpoint: {str(e)}")  # Improved error logging
         raise HTTPException(status_code=500, detail=str(e))
 
+# Function to fetch one metrics row by its primary key, through the row cache; None when there is no such row
+def fetch_row_by_id(data_id):
+    try:
+        metrics_version()
+        if data_id in _row_cache:
+            _row_cache.move_to_end(data_id)
+            return _row_cache[data_id]
+
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM device_consumption_metrics WHERE id = ?", (data_id,))
+            names = [column[0] for column in cursor.description]
+            row = cursor.fetchone()
+            cursor.close()
+    except Exception as e:
+        print(f"Database connection error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    if row is None:
+        return None
+    item = {name: value.isoformat() if isinstance(value, date) else value for name, value in zip(names, row)}
+    if interval_closed(item):
+        _row_cache[data_id] = item
+        if len(_row_cache) > row_cache_size:
+            _row_cache.popitem(last=False)
+    return item
+
 # Endpoint to get data by ID
 @app.get("/data/{data_id}", response_model=EnergyData)
 async def get_data_by_id(data_id: int):
     try:
-        data = fetch_data_from_db()
-        for item in data:
-            if item["id"] == data_id:
-                return item
-        raise HTTPException(status_code=404, detail="Data not found")
+        item = fetch_row_by_id(data_id)
+        if item is None:
+            raise HTTPException(status_code=404, detail="Data not found")
+        return item
     except HTTPException as e:
         raise e
     except Exception as e:
         print(f"Error in get_data_by_id endpoint: {str(e)}")  # Improved error logging
         raise HTTPException(status_code=500, detail=str(e))
 
+# Rollup tables maintained by metrics_calculator, by level
+rollup_tables = {
+    "hourly": "device_consumption_hourly",
+    "daily": "device_consumption_daily",
+    "monthly": "device_consumption_monthly",
+}
+
+# Endpoint to get hourly, daily or monthly totals without re-aggregating the 10-minute data
+@app.get("/rollups/{level}")
+async def get_rollups(level: str, device_id: Optional[str] = None):
+    if level not in rollup_tables:
+        raise HTTPException(status_code=404, detail=f"Unknown rollup level, expected one of {list(rollup_tables)}")
+    try:
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+            query = f"SELECT * FROM {rollup_tables[level]}"
+            if device_id is not None:
+                cursor.execute(query + " WHERE device_id = ?", (device_id,))
+            else:
+                cursor.execute(query)
+            columns = [column[0] for column in cursor.description]
+
+            # Dates are returned in YYYY-MM-DD format, like /data
+            return [
+                {column: value.isoformat() if isinstance(value, date) else value for column, value in zip(columns, row)}
+                for row in cursor.fetchall()
+            ]
+    except Exception as e:
+        print(f"Error in get_rollups endpoint: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
 # Run the API
 if __name__ == "__main__":
     import uvicorn
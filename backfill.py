@@ -0,0 +1,155 @@
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import batch_process
+import db_pool
+
+# Re-parses a past time range of mqtt_raw_data into the target database:
+#
+#     python backfill.py --start 2025-01-01 --end 2025-01-08 --chunk-hours 6 --workers 4
+#
+# The range is split into chunks that are processed in parallel. Each chunk keeps its own
+# (timestamp, id) checkpoint in process_metadata under "backfill:<chunk start>-<chunk end>",
+# so an interrupted run resumes where it stopped when started again with the same range and
+# chunk size. The live batch_process watermark is never read or written. Rows are upserted on
+# id, so re-parsing rows that already exist updates them in place.
+
+# Checkpoint id for a chunk that has not started yet: includes every row at the chunk start
+chunk_start_id = -1
+
+
+# Function to name the process_metadata row holding a chunk checkpoint
+def checkpoint_name(chunk_start, chunk_end):
+    return f"backfill:{chunk_start:%Y%m%dT%H%M%S}-{chunk_end:%Y%m%dT%H%M%S}"
+
+
+# Function to read a chunk checkpoint; returns None if the chunk has not been started
+def read_checkpoint(name):
+    with db_pool.connection("target") as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT last_fetched_timestamp, last_fetched_id
+            FROM process_metadata
+            WHERE process_name = ?
+        """, (name,))
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else None
+
+
+# Function to store a chunk checkpoint
+def write_checkpoint(name, position):
+    with db_pool.connection("target") as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE process_metadata
+            SET last_fetched_timestamp = ?, last_fetched_id = ?
+            WHERE process_name = ?
+        """, (*position, name))
+        if cursor.rowcount == 0:
+            cursor.execute("""
+                INSERT INTO process_metadata (process_name, last_fetched_timestamp, last_fetched_id)
+                VALUES (?, ?, ?)
+            """, (name, *position))
+        conn.commit()
+
+
+# Function to split [start, end) into consecutive chunks
+def split_range(start, end, chunk_size):
+    chunks = []
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + chunk_size, end)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return chunks
+
+
+# Function to re-parse one chunk, resuming from its checkpoint; returns the number of rows processed
+def backfill_chunk(chunk_start, chunk_end, batch_size, executor=None):
+    name = checkpoint_name(chunk_start, chunk_end)
+    position = read_checkpoint(name) or (chunk_start, chunk_start_id)
+    if position[0] >= chunk_end:
+        logging.info(f"Chunk {name} already done, skipping.")
+        return 0
+
+    processed = 0
+    while True:
+        rows = batch_process.fetch_rows(*position, batch_size, until_timestamp=chunk_end)
+        if not rows:
+            break
+
+        if executor:
+            parsed_data = batch_process.parse_batch_sharded(rows, executor)
+        else:
+            parsed_data = batch_process.parse_batch(rows)
+        if not batch_process.insert_parsed_data(parsed_data):
+            raise RuntimeError(f"Batch after {position} in chunk {name} was not committed")
+
+        position = (rows[-1]["timestamp"], rows[-1]["id"])
+        write_checkpoint(name, position)
+        processed += len(rows)
+
+    # Mark the chunk as done so a resumed run skips it
+    write_checkpoint(name, (chunk_end, batch_process.max_row_id))
+    logging.info(f"Chunk {name} done, {processed} rows re-parsed.")
+    return processed
+
+
+def parse_datetime(value):
+    return datetime.fromisoformat(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-parse a time range of raw telegrams into the target database.")
+    parser.add_argument("--start", type=parse_datetime, required=True, help="Range start (inclusive), ISO date or datetime")
+    parser.add_argument("--end", type=parse_datetime, required=True, help="Range end (exclusive), ISO date or datetime")
+    parser.add_argument("--chunk-hours", type=float, default=6, help="Size of each checkpointed chunk in hours")
+    parser.add_argument("--workers", type=int, default=4, help="Chunks processed in parallel")
+    parser.add_argument("--batch-size", type=int, default=batch_process.max_batch_size, help="Rows fetched per round trip")
+    parser.add_argument("--parse-processes", type=int, default=batch_process.parse_processes,
+                        help="Worker processes for parsing, sharded by device (0 parses in the chunk threads)")
+    args = parser.parse_args()
+
+    if args.end <= args.start:
+        parser.error("--end must be after --start")
+
+    chunks = split_range(args.start, args.end, timedelta(hours=args.chunk_hours))
+    logging.info(f"Backfilling {args.start} to {args.end} in {len(chunks)} chunks with {args.workers} workers.")
+
+    # Every chunk worker holds a source and a target connection while it runs
+    for pool_name in ("source", "target"):
+        pool = db_pool.get_pool(pool_name)
+        pool.max_size = max(pool.max_size, args.workers + 1)
+    batch_process.ensure_databases()
+
+    batch_process.parse_processes = args.parse_processes
+    executor = ProcessPoolExecutor(max_workers=args.parse_processes, mp_context=batch_process.worker_context) if args.parse_processes > 0 else None
+
+    failed = []
+    total = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as chunk_pool:
+            futures = {
+                chunk_pool.submit(backfill_chunk, chunk_start, chunk_end, args.batch_size, executor): (chunk_start, chunk_end)
+                for chunk_start, chunk_end in chunks
+            }
+            for future in as_completed(futures):
+                try:
+                    total += future.result()
+                except Exception as e:
+                    logging.error(f"Chunk {checkpoint_name(*futures[future])} failed: {e}")
+                    failed.append(futures[future])
+    finally:
+        if executor:
+            batch_process.stop_parse_workers(executor)
+
+    logging.info(f"Backfill finished: {total} rows re-parsed, {len(chunks) - len(failed)}/{len(chunks)} chunks done.")
+    if failed:
+        logging.error("Re-run the same command to resume the failed chunks.")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
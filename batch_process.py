@@ -1,8 +1,20 @@
-import pyodbc
 from datetime import datetime, timedelta, timezone
+import argparse
 import time
 import logging
-import re
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import db_pool
+import instrumentation
+import parquet_store
+import watermark_signal
+from telegram_parser import FIELD_NAMES, parse_data
+from bulk_writer import merge_rows
+from schema import SOURCE_SCHEMA, TARGET_SCHEMA, ensure_schema, report_duplicate_intervals
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -37,283 +49,402 @@ target_conn_str = (
     f"PWD={target_db_password};"
 )
 
+# Connection pools shared by all pipeline stages
+db_pool.register_pool("source", db_pool.pyodbc_backend(source_conn_str))
+db_pool.register_pool("target", db_pool.pyodbc_backend(target_conn_str))
+
 # Process name (used to identify the process in the metadata table)
 process_name = "mqtt_raw_data_processor"
 
-# Function to parse the data field
-def parse_data(data):
-    parsed_data = {}
-    try:
-        # Extract total energy consumed (1-0:1.8.0)
-        match = re.search(r"1-0:1\.8\.0\((\d+\.\d+)\*kWh\)", data)
-        if match:
-            parsed_data["total_energy_consumed"] = float(match.group(1))
-        else:
-            parsed_data["total_energy_consumed"] = None  # Handle missing data
-
-        # Extract current power consumption (1-0:1.7.0)
-        match = re.search(r"1-0:1\.7\.0\((\d+\.\d+)\*kW\)", data)
-        if match:
-            parsed_data["current_power_consumption"] = float(match.group(1))
-        else:
-            parsed_data["current_power_consumption"] = None
-
-        # Extract phase 1, 2, and 3 energy (1-0:21.7.0, 1-0:41.7.0, 1-0:61.7.0)
-        match = re.search(r"1-0:21\.7\.0\((\d+\.\d+)\*kW\)", data)
-        if match:
-            parsed_data["phase1_energy"] = float(match.group(1))
-        else:
-            parsed_data["phase1_energy"] = None
-
-        match = re.search(r"1-0:41\.7\.0\((\d+\.\d+)\*kW\)", data)
-        if match:
-            parsed_data["phase2_energy"] = float(match.group(1))
-        else:
-            parsed_data["phase2_energy"] = None
-
-        match = re.search(r"1-0:61\.7\.0\((\d+\.\d+)\*kW\)", data)
-        if match:
-            parsed_data["phase3_energy"] = float(match.group(1))
-        else:
-            parsed_data["phase3_energy"] = None
-
-        # Extract phase 1, 2, and 3 voltage (1-0:32.7.0, 1-0:52.7.0, 1-0:72.7.0)
-        match = re.search(r"1-0:32\.7\.0\((\d+\.\d+)\*V\)", data)
-        if match:
-            parsed_data["phase1_voltage"] = float(match.group(1))
-        else:
-            parsed_data["phase1_voltage"] = None
-
-        match = re.search(r"1-0:52\.7\.0\((\d+\.\d+)\*V\)", data)
-        if match:
-            parsed_data["phase2_voltage"] = float(match.group(1))
-        else:
-            parsed_data["phase2_voltage"] = None
-
-        match = re.search(r"1-0:72\.7\.0\((\d+\.\d+)\*V\)", data)
-        if match:
-            parsed_data["phase3_voltage"] = float(match.group(1))
-        else:
-            parsed_data["phase3_voltage"] = None
-
-        # Extract phase 1, 2, and 3 current (1-0:31.7.0, 1-0:51.7.0, 1-0:71.7.0)
-        match = re.search(r"1-0:31\.7\.0\((\d+\.\d+)\*A\)", data)
-        if match:
-            parsed_data["phase1_current"] = float(match.group(1))
-        else:
-            parsed_data["phase1_current"] = None
-
-        match = re.search(r"1-0:51\.7\.0\((\d+\.\d+)\*A\)", data)
-        if match:
-            parsed_data["phase2_current"] = float(match.group(1))
-        else:
-            parsed_data["phase2_current"] = None
-
-        match = re.search(r"1-0:71\.7\.0\((\d+\.\d+)\*A\)", data)
-        if match:
-            parsed_data["phase3_current"] = float(match.group(1))
-        else:
-            parsed_data["phase3_current"] = None
-
-        # Extract reactive energy consumed (1-0:3.8.0)
-        match = re.search(r"1-0:3\.8\.0\((\d+\.\d+)\*kVArh\)", data)
-        if match:
-            parsed_data["reactive_energy_consumed"] = float(match.group(1))
-        else:
-            parsed_data["reactive_energy_consumed"] = None
-
-        # Extract tariff 1 and tariff 2 energy (1-0:1.8.0, 1-0:2.8.0)
-        match = re.search(r"1-0:1\.8\.0\((\d+\.\d+)\*kWh\)", data)
-        if match:
-            parsed_data["tariff1_energy"] = float(match.group(1))
-        else:
-            parsed_data["tariff1_energy"] = None
-
-        match = re.search(r"1-0:2\.8\.0\((\d+\.\d+)\*kWh\)", data)
-        if match:
-            parsed_data["tariff2_energy"] = float(match.group(1))
-        else:
-            parsed_data["tariff2_energy"] = None
+# Columns written to the target mqtt_raw_data table
+parsed_columns = ["id", "device_id", "timestamp", "processed", *FIELD_NAMES]
 
-    except Exception as e:
-        logging.error(f"Error parsing data: {e}")
-        parsed_data = {}  # Return an empty dict if parsing fails
+# Columns of the mqtt_raw_data_rejects dead-letter table
+reject_columns = ["id", "device_id", "timestamp", "data", "error", "rejected_at"]
 
-    return parsed_data
+# Pipeline settings
+queue_size = int(os.getenv("BATCH_QUEUE_SIZE", "4"))  # Batches buffered between stages before the upstream stage blocks
+parse_workers = int(os.getenv("BATCH_PARSE_WORKERS", "2"))
+parse_processes = int(os.getenv("BATCH_PARSE_PROCESSES", "0"))  # 0 parses in the parser threads, N shards batches over N processes
+parse_timeout = int(os.getenv("BATCH_PARSE_TIMEOUT", "300"))  # Seconds a sharded batch may take before the pipeline restarts
+poll_interval = int(os.getenv("BATCH_POLL_INTERVAL", "20"))  # Seconds to wait once the source is drained
+min_batch_size = int(os.getenv("BATCH_MIN_SIZE", "1000"))
+max_batch_size = int(os.getenv("BATCH_MAX_SIZE", "20000"))
 
-# Function to fetch new data from the source database (100 rows at a time)
-def fetch_new_data(last_fetched_timestamp):
-    try:
-        conn = pyodbc.connect(source_conn_str)
+# Parse workers start from a fresh interpreter (forkserver where available) rather than a fork of this
+# multithreaded process
+worker_context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Keyset id used when the watermark has no id yet: skips every row at the stored timestamp
+max_row_id = 2**63 - 1
+
+# Function to fetch the next batch after the (timestamp, id) keyset cursor from the source database.
+# until_timestamp bounds the range (exclusive); database errors are raised to the caller.
+def fetch_rows(last_fetched_timestamp, last_fetched_id, batch_size, until_timestamp=None):
+    with db_pool.connection("source") as conn:
         cursor = conn.cursor()
 
-        query = """
+        upper_bound = "AND timestamp < ?" if until_timestamp is not None else ""
+        page = "LIMIT ?" if db_pool.get_pool("source").dialect == "sqlite" else "OFFSET 0 ROWS FETCH NEXT ? ROWS ONLY"
+        query = f"""
             SELECT id, device_id, timestamp, processed, data
             FROM mqtt_raw_data
-            WHERE timestamp > ?
-            ORDER BY timestamp
-            OFFSET 0 ROWS
-            FETCH NEXT 1000 ROWS ONLY
+            WHERE timestamp >= ? AND (timestamp > ? OR id > ?) {upper_bound}
+            ORDER BY timestamp, id
+            {page}
         """
-        cursor.execute(query, last_fetched_timestamp)
+        if last_fetched_id is None:
+            last_fetched_id = max_row_id
+        params = [last_fetched_timestamp, last_fetched_timestamp, last_fetched_id]
+        if until_timestamp is not None:
+            params.append(until_timestamp)
+        cursor.execute(query, (*params, batch_size))
         rows = cursor.fetchall()
 
         # Convert rows to a list of dictionaries
         data = [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
         return data
+
+# Function to fetch new data for the live pipeline (errors are logged and read as "no new data")
+def fetch_new_data(last_fetched_timestamp, last_fetched_id, batch_size):
+    try:
+        return fetch_rows(last_fetched_timestamp, last_fetched_id, batch_size)
     except Exception as e:
         logging.error(f"Error fetching data: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
-# Function to insert parsed data into the target database
+# Function to upsert parsed data into the target database
+# Returns True when the batch is committed (rows with bad data go to the dead-letter table), False otherwise
 def insert_parsed_data(data):
     if not data:
         logging.info("No new data to insert.")
-        return
+        return True
 
     try:
-        conn = pyodbc.connect(target_conn_str)
-        cursor = conn.cursor()
-
-        # Prepare the insert query
-        insert_query = """
-            INSERT INTO mqtt_raw_data (
-                id, device_id, timestamp, processed,
-                total_energy_consumed, current_power_consumption,
-                phase1_energy, phase2_energy, phase3_energy,
-                phase1_voltage, phase2_voltage, phase3_voltage,
-                phase1_current, phase2_current, phase3_current,
-                reactive_energy_consumed, tariff1_energy, tariff2_energy
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
-
-        # Prepare the data for batch insertion
-        insert_data = [
-            (
-                item["id"],
-                item["device_id"],
-                item["timestamp"],
-                item["processed"],
-                item["total_energy_consumed"],
-                item["current_power_consumption"],
-                item["phase1_energy"],
-                item["phase2_energy"],
-                item["phase3_energy"],
-                item["phase1_voltage"],
-                item["phase2_voltage"],
-                item["phase3_voltage"],
-                item["phase1_current"],
-                item["phase2_current"],
-                item["phase3_current"],
-                item["reactive_energy_consumed"],
-                item["tariff1_energy"],
-                item["tariff2_energy"]
-            )
-            for item in data
-        ]
-
-        # Execute the batch insert
-        cursor.executemany(insert_query, insert_data)
-        conn.commit()
-        logging.info(f"Inserted {len(data)} records successfully.")
-    except pyodbc.IntegrityError as e:
-        logging.warning(f"Skipping duplicate records: {e}")
+        with db_pool.connection("target") as conn:
+            # Prepare the data for batch insertion, in parsed_columns order
+            insert_data = [tuple(item[column] for column in parsed_columns) for item in data]
+
+            # Stage the batch and MERGE it on id, so replays update rows instead of failing on duplicates
+            dialect = db_pool.get_pool("target").dialect
+            written, rejected = merge_rows(conn, "mqtt_raw_data", parsed_columns, ["id"], insert_data, dialect)
+            instrumentation.inc("batch_rows_written_total", written)
+            instrumentation.inc("batch_rows_rejected_total", len(rejected))
+            logging.info(f"Upserted {written} records successfully ({len(rejected)} rejected).")
+
+            # The watermark moves past rejected rows, so they are kept for replay; if that fails the
+            # batch counts as not committed and is retried
+            if rejected:
+                save_rejects(conn, data, rejected, dialect)
     except Exception as e:
         logging.error(f"Error inserting data: {e}")
-    finally:
-        if conn:
-            conn.close()
+        return False
+
+    # Keep the local columnar copy (if enabled) in step with the committed rows
+    rejected_ids = {row[0] for row, _ in rejected}
+    parquet_store.write_rows([item for item in data if item["id"] not in rejected_ids])
+    return True
+
+# Function to write rows rejected by merge_rows to the dead-letter table, with their raw telegram and error
+def save_rejects(conn, data, rejected, dialect):
+    items = {item["id"]: item for item in data}
+    rejected_at = datetime.now(timezone.utc)
+    rows = [
+        (row[0], items[row[0]]["device_id"], items[row[0]]["timestamp"], items[row[0]].get("data"), str(error), rejected_at)
+        for row, error in rejected
+    ]
+    saved, failed = merge_rows(conn, "mqtt_raw_data_rejects", reject_columns, ["id"], rows, dialect)
+    if failed:
+        raise RuntimeError(f"{len(failed)} rejected rows could not be saved to mqtt_raw_data_rejects")
+    logging.warning(f"Saved {saved} rejected rows to mqtt_raw_data_rejects.")
+
+# Function to parse the dead-letter rows again and upsert them into mqtt_raw_data, e.g. after a parser or
+# schema fix. Rows that are written leave the table; the others keep it with their new error.
+# Returns the (first, last) timestamp of the replayed rows, for a metrics reprocess of that range, or None.
+def replay_rejects():
+    with db_pool.connection("target") as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(reject_columns)} FROM mqtt_raw_data_rejects ORDER BY timestamp, id")
+        rejects = [dict(zip(reject_columns, row)) for row in cursor.fetchall()]
+        cursor.close()
+
+        data = []
+        for item in rejects:
+            parsed_item = parse_data(item["data"] or "")
+            if parsed_item:
+                data.append({**item, "processed": 0, **parsed_item})
+        if not data:
+            logging.info(f"No replayable rows among {len(rejects)} rejects.")
+            return None
+
+        dialect = db_pool.get_pool("target").dialect
+        insert_data = [tuple(item[column] for column in parsed_columns) for item in data]
+        written, rejected = merge_rows(conn, "mqtt_raw_data", parsed_columns, ["id"], insert_data, dialect)
+        if rejected:
+            save_rejects(conn, data, rejected, dialect)
+        rejected_ids = {row[0] for row, _ in rejected}
+        replayed = [item for item in data if item["id"] not in rejected_ids]
 
-# Function to get the last fetched timestamp from the metadata table
-def get_last_fetched_timestamp():
-    try:
-        conn = pyodbc.connect(target_conn_str)
         cursor = conn.cursor()
+        for start in range(0, len(replayed), 1000):
+            ids = [item["id"] for item in replayed[start:start + 1000]]
+            cursor.execute(f"DELETE FROM mqtt_raw_data_rejects WHERE id IN ({', '.join('?' for _ in ids)})", ids)
+        conn.commit()
+        cursor.close()
 
-        query = """
-            SELECT last_fetched_timestamp
-            FROM process_metadata
-            WHERE process_name = ?
-        """
-        cursor.execute(query, process_name)
-        row = cursor.fetchone()
-
-        if row:
-            return row[0]
-        else:
-            # If no record exists, insert a default timestamp (e.g., 1 hour ago)
-            default_timestamp = datetime.now(timezone.utc) - timedelta(hours=1)
-            cursor.execute("""
-                INSERT INTO process_metadata (process_name, last_fetched_timestamp)
-                VALUES (?, ?)
-            """, process_name, default_timestamp)
-            conn.commit()
-            return default_timestamp
+    parquet_store.write_rows(replayed)
+    logging.info(f"Replayed {written} of {len(rejects)} rejected rows ({len(rejected)} rejected again).")
+    if not replayed:
+        return None
+    return min(item["timestamp"] for item in replayed), max(item["timestamp"] for item in replayed)
+
+# Function to get the last fetched (timestamp, id) position from the metadata table
+def get_last_fetched_position():
+    try:
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+
+            query = """
+                SELECT last_fetched_timestamp, last_fetched_id
+                FROM process_metadata
+                WHERE process_name = ?
+            """
+            cursor.execute(query, (process_name,))
+            row = cursor.fetchone()
+
+            if row:
+                return row[0], row[1]
+            else:
+                # If no record exists, insert a default timestamp (1 hour ago, naive UTC like the stored timestamps)
+                default_timestamp = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=1)
+                cursor.execute("""
+                    INSERT INTO process_metadata (process_name, last_fetched_timestamp)
+                    VALUES (?, ?)
+                """, (process_name, default_timestamp))
+                conn.commit()
+                return default_timestamp, None
     except Exception as e:
         logging.error(f"Error fetching last timestamp: {e}")
-        return datetime.now(timezone.utc) - timedelta(hours=1)
-    finally:
-        if conn:
-            conn.close()
+        return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=1), None
 
-# Function to update the last fetched timestamp in the metadata table
-def update_last_fetched_timestamp(new_timestamp):
+# Function to update the last fetched (timestamp, id) position in the metadata table
+def update_last_fetched_position(new_timestamp, new_id):
     try:
-        conn = pyodbc.connect(target_conn_str)
-        cursor = conn.cursor()
-
-        query = """
-            UPDATE process_metadata
-            SET last_fetched_timestamp = ?
-            WHERE process_name = ?
-        """
-        cursor.execute(query, new_timestamp, process_name)
-        conn.commit()
-        logging.info(f"Updated last_fetched_timestamp to {new_timestamp}.")
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+
+            query = """
+                UPDATE process_metadata
+                SET last_fetched_timestamp = ?, last_fetched_id = ?
+                WHERE process_name = ?
+            """
+            cursor.execute(query, (new_timestamp, new_id, process_name))
+            conn.commit()
+            logging.info(f"Updated last_fetched_timestamp to {new_timestamp} (id {new_id}).")
     except Exception as e:
         logging.error(f"Error updating last timestamp: {e}")
-    finally:
-        if conn:
-            conn.close()
 
-# Main function to run the batch process
-def run_batch_process():
+# Function to parse a fetched batch
+def parse_batch(rows):
+    parsed_data = []
+    for item in rows:
+        parsed_item = parse_data(item["data"])
+        if parsed_item:
+            parsed_data.append({
+                **item,
+                **parsed_item
+            })
+    return parsed_data
+
+# Function to parse one device shard in a worker process; returns (position in batch, parsed fields)
+def parse_shard(shard):
+    return [(position, parse_data(data)) for position, data in shard]
+
+# Function to parse a batch across worker processes, sharded by device_id
+def parse_batch_sharded(rows, executor):
+    # A device always hashes to the same shard, and each shard keeps the batch order of its rows
+    shards = [[] for _ in range(parse_processes)]
+    for position, item in enumerate(rows):
+        shards[zlib.crc32(str(item["device_id"]).encode()) % parse_processes].append((position, item["data"]))
+
+    parsed_items = [None] * len(rows)
+    for results in executor.map(parse_shard, [shard for shard in shards if shard], timeout=parse_timeout):
+        for position, parsed_item in results:
+            parsed_items[position] = parsed_item
+
+    # Reassemble in fetch (timestamp, id) order so writes keep per-device ordering
+    return [
+        {**item, **parsed_item}
+        for item, parsed_item in zip(rows, parsed_items)
+        if parsed_item
+    ]
+
+# Function to put an item on a bounded queue, blocking until there is room or the pipeline stops
+def put_until_stopped(stage_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+# Function to take an item from a queue, returning None when the pipeline stops
+def get_until_stopped(stage_queue, stop_event):
+    while not stop_event.is_set():
+        try:
+            return stage_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+    return None
+
+# Function to size the next fetch: grow while pages come back full, shrink once caught up
+def next_batch_size(batch_size, fetched):
+    if fetched >= batch_size:
+        return min(batch_size * 2, max_batch_size)
+    if fetched < batch_size // 2:
+        return max(batch_size // 2, min_batch_size)
+    return batch_size
+
+# Source reader stage: fetches batches ahead of the committed watermark
+def read_source(parse_queue, stop_event):
+    last_fetched_timestamp, last_fetched_id = get_last_fetched_position()
+    batch_size = min_batch_size
+    sequence = 0
+    while not stop_event.is_set():
+        with instrumentation.timer("batch_fetch_seconds"):
+            new_data = fetch_new_data(last_fetched_timestamp, last_fetched_id, batch_size)
+        fetched = len(new_data)
+        instrumentation.inc("batch_rows_fetched_total", fetched)
+        instrumentation.set_gauge("batch_fetch_size", batch_size)
+        if new_data:
+            # Rows are in keyset order, so the last one is the new read position
+            last_fetched_timestamp, last_fetched_id = new_data[-1]["timestamp"], new_data[-1]["id"]
+            if not put_until_stopped(parse_queue, (sequence, new_data), stop_event):
+                return
+            instrumentation.set_gauge("batch_parse_queue_depth", parse_queue.qsize())
+            sequence += 1
+
+        # A short page means the backlog is drained, wait before polling the source again
+        if fetched < batch_size:
+            stop_event.wait(poll_interval)
+        batch_size = next_batch_size(batch_size, fetched)
+
+# Parser stage: several workers take batches from the reader
+def parse_source(parse_queue, write_queue, executor, stop_event):
+    while True:
+        item = get_until_stopped(parse_queue, stop_event)
+        if item is None:
+            return
+        sequence, new_data = item
+        with instrumentation.timer("batch_parse_seconds"):
+            parsed_data = parse_batch_sharded(new_data, executor) if executor else parse_batch(new_data)
+        instrumentation.inc("batch_rows_parsed_total", len(parsed_data))
+        instrumentation.inc("batch_rows_unparsed_total", len(new_data) - len(parsed_data))
+        batch = (sequence, parsed_data, (new_data[-1]["timestamp"], new_data[-1]["id"]))
+        if not put_until_stopped(write_queue, batch, stop_event):
+            return
+
+# Target writer stage: commits batches in fetch order and only then advances the watermark
+def write_target(write_queue, stop_event):
+    pending = {}
+    next_sequence = 0
     while True:
+        item = get_until_stopped(write_queue, stop_event)
+        if item is None:
+            return
+        sequence, parsed_data, batch_position = item
+        pending[sequence] = (parsed_data, batch_position)
+
+        # Parser workers may finish out of order; write as soon as the next batch in sequence is ready
+        instrumentation.set_gauge("batch_reorder_pending", len(pending))
+        while next_sequence in pending:
+            parsed_data, batch_position = pending.pop(next_sequence)
+            with instrumentation.timer("batch_insert_seconds"):
+                committed = insert_parsed_data(parsed_data)
+            if not committed:
+                logging.error(f"Batch {next_sequence} was not committed, restarting from the last watermark.")
+                stop_event.set()
+                return
+            update_last_fetched_position(*batch_position)
+            # Wake metrics_calculator for the newly committed rows
+            watermark_signal.notify(batch_position[0])
+            # How far the committed watermark trails the wall clock
+            instrumentation.set_gauge("batch_watermark_lag_seconds", instrumentation.seconds_since(batch_position[0]))
+            next_sequence += 1
+
+# Function to run a pipeline stage, stopping the whole pipeline if it fails
+def run_stage(stage, stop_event, *args):
+    try:
+        stage(*args, stop_event)
+    except Exception as e:
+        logging.error(f"Error in {stage.__name__} stage: {e}")
+        stop_event.set()
+
+# Function to run the reader, parser and writer stages concurrently until one of them stops
+def run_pipeline():
+    stop_event = threading.Event()
+    parse_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    executor = ProcessPoolExecutor(max_workers=parse_processes, mp_context=worker_context) if parse_processes > 0 else None
+
+    threads = [threading.Thread(target=run_stage, args=(read_source, stop_event, parse_queue), name="reader", daemon=True)]
+    threads += [
+        threading.Thread(target=run_stage, args=(parse_source, stop_event, parse_queue, write_queue, executor), name=f"parser-{i}", daemon=True)
+        for i in range(parse_workers)
+    ]
+    threads.append(threading.Thread(target=run_stage, args=(write_target, stop_event, write_queue), name="writer", daemon=True))
+
+    for thread in threads:
+        thread.start()
+    while not stop_event.is_set():
+        stop_event.wait(1)  # Short waits keep the main thread responsive to Ctrl-C
+    for thread in threads:
+        thread.join()
+    if executor:
+        stop_parse_workers(executor)
+
+# Function to stop the parse worker processes without waiting on one that hangs
+def stop_parse_workers(executor):
+    processes = list((executor._processes or {}).values())  # The executor has no public way to end its processes
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+        process.join()
+
+# Function to apply pending schema changes to the source and target databases
+def ensure_databases():
+    for pool_name, statements in (("source", SOURCE_SCHEMA), ("target", TARGET_SCHEMA)):
         try:
-            # Get the last fetched timestamp
-            last_fetched_timestamp = get_last_fetched_timestamp()
-
-            # Fetch new data (100 rows at a time)
-            new_data = fetch_new_data(last_fetched_timestamp)
-
-            # Parse the data
-            parsed_data = []
-            for item in new_data:
-                parsed_item = parse_data(item["data"])
-                if parsed_item:
-                    parsed_data.append({
-                        **item,
-                        **parsed_item
-                    })
-
-            # Insert parsed data
-            insert_parsed_data(parsed_data)
-
-            # Update the last fetched timestamp
-            if parsed_data:
-                new_timestamp = max(item["timestamp"] for item in parsed_data)
-                update_last_fetched_timestamp(new_timestamp)
+            with db_pool.connection(pool_name) as conn:
+                ensure_schema(conn, statements)
+                if pool_name == "target":
+                    report_duplicate_intervals(conn)
         except Exception as e:
-            logging.error(f"Error in batch process: {e}")
+            logging.error(f"Error connecting to apply schema changes: {e}")
+
+# Main function to run the batch process
+def run_batch_process():
+    instrumentation.start_server()
+    ensure_databases()
+    while True:
+        run_pipeline()
 
-        # Wait for 1 minute before the next run
-        time.sleep(20)
+        # Wait before restarting the pipeline from the committed watermark
+        time.sleep(poll_interval)
 
-# Run the batch process
+# Run the batch process, or replay the dead-letter rows with --replay-rejects
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy and parse raw telegrams into the target database.")
+    parser.add_argument("--replay-rejects", action="store_true", help="Upsert the rows in mqtt_raw_data_rejects again and exit")
+    args = parser.parse_args()
+
+    if args.replay_rejects:
+        replayed = replay_rejects()
+        if replayed:
+            # Their intervals are behind the metrics watermark
+            logging.info(f"Recompute their metrics with: python metrics_calculator.py --reprocess {replayed[0].isoformat()} {(replayed[1] + timedelta(seconds=1)).isoformat()}")
+        raise SystemExit(0)
+
     logging.info("Starting batch process...")
     run_batch_process()
\ No newline at end of file
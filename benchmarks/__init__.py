@@ -0,0 +1,6 @@
+# Benchmarks for the ingest, metrics and API hot paths, run against local SQLite stand-ins:
+#
+#     python -m benchmarks.run --sizes 10k 1m --save local
+#     python -m benchmarks.run --sizes 10k --compare local
+#
+# Inputs come from the seeded telegram generator, so every run over the same size sees the same rows.
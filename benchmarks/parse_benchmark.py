@@ -0,0 +1,91 @@
+import re
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pandas as pd
+
+from telegram_parser import parse_column, parse_data
+
+# Representative DSMR 5 telegram as stored in mqtt_raw_data.data
+SAMPLE_TELEGRAM = "\r\n".join([
+    "/ISK5\\2M550T-1012",
+    "",
+    "1-3:0.2.8(50)",
+    "0-0:1.0.0(240101120000W)",
+    "0-0:96.1.1(4530303434303037313331363530363138)",
+    "1-0:1.8.1(001234.567*kWh)",
+    "1-0:1.8.2(002345.678*kWh)",
+    "1-0:2.8.1(000000.000*kWh)",
+    "1-0:2.8.2(000000.000*kWh)",
+    "0-0:96.14.0(0002)",
+    "1-0:1.8.0(003580.245*kWh)",
+    "1-0:2.8.0(000012.345*kWh)",
+    "1-0:3.8.0(000456.789*kVArh)",
+    "1-0:1.7.0(00.532*kW)",
+    "1-0:2.7.0(00.000*kW)",
+    "0-0:96.7.21(00010)",
+    "0-0:96.7.9(00003)",
+    "1-0:32.32.0(00002)",
+    "1-0:32.7.0(231.4*V)",
+    "1-0:52.7.0(229.8*V)",
+    "1-0:72.7.0(230.6*V)",
+    "1-0:31.7.0(001.20*A)",
+    "1-0:51.7.0(000.85*A)",
+    "1-0:71.7.0(000.31*A)",
+    "1-0:21.7.0(00.276*kW)",
+    "1-0:41.7.0(00.191*kW)",
+    "1-0:61.7.0(00.065*kW)",
+    "0-1:24.1.0(003)",
+    "0-1:24.2.1(240101115500W)(01234.567*m3)",
+    "!1A2B",
+])
+
+# The previous per-field implementation (one re.search per column), kept as the comparison baseline
+_LEGACY_PATTERNS = [
+    ("total_energy_consumed", r"1-0:1\.8\.0\((\d+\.\d+)\*kWh\)"),
+    ("current_power_consumption", r"1-0:1\.7\.0\((\d+\.\d+)\*kW\)"),
+    ("phase1_energy", r"1-0:21\.7\.0\((\d+\.\d+)\*kW\)"),
+    ("phase2_energy", r"1-0:41\.7\.0\((\d+\.\d+)\*kW\)"),
+    ("phase3_energy", r"1-0:61\.7\.0\((\d+\.\d+)\*kW\)"),
+    ("phase1_voltage", r"1-0:32\.7\.0\((\d+\.\d+)\*V\)"),
+    ("phase2_voltage", r"1-0:52\.7\.0\((\d+\.\d+)\*V\)"),
+    ("phase3_voltage", r"1-0:72\.7\.0\((\d+\.\d+)\*V\)"),
+    ("phase1_current", r"1-0:31\.7\.0\((\d+\.\d+)\*A\)"),
+    ("phase2_current", r"1-0:51\.7\.0\((\d+\.\d+)\*A\)"),
+    ("phase3_current", r"1-0:71\.7\.0\((\d+\.\d+)\*A\)"),
+    ("reactive_energy_consumed", r"1-0:3\.8\.0\((\d+\.\d+)\*kVArh\)"),
+    ("tariff1_energy", r"1-0:1\.8\.0\((\d+\.\d+)\*kWh\)"),
+    ("tariff2_energy", r"1-0:2\.8\.0\((\d+\.\d+)\*kWh\)"),
+]
+
+
+def legacy_parse_data(data):
+    parsed_data = {}
+    for name, pattern in _LEGACY_PATTERNS:
+        match = re.search(pattern, data)
+        parsed_data[name] = float(match.group(1)) if match else None
+    return parsed_data
+
+
+if __name__ == "__main__":
+    assert parse_data(SAMPLE_TELEGRAM) == legacy_parse_data(SAMPLE_TELEGRAM)
+
+    number = 20000
+    legacy = min(timeit.repeat(lambda: legacy_parse_data(SAMPLE_TELEGRAM), number=number, repeat=5))
+    current = min(timeit.repeat(lambda: parse_data(SAMPLE_TELEGRAM), number=number, repeat=5))
+
+    print(f"legacy parse_data:  {legacy / number * 1e6:.2f} us/row")
+    print(f"telegram_parser:    {current / number * 1e6:.2f} us/row")
+    print(f"speedup:            {legacy / current:.1f}x")
+
+    # Columnar mode against the previous /data path (apply + json_normalize) on 10k rows
+    telegrams = pd.Series([SAMPLE_TELEGRAM] * 10000)
+    legacy = min(timeit.repeat(lambda: pd.json_normalize(telegrams.apply(legacy_parse_data)), number=1, repeat=5))
+    current = min(timeit.repeat(lambda: parse_column(telegrams), number=1, repeat=5))
+
+    print(f"legacy column parse: {legacy * 1e3:.1f} ms/10k rows")
+    print(f"parse_column:        {current * 1e3:.1f} ms/10k rows")
+    print(f"speedup:             {legacy / current:.1f}x")
@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import batch_process
+import db_pool
+import metrics_calculator
+import rollups
+from benchmarks.telegram_generator import chunked, generate_rows
+from telegram_parser import parse_column, parse_data
+
+# Times the hot paths at several input sizes against SQLite stand-ins for the source and target databases:
+#
+#     python -m benchmarks.run --sizes 10k 1m 10m --repeat 1 --save local
+#     python -m benchmarks.run --compare local
+#
+# Results are written as JSON to benchmarks/baselines/<name>.json; --compare exits with status 1
+# when a benchmark got slower than its baseline by more than --max-regression.
+
+baselines_dir = Path(__file__).resolve().parent / "baselines"
+
+# Rows held in memory at a time, so 10M-row runs stream through the benchmarks
+chunk_rows = 100000
+
+# Rows per api.py /data response
+api_page_rows = 10000
+
+size_suffixes = {"k": 1000, "m": 1000000}
+
+# SQLite versions of the tables the benchmarked code reads and writes
+SOURCE_TABLES = [
+    """
+    CREATE TABLE mqtt_raw_data (
+        id INTEGER PRIMARY KEY, device_id TEXT, timestamp TIMESTAMP, processed INTEGER, data TEXT
+    )
+    """,
+    "CREATE INDEX IX_mqtt_raw_data_timestamp_id ON mqtt_raw_data (timestamp, id)",
+]
+
+TARGET_TABLES = [
+    f"""
+    CREATE TABLE mqtt_raw_data (
+        id INTEGER PRIMARY KEY, device_id TEXT, timestamp TIMESTAMP, processed INTEGER,
+        {", ".join(f"{name} REAL" for name in batch_process.parsed_columns[4:])}
+    )
+    """,
+    "CREATE INDEX IX_mqtt_raw_data_timestamp_id ON mqtt_raw_data (timestamp, id)",
+    """
+    CREATE TABLE device_consumption_metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, device_id TEXT, day DATE, hour INTEGER, interval_start INTEGER,
+        power_consumption REAL, reactive_energy_consumed REAL, tariff1_energy REAL, tariff2_energy REAL,
+        avg_phase1_voltage REAL, avg_phase2_voltage REAL, avg_phase3_voltage REAL,
+        avg_phase1_current REAL, avg_phase2_current REAL, avg_phase3_current REAL, quality_flag INTEGER,
+        UNIQUE (device_id, day, hour, interval_start)
+    )
+    """,
+    "CREATE INDEX IX_device_consumption_metrics_device_day_hour ON device_consumption_metrics (device_id, day, hour)",
+    "CREATE TABLE meter_registry (device_id TEXT PRIMARY KEY, max_value REAL NOT NULL)",
+    """
+    CREATE TABLE mqtt_raw_data_rejects (
+        id INTEGER PRIMARY KEY, device_id TEXT, timestamp TIMESTAMP, data TEXT, error TEXT, rejected_at TIMESTAMP NOT NULL
+    )
+    """,
+    *(
+        f"""
+        CREATE TABLE {table} (
+            device_id TEXT, {key_definitions},
+            power_consumption REAL, reactive_energy_consumed REAL, tariff1_energy REAL, tariff2_energy REAL,
+            avg_phase1_voltage REAL, avg_phase2_voltage REAL, avg_phase3_voltage REAL,
+            avg_phase1_current REAL, avg_phase2_current REAL, avg_phase3_current REAL,
+            interval_count INTEGER, quality_flag INTEGER, PRIMARY KEY ({", ".join(key_columns)})
+        )
+        """
+        for table, key_definitions, key_columns in [
+            ("device_consumption_hourly", "day DATE, hour INTEGER", ["device_id", "day", "hour"]),
+            ("device_consumption_daily", "day DATE", ["device_id", "day"]),
+            ("device_consumption_monthly", "month DATE", ["device_id", "month"]),
+        ]
+    ),
+    """
+    CREATE TABLE process_metadata (
+        process_name TEXT PRIMARY KEY, last_fetched_timestamp TIMESTAMP, last_fetched_id INTEGER
+    )
+    """,
+]
+
+
+def parse_size(value):
+    value = value.lower()
+    if value[-1] in size_suffixes:
+        return int(float(value[:-1]) * size_suffixes[value[-1]])
+    return int(value)
+
+
+def size_label(size):
+    for suffix, factor in sorted(size_suffixes.items(), key=lambda item: -item[1]):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{suffix}"
+    return str(size)
+
+
+# Function to build a SQLite backend whose rows also support attribute access, like pyodbc rows
+def sqlite_row_backend(path):
+    backend = db_pool.sqlite_backend(path)
+    return db_pool.Backend(functools.partial(_connect_attribute_rows, backend.connect), backend.dialect)
+
+
+def _connect_attribute_rows(connect):
+    conn = connect()
+    conn.row_factory = _attribute_row
+    return conn
+
+
+def _attribute_row(cursor, row):
+    return _row_type(tuple(column[0] for column in cursor.description))(*row)
+
+
+@functools.lru_cache(maxsize=None)
+def _row_type(fields):
+    return namedtuple("Row", fields, rename=True)
+
+
+# Function to point the "source" and "target" pools at fresh SQLite databases in db_dir
+def register_standins(db_dir):
+    for name, tables, backend in (
+        ("source", SOURCE_TABLES, db_pool.sqlite_backend(os.path.join(db_dir, "source.db"))),
+        ("target", TARGET_TABLES, sqlite_row_backend(os.path.join(db_dir, "target.db"))),
+    ):
+        pool = db_pool.register_pool(name, backend, replace=True)
+        with pool.connection() as conn:
+            for statement in tables:
+                conn.execute(statement)
+            conn.commit()
+
+
+def load_source(rows):
+    with db_pool.connection("source") as conn:
+        for chunk in chunked(rows, chunk_rows):
+            conn.executemany(
+                "INSERT INTO mqtt_raw_data (id, device_id, timestamp, processed, data) VALUES (?, ?, ?, ?, ?)",
+                [(row["id"], row["device_id"], row["timestamp"], row["processed"], row["data"]) for row in chunk],
+            )
+        conn.commit()
+
+
+def result(rows, seconds):
+    return {"rows": rows, "seconds": round(seconds, 6), "rows_per_second": round(rows / seconds, 1) if seconds else None}
+
+
+def bench_parse_data(size, seed, devices):
+    seconds = 0.0
+    for chunk in chunked(generate_rows(size, devices, seed), chunk_rows):
+        telegrams = [row["data"] for row in chunk]
+        started = time.perf_counter()
+        for data in telegrams:
+            parse_data(data)
+        seconds += time.perf_counter() - started
+    return result(size, seconds)
+
+
+def bench_parse_column(size, seed, devices):
+    seconds = 0.0
+    for chunk in chunked(generate_rows(size, devices, seed), chunk_rows):
+        telegrams = pd.Series([row["data"] for row in chunk])
+        started = time.perf_counter()
+        parse_column(telegrams)
+        seconds += time.perf_counter() - started
+    return result(size, seconds)
+
+
+# The batch_process loop without its polling and threads: fetch a page, parse it, upsert it
+def bench_batch_ingest(size, seed, devices):
+    load_source(generate_rows(size, devices, seed))
+    position = (datetime.min, -1)
+    processed = 0
+    started = time.perf_counter()
+    while True:
+        rows = batch_process.fetch_rows(*position, batch_process.max_batch_size)
+        if not rows:
+            break
+        if not batch_process.insert_parsed_data(batch_process.parse_batch(rows)):
+            raise RuntimeError("Benchmark batch was not committed")
+        position = (rows[-1]["timestamp"], rows[-1]["id"])
+        processed += len(rows)
+    return result(processed, time.perf_counter() - started)
+
+
+# Interval metrics and their upsert. The rollup update is timed on its own by bench_rollups, so the
+# batches it would have been given are kept for it here instead.
+def bench_metrics(size, seed, devices):
+    seconds = 0.0
+    _rollup_batches.clear()
+    update_rollups = metrics_calculator.update_rollups
+    metrics_calculator.update_rollups = lambda conn, metrics, dialect: _rollup_batches.append(metrics)
+    try:
+        for chunk in chunked(generate_rows(size, devices, seed), chunk_rows):
+            # Shaped like metrics_calculator.fetch_data output
+            data = pd.DataFrame(batch_process.parse_batch(chunk))
+            started = time.perf_counter()
+            metrics_calculator.calculate_and_insert_metrics(data)
+            seconds += time.perf_counter() - started
+    finally:
+        metrics_calculator.update_rollups = update_rollups
+    return result(size, seconds)
+
+
+_rollup_batches = []
+
+
+# rollups.update_rollups over the batches bench_metrics wrote, in the same order and with the same connection use
+def bench_rollups(size, seed, devices):
+    started = time.perf_counter()
+    with db_pool.connection("target") as conn:
+        dialect = db_pool.get_pool("target").dialect
+        for metrics in _rollup_batches:
+            rollups.update_rollups(conn, metrics, dialect)
+    return result(sum(len(metrics) for metrics in _rollup_batches), time.perf_counter() - started)
+
+
+# api.py /data: parsing and serializing pages of raw rows
+def bench_api_raw(size, seed, devices):
+    from fastapi.encoders import jsonable_encoder
+    import api
+
+    seconds = 0.0
+    for chunk in chunked(generate_rows(size, devices, seed), api_page_rows):
+        df = pd.DataFrame(chunk)
+        started = time.perf_counter()
+        json.dumps(jsonable_encoder(api.build_records(df)))
+        seconds += time.perf_counter() - started
+    return result(size, seconds)
+
+
+# apiagg.py /data: reading the metrics written by bench_metrics and serializing them through the response model
+def bench_api_metrics(size, seed, devices):
+    from fastapi.routing import serialize_response
+    import apiagg
+
+    field = next(route.response_field for route in apiagg.app.routes if getattr(route, "path", None) == "/data")
+    started = time.perf_counter()
+    data = apiagg.fetch_data_from_db()
+    json.dumps(asyncio.run(serialize_response(field=field, response_content=data)))
+    return result(len(data), time.perf_counter() - started)
+
+
+# Run order matters: bench_rollups and bench_api_metrics read what bench_metrics wrote
+BENCHMARKS = [
+    ("parse_data", bench_parse_data),
+    ("parse_column", bench_parse_column),
+    ("batch_ingest", bench_batch_ingest),
+    ("metrics", bench_metrics),
+    ("rollups", bench_rollups),
+    ("api_raw_serialize", bench_api_raw),
+    ("api_metrics_serialize", bench_api_metrics),
+]
+
+
+# Function to run the benchmarks for one size; each is repeated on fresh databases and the fastest run kept
+def run_size(size, seed, devices, selected, repeat):
+    results = {}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as db_dir:
+            register_standins(db_dir)
+            for name, benchmark in BENCHMARKS:
+                if selected and name not in selected:
+                    continue
+                try:
+                    run = benchmark(size, seed, devices)
+                except ImportError as e:
+                    logging.error(f"Skipping {name}: {e}")
+                    continue
+                if name not in results or run["seconds"] < results[name]["seconds"]:
+                    results[name] = run
+            for name in ("source", "target"):
+                db_pool.get_pool(name).close_all()
+
+    for name, run in results.items():
+        print(f"{size_label(size):>5} {name:<24} {run['seconds']:>10.3f} s {run['rows_per_second'] or 0:>14,.0f} rows/s")
+    return results
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sqlite": sqlite3.sqlite_version,
+    }
+
+
+# Function to print the change against a baseline; returns the benchmarks that regressed
+def compare(results, baseline, max_regression):
+    regressions = []
+    for label, benchmarks in results.items():
+        for name, current in benchmarks.items():
+            previous = baseline["results"].get(label, {}).get(name)
+            if not previous or not previous["seconds"]:
+                continue
+            ratio = current["seconds"] / previous["seconds"]
+            flag = ""
+            if ratio > 1 + max_regression:
+                flag = "  REGRESSION"
+                regressions.append((label, name, ratio))
+            print(f"{label:>5} {name:<24} {previous['seconds']:>10.3f} s -> {current['seconds']:>10.3f} s ({ratio - 1:+.1%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the parsing, ingest, metrics and API hot paths.")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[10000], help="Row counts, e.g. 10k 1m 10m")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the fastest is reported")
+    parser.add_argument("--only", nargs="+", choices=[name for name, _ in BENCHMARKS], help="Run only these benchmarks")
+    parser.add_argument("--save", metavar="NAME", help="Write the results to benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="Compare with benchmarks/baselines/NAME.json")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    # Keep per-batch progress logs out of the timings
+    logging.getLogger().setLevel(logging.ERROR)
+
+    results = {size_label(size): run_size(size, args.seed, args.devices, args.only, args.repeat) for size in args.sizes}
+
+    regressions = []
+    if args.compare:
+        with open(baselines_dir / f"{args.compare}.json") as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+
+    if args.save:
+        baselines_dir.mkdir(exist_ok=True)
+        with open(baselines_dir / f"{args.save}.json", "w") as f:
+            json.dump({
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "seed": args.seed,
+                "devices": args.devices,
+                "environment": environment(),
+                "results": results,
+            }, f, indent=2)
+            f.write("\n")
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import random
+from datetime import datetime, timedelta
+
+# Seeded generator for realistic DSMR P1 telegrams, shaped like rows of the source mqtt_raw_data table.
+# The same seed always yields the same rows. Telegrams cover the situations the parser and the metrics
+# have to cope with: many devices reporting at once, fields missing from a telegram, cumulative
+# registers rolling over at the meter maximum and lines corrupted in transit.
+
+# Cumulative registers wrap to zero at this value (the METER_MAX_VALUE default of interval_aggregator)
+meter_max = 10000
+
+# Per-telegram rates of the irregularities
+missing_field_rate = 0.005  # Each value line is dropped with this probability
+malformed_line_rate = 0.002  # Each value line is corrupted with this probability
+rollover_device_rate = 0.1  # Share of devices whose registers start just below meter_max and wrap within minutes
+
+default_start = datetime(2025, 1, 1)
+
+
+class _Meter:
+    def __init__(self, device_id, rng):
+        self.device_id = device_id
+        near_max = rng.random() < rollover_device_rate
+        self.tariff1 = rng.uniform(meter_max - 0.2, meter_max) if near_max else rng.uniform(0, 5000)
+        self.tariff2 = rng.uniform(meter_max - 0.2, meter_max) if near_max else rng.uniform(0, 2000)
+        self.total = rng.uniform(meter_max - 0.2, meter_max) if near_max else self.tariff1 + self.tariff2
+        self.reactive = rng.uniform(meter_max - 0.05, meter_max) if near_max else rng.uniform(0, 800)
+        self.returned = rng.uniform(0, 50)
+        self.base_load = rng.uniform(0.1, 1.5)  # kW
+        self.serial = "".join(f"{ord(c):02X}" for c in f"E{rng.randrange(10**15):015d}")
+
+    # Function to advance the registers by one reading interval and return the instantaneous values
+    def step(self, rng, seconds, hour):
+        # Daily shape: higher load in the morning and evening peaks
+        peak = 1.8 if hour in (7, 8, 18, 19, 20, 21) else 1.0
+        power = max(0.0, rng.gauss(self.base_load * peak, 0.15))
+        energy = power * seconds / 3600
+        self.total = (self.total + energy) % meter_max
+        if 7 <= hour < 23:
+            self.tariff2 = (self.tariff2 + energy) % meter_max
+        else:
+            self.tariff1 = (self.tariff1 + energy) % meter_max
+        self.reactive = (self.reactive + energy * rng.uniform(0.05, 0.2)) % meter_max
+
+        phase_power = [power * share for share in _split(rng)]
+        voltages = [rng.gauss(230.0, 1.5) for _ in range(3)]
+        currents = [p * 1000 / v for p, v in zip(phase_power, voltages)]
+        return power, phase_power, voltages, currents
+
+
+def _split(rng):
+    weights = [rng.random() + 0.2 for _ in range(3)]
+    total = sum(weights)
+    return [w / total for w in weights]
+
+
+# Function to render one telegram; value lines are dropped or corrupted at the configured rates
+def render_telegram(meter, rng, timestamp, power, phase_power, voltages, currents):
+    value_lines = [
+        f"1-0:1.8.1({meter.tariff1:010.3f}*kWh)",
+        f"1-0:1.8.2({meter.tariff2:010.3f}*kWh)",
+        "1-0:2.8.1(000000.000*kWh)",
+        "1-0:2.8.2(000000.000*kWh)",
+        f"0-0:96.14.0(000{1 if timestamp.hour < 7 or timestamp.hour >= 23 else 2})",
+        f"1-0:1.8.0({meter.total:010.3f}*kWh)",
+        f"1-0:2.8.0({meter.returned:010.3f}*kWh)",
+        f"1-0:3.8.0({meter.reactive:010.3f}*kVArh)",
+        f"1-0:1.7.0({power:06.3f}*kW)",
+        "1-0:2.7.0(00.000*kW)",
+        *(f"1-0:{code}.7.0({voltage:05.1f}*V)" for code, voltage in zip((32, 52, 72), voltages)),
+        *(f"1-0:{code}.7.0({current:06.2f}*A)" for code, current in zip((31, 51, 71), currents)),
+        *(f"1-0:{code}.7.0({p:06.3f}*kW)" for code, p in zip((21, 41, 61), phase_power)),
+    ]
+
+    lines = [
+        "/ISK5\\2M550T-1012",
+        "",
+        "1-3:0.2.8(50)",
+        f"0-0:1.0.0({timestamp:%y%m%d%H%M%S}W)",
+        f"0-0:96.1.1({meter.serial})",
+    ]
+    for line in value_lines:
+        roll = rng.random()
+        if roll < missing_field_rate:
+            continue
+        if roll < missing_field_rate + malformed_line_rate:
+            line = _corrupt(line, rng)
+        lines.append(line)
+    lines.append(f"!{rng.randrange(0x10000):04X}")
+    return "\r\n".join(lines)
+
+
+def _corrupt(line, rng):
+    kind = rng.randrange(3)
+    if kind == 0:
+        return line[:rng.randrange(1, len(line))]  # Truncated in transit
+    if kind == 1:
+        return line.replace(".", ",", 1)  # Wrong decimal separator
+    return line.replace("*", "", 1)  # Missing unit separator
+
+
+# Function to generate source rows {id, device_id, timestamp, processed, data} in (timestamp, id) order.
+# Devices report every interval_seconds at their own offset, interleaved like a real ingest stream.
+def generate_rows(count, devices=50, seed=0, start=default_start, interval_seconds=10):
+    rng = random.Random(seed)
+    meters = [_Meter(f"device-{i:04d}", rng) for i in range(devices)]
+    offsets = sorted((rng.uniform(0, interval_seconds), i) for i in range(devices))
+
+    row_id = 1
+    tick = 0
+    while row_id <= count:
+        tick_start = start + timedelta(seconds=tick * interval_seconds)
+        for offset, i in offsets:
+            if row_id > count:
+                return
+            meter = meters[i]
+            timestamp = tick_start + timedelta(seconds=offset)
+            readings = meter.step(rng, interval_seconds, timestamp.hour)
+            yield {
+                "id": row_id,
+                "device_id": meter.device_id,
+                "timestamp": timestamp,
+                "processed": 0,
+                "data": render_telegram(meter, rng, timestamp, *readings),
+            }
+            row_id += 1
+        tick += 1
+
+
+# Function to group a row stream into lists of at most size rows
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,89 @@
+import logging
+import sqlite3
+
+# Set-based upserts through a per-connection staging table:
+#   1. bulk load the rows into a temporary table (fast_executemany on SQL Server),
+#   2. MERGE them into the target table on the key columns in one statement.
+# Re-running the same rows is safe: existing keys are updated, new keys inserted.
+# If a chunk fails on bad data, it is split in halves until the offending rows are
+# isolated; those are returned as rejects and the rest of the batch is still written.
+
+# Errors caused by the row contents (as opposed to the connection or the SQL itself)
+_ROW_ERRORS = (sqlite3.DataError, sqlite3.IntegrityError)
+try:
+    import pyodbc
+    _ROW_ERRORS += (pyodbc.DataError, pyodbc.IntegrityError)
+except ImportError:
+    pass
+
+
+# Function to upsert rows (sequences ordered like columns) keyed on key_columns.
+# Returns (number of rows written, [(row, error), ...] for rows that were rejected).
+def merge_rows(conn, table, columns, key_columns, rows, dialect="mssql"):
+    # The same key twice in one MERGE is an error, so the last occurrence wins
+    key_positions = [columns.index(column) for column in key_columns]
+    rows = list({tuple(row[i] for i in key_positions): row for row in rows}.values())
+
+    rejected = []
+    written = _merge_isolating(conn, table, columns, key_columns, rows, dialect, rejected)
+    for row, error in rejected:
+        key = {column: row[i] for column, i in zip(key_columns, key_positions)}
+        logging.error(f"Rejected row {key} for {table}: {error}")
+    return written, rejected
+
+
+def _merge_isolating(conn, table, columns, key_columns, rows, dialect, rejected):
+    if not rows:
+        return 0
+    try:
+        _merge_chunk(conn, table, columns, key_columns, rows, dialect)
+        conn.commit()
+        return len(rows)
+    except _ROW_ERRORS as e:
+        conn.rollback()
+        if len(rows) == 1:
+            rejected.append((rows[0], e))
+            return 0
+        middle = len(rows) // 2
+        return (
+            _merge_isolating(conn, table, columns, key_columns, rows[:middle], dialect, rejected)
+            + _merge_isolating(conn, table, columns, key_columns, rows[middle:], dialect, rejected)
+        )
+
+
+def _merge_chunk(conn, table, columns, key_columns, rows, dialect):
+    cursor = conn.cursor()
+    column_list = ", ".join(columns)
+    placeholders = ", ".join("?" for _ in columns)
+    update_columns = [column for column in columns if column not in key_columns]
+
+    if dialect == "sqlite":
+        staging = f"staging_{table}"
+        cursor.execute(f"DROP TABLE IF EXISTS temp.{staging}")
+        cursor.execute(f"CREATE TEMP TABLE {staging} AS SELECT {column_list} FROM {table} WHERE 0")
+        cursor.executemany(f"INSERT INTO {staging} ({column_list}) VALUES ({placeholders})", rows)
+        cursor.execute(f"""
+            INSERT INTO {table} ({column_list})
+            SELECT {column_list} FROM {staging} WHERE true
+            ON CONFLICT ({", ".join(key_columns)}) DO UPDATE SET
+                {", ".join(f"{column} = excluded.{column}" for column in update_columns)}
+        """)
+        cursor.execute(f"DROP TABLE temp.{staging}")
+    else:
+        staging = f"#staging_{table}"
+        cursor.execute(f"IF OBJECT_ID('tempdb..{staging}') IS NOT NULL DROP TABLE {staging}")
+        # TOP 0 ... INTO copies the column types of the target table
+        cursor.execute(f"SELECT TOP 0 {column_list} INTO {staging} FROM {table}")
+        cursor.fast_executemany = True
+        cursor.executemany(f"INSERT INTO {staging} ({column_list}) VALUES ({placeholders})", rows)
+        cursor.execute(f"""
+            MERGE {table} WITH (HOLDLOCK) AS t
+            USING {staging} AS s
+                ON {" AND ".join(f"t.{column} = s.{column}" for column in key_columns)}
+            WHEN MATCHED THEN UPDATE SET
+                {", ".join(f"t.{column} = s.{column}" for column in update_columns)}
+            WHEN NOT MATCHED BY TARGET THEN
+                INSERT ({column_list}) VALUES ({", ".join(f"s.{column}" for column in columns)});
+        """)
+        cursor.execute(f"DROP TABLE {staging}")
+    cursor.close()
@@ -0,0 +1,235 @@
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Shared connection pools, one per database target ("source", "target", ...).
+# Every entry point registers its targets at import time and then borrows connections with
+#
+#     with db_pool.connection("target") as conn:
+#         ...
+#
+# Connections are rolled back when they are returned, so uncommitted work is discarded
+# exactly as it was when each function opened and closed its own connection.
+
+# A backend knows how to open a connection and which SQL dialect it speaks
+Backend = namedtuple("Backend", ["connect", "dialect"])
+
+# Pool defaults, overridable per target when registering
+default_max_size = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+default_idle_timeout = int(os.getenv("DB_POOL_IDLE_TIMEOUT", "300"))  # Seconds before an idle connection is closed
+default_check_after = int(os.getenv("DB_POOL_CHECK_AFTER", "30"))  # Idle seconds before a liveness check on checkout
+default_acquire_timeout = int(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "30"))
+
+
+# Function to build a backend for SQL Server through pyodbc
+def pyodbc_backend(connection_string):
+    return Backend(functools.partial(_connect_pyodbc, connection_string), "mssql")
+
+
+def _connect_pyodbc(connection_string):
+    import pyodbc
+    return pyodbc.connect(connection_string)
+
+
+# Function to build a backend for a local SQLite stand-in (":memory:" is shared by all pooled connections
+# of this process). Backends are picklable, so worker processes can register the same pools.
+def sqlite_backend(path=":memory:"):
+    if path == ":memory:":
+        path = f"file:pool-{uuid.uuid4().hex}?mode=memory&cache=shared"
+        # A shared in-memory database only lives while a connection is open, so idle eviction must not drop it
+        _memory_keepers[path] = sqlite3.connect(path, uri=True, check_same_thread=False)
+    return Backend(functools.partial(_connect_sqlite, path), "sqlite")
+
+
+_memory_keepers = {}
+
+
+def _connect_sqlite(path):
+    return sqlite3.connect(
+        path,
+        uri=path.startswith("file:"),
+        check_same_thread=False,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+    )
+
+
+class ConnectionPool:
+    def __init__(self, name, backend, max_size=None, idle_timeout=None, check_after=None, acquire_timeout=None):
+        self.name = name
+        self.backend = backend
+        self.dialect = backend.dialect
+        self.max_size = max_size or default_max_size
+        self.idle_timeout = idle_timeout if idle_timeout is not None else default_idle_timeout
+        self.check_after = check_after if check_after is not None else default_check_after
+        self.acquire_timeout = acquire_timeout if acquire_timeout is not None else default_acquire_timeout
+
+        self._idle = []  # (connection, returned_at), most recently returned last
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._stats = {"created": 0, "reused": 0, "discarded": 0, "evicted": 0, "failed_checks": 0, "waits": 0}
+
+    # Function to borrow a connection, waiting while the pool is at max size
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._condition:
+            self._evict_idle()
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No connection available in pool '{self.name}' after {self.acquire_timeout}s")
+                self._stats["waits"] += 1
+                self._condition.wait(remaining)
+
+            conn, returned_at = self._idle.pop() if self._idle else (None, None)
+            self._in_use += 1
+
+        try:
+            if conn is not None and time.monotonic() - returned_at > self.check_after and not self._is_alive(conn):
+                self._count("failed_checks")
+                self._close(conn)
+                conn = None
+
+            if conn is None:
+                conn = self.backend.connect()
+                self._count("created")
+            else:
+                self._count("reused")
+            return conn
+        except Exception:
+            self._forget()
+            raise
+
+    # Function to return a borrowed connection; broken connections are closed instead of reused
+    def release(self, conn):
+        try:
+            conn.rollback()
+        except Exception as e:
+            logging.warning(f"Discarding connection from pool '{self.name}': {e}")
+            self._count("discarded")
+            self._close(conn)
+            self._forget()
+            return
+
+        with self._condition:
+            self._in_use -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    # Function to close every idle connection (borrowed ones are still returned to this pool)
+    def close_all(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def metrics(self):
+        with self._condition:
+            return {
+                **self._stats,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "max_size": self.max_size,
+            }
+
+    # Function to close idle connections unused for longer than idle_timeout (caller holds the lock)
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = [conn for conn, returned_at in self._idle if returned_at < cutoff]
+        if expired:
+            self._idle = [(conn, returned_at) for conn, returned_at in self._idle if returned_at >= cutoff]
+            self._stats["evicted"] += len(expired)
+            for conn in expired:
+                self._close(conn)
+
+    def _is_alive(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _forget(self):
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify()
+
+    def _count(self, stat):
+        with self._condition:
+            self._stats[stat] += 1
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# Function to register a pool for a target; an existing pool is kept unless replace=True
+def register_pool(name, backend, replace=False, **options):
+    with _pools_lock:
+        existing = _pools.get(name)
+        if existing is not None and not replace:
+            return existing
+        _pools[name] = ConnectionPool(name, backend, **options)
+    if existing is not None:
+        existing.close_all()
+    return _pools[name]
+
+
+def get_pool(name):
+    try:
+        return _pools[name]
+    except KeyError:
+        raise KeyError(f"No connection pool registered for '{name}'") from None
+
+
+# Function to borrow a connection from a registered pool
+def connection(name):
+    return get_pool(name).connection()
+
+
+# Function to collect the metrics of every registered pool
+def pool_metrics():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {name: pool.metrics() for name, pool in pools.items()}
+
+
+# Function to describe the registered pools as {name: (backend, options)}, to register them in a worker process
+def pool_settings():
+    with _pools_lock:
+        return {
+            name: (pool.backend, {
+                "max_size": pool.max_size, "idle_timeout": pool.idle_timeout,
+                "check_after": pool.check_after, "acquire_timeout": pool.acquire_timeout,
+            })
+            for name, pool in _pools.items()
+        }
+
+
+# Function to register the pools of a parent process (from pool_settings) in a newly started worker.
+# Workers open connections of their own; they start from a fresh interpreter, so none are inherited.
+def register_pools(settings):
+    for name, (backend, options) in settings.items():
+        register_pool(name, backend, replace=True, **options)
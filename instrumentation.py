@@ -0,0 +1,167 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import db_pool
+
+# Counters, gauges and histograms for the worker hot paths, served in the Prometheus text format:
+#
+#     INSTRUMENTATION_PORT=9101 python batch_process.py
+#     curl localhost:9101/metrics
+#
+# Without INSTRUMENTATION_PORT every call returns immediately, so the hooks can stay in the hot paths.
+
+port = os.getenv("INSTRUMENTATION_PORT")
+enabled = port is not None
+
+# Histogram buckets in seconds, from a fast query to a slow batch
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}  # name -> [bucket counts, sum, count]
+_server = None
+_null_timer = nullcontext()
+
+
+# Function to add to a counter
+def inc(name, value=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+# Function to set a gauge to the current value
+def set_gauge(name, value):
+    if not enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+# Function to record one observation in a histogram
+def observe(name, value):
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [[0] * (len(default_buckets) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(default_buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+# Function to take and reset everything recorded in this process, e.g. in a worker process whose
+# registry is never served: {"counters": ..., "gauges": ..., "histograms": ...}, for merge in the parent
+def drain():
+    with _lock:
+        snapshot = {"counters": dict(_counters), "gauges": dict(_gauges), "histograms": {name: (list(buckets), total, count) for name, (buckets, total, count) in _histograms.items()}}
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+    return snapshot
+
+
+# Function to add a drained snapshot to this process's metrics
+def merge(snapshot):
+    if not enabled:
+        return
+    with _lock:
+        for name, value in snapshot["counters"].items():
+            _counters[name] = _counters.get(name, 0) + value
+        _gauges.update(snapshot["gauges"])
+        for name, (buckets, total, count) in snapshot["histograms"].items():
+            histogram = _histograms.get(name)
+            if histogram is None:
+                histogram = _histograms[name] = [[0] * (len(default_buckets) + 1), 0.0, 0]
+            histogram[0] = [mine + theirs for mine, theirs in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+# Function to time a block into a histogram: with instrumentation.timer("batch_parse_seconds"): ...
+def timer(name):
+    return _Timer(name) if enabled else _null_timer
+
+
+# Function to measure how far a timestamp is behind now (naive timestamps are UTC, as stored)
+def seconds_since(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return time.time() - timestamp.timestamp()
+
+
+# Function to render every metric, plus the connection pool stats, in the Prometheus text format
+def render():
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {name: (list(buckets), total, count) for name, (buckets, total, count) in _histograms.items()}
+
+    for name, value in sorted(counters.items()):
+        lines += [f"# TYPE {name} counter", f"{name} {value}"]
+    for name, value in sorted(gauges.items()):
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    for name, (buckets, total, count) in sorted(histograms.items()):
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip([*default_buckets, "+Inf"], buckets):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f"{name}_sum {total}", f"{name}_count {count}"]
+
+    # Pool stats as one gauge family per stat, labelled by pool
+    pools = db_pool.pool_metrics()
+    for stat in sorted({stat for stats in pools.values() for stat in stats}):
+        lines.append(f"# TYPE db_pool_{stat} gauge")
+        lines += [f'db_pool_{stat}{{pool="{pool_name}"}} {stats[stat]}' for pool_name, stats in sorted(pools.items())]
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are frequent; keep them out of the worker logs
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to serve /metrics on localhost in a background thread (no-op when disabled)
+def start_server():
+    global _server
+    if not enabled or _server is not None:
+        return
+    _server = ThreadingHTTPServer(("127.0.0.1", int(port)), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="instrumentation", daemon=True).start()
+    logging.info(f"Serving instrumentation on http://127.0.0.1:{port}/metrics")
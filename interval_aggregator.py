@@ -0,0 +1,311 @@
+import logging
+import os
+from datetime import timedelta
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+# Running 10-minute interval metrics per device, kept across metrics_calculator runs.
+# An interval's energy is measured from the device's last register reading before the interval
+# (its own first reading only when nothing earlier is known), so consecutive intervals add up
+# to the meter's total instead of losing the energy between two intervals.
+# An interval closes when the device has reported in a later interval, or when the newest reading
+# seen is more than close_grace past the interval end. Until then it is emitted as a provisional row
+# after every batch that adds to it, and the final row replaces it on upsert. Rows at or before a
+# device's last processed reading are ignored, so re-fetched rows are never counted twice.
+#
+# A register that went down between the baseline and the interval's last reading either wrapped at
+# the device's register maximum (the corrected delta is plausible for the time that passed), restarted
+# from zero (reset) or belongs to a different meter (replaced). Rises larger than max_power_kw could
+# draw over that time are also taken as a replaced meter. Reset and replaced deltas are left NULL and
+# the interval carries quality_flag bits, so no sum downstream picks up a rollover-sized artifact.
+#
+# A register's maximum is the value it wraps back to zero at (a four-digit register reads up to 9999.999
+# and wraps at 10000). Readings above a device's maximum widen it to the next power of ten, but only
+# once widen_samples readings in a row have stayed above it, so one corrupted reading cannot turn later
+# rollovers into meter replacements. The interval the register was widened in is flagged.
+
+interval_length = timedelta(minutes=10)
+close_grace = timedelta(seconds=int(os.getenv("METRICS_CLOSE_GRACE", "600")))  # Wait for late devices before closing on time
+max_meter_value = float(os.getenv("METER_MAX_VALUE", "10000"))  # Registers wrap to zero at this value unless the registry says otherwise
+widen_samples = int(os.getenv("METER_WIDEN_SAMPLES", "3"))  # Consecutive readings above the maximum before it is widened
+max_power_kw = float(os.getenv("METER_MAX_POWER_KW", "50"))  # Highest plausible draw of a connection
+register_resolution = 0.001  # kWh; registers report three decimals
+
+# quality_flag bits of a metrics row (0: every delta is a plain difference)
+QUALITY_ROLLOVER = 1  # A register wrapped at its maximum; the delta is corrected
+QUALITY_RESET = 2  # A register restarted from zero; its delta is NULL
+QUALITY_REPLACED = 4  # A register jumped implausibly (meter swap or bad reading); its delta is NULL
+QUALITY_WIDENED = 8  # The device's register maximum was widened to the next power of ten
+
+# (metric column, register column): energy used over the interval
+DELTA_COLUMNS = [
+    ("power_consumption", "total_energy_consumed"),
+    ("reactive_energy_consumed", "reactive_energy_consumed"),
+    ("tariff1_energy", "tariff1_energy"),
+    ("tariff2_energy", "tariff2_energy"),
+]
+
+# (metric column, reading column): interval means of instantaneous readings
+AVERAGE_COLUMNS = [
+    ("avg_phase1_voltage", "phase1_voltage"),
+    ("avg_phase2_voltage", "phase2_voltage"),
+    ("avg_phase3_voltage", "phase3_voltage"),
+    ("avg_phase1_current", "phase1_current"),
+    ("avg_phase2_current", "phase2_current"),
+    ("avg_phase3_current", "phase3_current"),
+]
+
+REGISTERS = [register for _, register in DELTA_COLUMNS]
+READINGS = [reading for _, reading in AVERAGE_COLUMNS]
+
+# Columns of a device_consumption_metrics row, in table order
+METRIC_COLUMNS = ["device_id", "day", "hour", "interval_start", *(metric for metric, _ in DELTA_COLUMNS), *(metric for metric, _ in AVERAGE_COLUMNS), "quality_flag"]
+
+
+# Function to load parsed rows into typed columns (missing values become NaN)
+def load_frame(rows):
+    if isinstance(rows, pd.DataFrame):
+        frame = rows[["device_id", "timestamp", *REGISTERS, *READINGS]].astype({column: np.float64 for column in REGISTERS + READINGS})
+        frame["timestamp"] = pd.to_datetime(frame["timestamp"])
+        return frame
+    # One pass over the row dicts; NumPy turns None into NaN for float arrays
+    values = np.array(list(map(itemgetter(*REGISTERS, *READINGS), rows)), dtype=np.float64).reshape(len(rows), -1)
+    frame = pd.DataFrame(values, columns=REGISTERS + READINGS)
+    frame.insert(0, "device_id", [row["device_id"] for row in rows])
+    frame.insert(1, "timestamp", pd.to_datetime([row["timestamp"] for row in rows]))
+    return frame
+
+
+def _present(values):
+    return {name: (None if value != value else value) for name, value in zip(REGISTERS, values)}  # NaN != NaN
+
+
+# Function to summarize a batch per (device, interval): first and last non-null register values,
+# sums and counts of the readings, and the first and last timestamps. Rows must be in timestamp order.
+def partial_aggregates(frame):
+    grouped = frame.groupby([frame["device_id"], frame["timestamp"].dt.floor(interval_length).rename("start")], sort=False)
+    first = grouped[REGISTERS].first().to_numpy().tolist()  # first() and last() skip NaN per column
+    last = grouped[REGISTERS].last().to_numpy().tolist()
+    sums = grouped[READINGS].sum().to_numpy().tolist()
+    counts = grouped[READINGS].count().to_numpy().tolist()
+    summary = grouped["timestamp"].agg(["size", "min", "max"])
+
+    partials = {}
+    for i, ((device_id, start), rows, first_timestamp, last_timestamp) in enumerate(zip(summary.index, summary["size"], summary["min"], summary["max"])):
+        partials[(device_id, start.to_pydatetime())] = {
+            "first": _present(first[i]),
+            "last": _present(last[i]),
+            "sums": dict(zip(READINGS, sums[i])),
+            "counts": dict(zip(READINGS, counts[i])),
+            "rows": int(rows),
+            "first_timestamp": first_timestamp.to_pydatetime(),
+            "last_timestamp": last_timestamp.to_pydatetime(),
+        }
+    return partials
+
+
+class IntervalAggregator:
+    def __init__(self):
+        self.registers = {}  # device_id -> {register: last non-null value}
+        self.last_seen = {}  # device_id -> timestamp of the last processed reading
+        self.open = {}  # device_id -> (interval start, interval state)
+        self.max_values = {}  # device_id -> register rollover value, where it is not max_meter_value
+        self.widened = {}  # device_id -> rollover value learned from the readings, not yet saved
+        self.above_max = {}  # device_id -> (consecutive readings above its maximum, highest of them)
+        self.widened_at = {}  # device_id -> timestamp of the reading its register was widened at, until flagged
+        self.read_position = None  # Newest timestamp processed
+        self.skipped = 0
+
+    # Function to set a device's register readings from before the first batch (cold start)
+    def seed(self, device_id, timestamp, registers):
+        self.registers[device_id] = {register: value for register, value in registers.items() if value is not None}
+        self.last_seen[device_id] = timestamp
+        if self.registers[device_id]:
+            reading = max(self.registers[device_id].values())
+            self._count_above_max(device_id, [reading > self.max_value(device_id)], [reading], [timestamp])
+
+    # Function to look up the value a device's registers roll over at
+    def max_value(self, device_id):
+        return self.max_values.get(device_id, max_meter_value)
+
+    # Function to fold a batch of parsed rows (dicts or a DataFrame, in timestamp order) into the
+    # running state. Returns the metrics of the intervals that closed, then (unless provisional=False)
+    # provisional metrics of the open intervals this batch added to. When the rows are one device shard
+    # of a fleet, read_position is the fleet's newest timestamp, so quiet devices still close on time.
+    def process(self, rows, provisional=True, read_position=None):
+        closed = []
+        partials = {}
+        if len(rows):
+            frame = load_frame(rows)
+
+            # Drop rows at or before each device's last processed reading
+            last_seen = pd.to_datetime(frame["device_id"].map(self.last_seen))
+            new_rows = frame[last_seen.isna() | (frame["timestamp"] > last_seen)]
+            self.skipped += len(frame) - len(new_rows)
+            if not new_rows.empty:
+                # Readings that stay above the assumed maximum mean the register is wider than assumed.
+                # Only the rows of devices above it now (or in a streak from earlier batches) are walked.
+                peaks = np.fmax.reduce(new_rows[REGISTERS].to_numpy(), axis=1)  # Skips NaN
+                limits = new_rows["device_id"].map(self.max_values).fillna(max_meter_value).to_numpy()
+                above = peaks > limits
+                if above.any() or self.above_max:
+                    devices = new_rows["device_id"].to_numpy()
+                    tracked = np.isin(devices, [*set(devices[above]), *self.above_max])
+                    streaks = pd.DataFrame(
+                        {"above": above[tracked], "peak": peaks[tracked], "timestamp": new_rows["timestamp"].to_numpy()[tracked]},
+                        index=devices[tracked],
+                    )
+                    for device_id, rows in streaks.groupby(level=0, sort=False):
+                        self._count_above_max(device_id, rows["above"].to_numpy(), rows["peak"].to_numpy(), list(rows["timestamp"]))
+                partials = partial_aggregates(new_rows)
+
+        for (device_id, start), partial in sorted(partials.items(), key=lambda item: item[0][1]):
+            closed += self._fold(device_id, start, partial)
+            self._advance(partial["last_timestamp"])
+        if read_position is not None:
+            self._advance(read_position)
+        if not partials and read_position is None:
+            return []
+
+        # Devices that went quiet: close their interval once the rest of the fleet is well past it
+        for device_id, (start, _) in list(self.open.items()):
+            if start + interval_length + close_grace <= self.read_position:
+                closed += self._close(device_id)
+
+        if provisional:
+            touched = {device_id for device_id, _ in partials}
+            closed += [(device_id, *self.open[device_id]) for device_id in touched if device_id in self.open]
+        return interval_metrics(closed)
+
+    # Function to close every open interval (for one-shot runs over a fixed set of rows)
+    def close_all(self):
+        closed = []
+        for device_id in list(self.open):
+            closed += self._close(device_id)
+        return interval_metrics(closed)
+
+    # Function to find the position to restart from: the oldest open interval, or the read position
+    def watermark(self):
+        if self.open:
+            return min(start for start, _ in self.open.values())
+        return self.read_position
+
+    def _fold(self, device_id, start, partial):
+        closed = []
+        current = self.open.get(device_id)
+        if current is not None and current[0] != start:
+            closed = self._close(device_id)
+            current = None
+
+        registers = self.registers.setdefault(device_id, {})
+        if current is None:
+            # Baseline: the reading just before this interval when known
+            interval = {
+                "baseline": {register: registers.get(register, partial["first"][register]) for register in REGISTERS},
+                "baseline_timestamp": self.last_seen.get(device_id, partial["first_timestamp"]),
+                "last": dict(partial["last"]),
+                "sums": dict(partial["sums"]),
+                "counts": dict(partial["counts"]),
+                "rows": partial["rows"],
+            }
+            self.open[device_id] = (start, interval)
+        else:
+            interval = current[1]
+            for register, value in partial["last"].items():
+                if value is not None:
+                    interval["last"][register] = value
+            for reading in READINGS:
+                interval["sums"][reading] += partial["sums"][reading]
+                interval["counts"][reading] += partial["counts"][reading]
+            interval["rows"] += partial["rows"]
+        interval["last_timestamp"] = partial["last_timestamp"]
+        interval["max_value"] = self.max_value(device_id)
+        if device_id in self.widened_at and self.widened_at[device_id] < start + interval_length:
+            del self.widened_at[device_id]
+            interval["widened"] = True
+
+        for register, value in partial["last"].items():
+            if value is not None:
+                registers[register] = value
+        self.last_seen[device_id] = partial["last_timestamp"]
+        return closed
+
+    # Function to track a device's consecutive readings above its maximum (in timestamp order)
+    # and widen the register once widen_samples of them in a row have been seen
+    def _count_above_max(self, device_id, above, readings, timestamps):
+        count, peak = self.above_max.pop(device_id, (0, 0.0))
+        for is_above, reading, timestamp in zip(above, readings, timestamps):
+            if not is_above:
+                count, peak = 0, 0.0
+                continue
+            count, peak = count + 1, max(peak, float(reading))
+            if count >= widen_samples:
+                self._widen(device_id, peak)
+                self.widened_at[device_id] = timestamp
+                return
+        if count:
+            self.above_max[device_id] = (count, peak)
+
+    # Function to record a register wider than assumed: it wraps at the next power of ten
+    def _widen(self, device_id, reading):
+        max_value = float(10 ** len(str(int(reading))))
+        logging.warning(f"Device {device_id} read {reading}, above its register maximum {self.max_value(device_id)}; using {max_value}.")
+        self.max_values[device_id] = self.widened[device_id] = max_value
+
+    def _advance(self, timestamp):
+        if self.read_position is None or timestamp > self.read_position:
+            self.read_position = timestamp
+
+    def _close(self, device_id):
+        start, interval = self.open.pop(device_id)
+        return [(device_id, start, interval)]
+
+
+# Function to compute the metrics rows of closed intervals in one pass over typed arrays
+def interval_metrics(closed):
+    if not closed:
+        return []
+    nan = float("nan")
+    baseline = np.array([[nan if interval["baseline"][r] is None else interval["baseline"][r] for r in REGISTERS] for _, _, interval in closed])
+    last = np.array([[nan if interval["last"][r] is None else interval["last"][r] for r in REGISTERS] for _, _, interval in closed])
+    sums = np.array([[interval["sums"][r] for r in READINGS] for _, _, interval in closed])
+    counts = np.array([[interval["counts"][r] for r in READINGS] for _, _, interval in closed])
+
+    max_values = np.array([interval["max_value"] for _, _, interval in closed])[:, None]
+    hours = np.array([(interval["last_timestamp"] - interval["baseline_timestamp"]).total_seconds() / 3600 for _, _, interval in closed])[:, None]
+
+    # Classify every register delta at once (NaN compares False, so missing registers are never flagged)
+    deltas = last - baseline
+    limit = max_power_kw * hours + register_resolution  # Most energy the meter could have counted since the baseline
+    with np.errstate(invalid="ignore"):
+        rollover = (deltas < 0) & (deltas + max_values >= 0) & (deltas + max_values <= limit)  # A drop beyond the maximum cannot be a wrap
+        reset = (deltas < 0) & ~rollover & (last <= limit)
+        replaced = ((deltas < 0) & ~rollover & ~reset) | (deltas > limit)
+    complete = ~np.isnan(deltas).any(axis=1)
+    deltas = np.where(rollover, deltas + max_values, deltas)
+    deltas = np.where(reset | replaced, np.nan, deltas)
+    widened = np.array([interval.get("widened", False) for _, _, interval in closed])
+    flags = (QUALITY_ROLLOVER * rollover.any(axis=1) | QUALITY_RESET * reset.any(axis=1) | QUALITY_REPLACED * replaced.any(axis=1) | QUALITY_WIDENED * widened).tolist()
+    # Phases a meter does not report average to 0, as they always have
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(counts > 0, sums / counts, 0.0)
+    deltas, means = np.round(deltas, 3).tolist(), np.round(means, 3).tolist()
+
+    metrics = []
+    for i, (device_id, start, _) in enumerate(closed):
+        if not complete[i]:
+            continue
+        metric = {"device_id": device_id, "day": start.date(), "hour": start.hour, "interval_start": start.minute}
+        metric.update(zip((metric for metric, _ in DELTA_COLUMNS), [None if value != value else value for value in deltas[i]] if flags[i] else deltas[i]))
+        metric.update(zip((metric for metric, _ in AVERAGE_COLUMNS), means[i]))
+        metric["quality_flag"] = flags[i]
+        metrics.append(metric)
+
+    if len(metrics) < len(closed):
+        logging.warning(f"Skipped {len(closed) - len(metrics)} intervals due to NULL values.")
+    suspect = sum(1 for flag in flags if flag & (QUALITY_RESET | QUALITY_REPLACED))
+    if suspect:
+        logging.warning(f"Flagged {suspect} intervals with a register reset or meter replacement.")
+    return metrics
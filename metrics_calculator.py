@@ -1,8 +1,20 @@
-import pyodbc
 from datetime import datetime, timedelta, timezone
+import argparse
 import time
 import logging
-from collections import defaultdict
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import db_pool
+import instrumentation
+import parquet_store
+import watermark_signal
+from bulk_writer import merge_rows
+from interval_aggregator import IntervalAggregator, METRIC_COLUMNS, REGISTERS
+from rollups import update_rollups
+from schema import METRICS_AMENDED, METRICS_REPROCESSED, METRICS_WATERMARK, TARGET_SCHEMA, ensure_schema, report_duplicate_intervals
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -22,258 +34,431 @@ target_conn_str = (
     f"PWD={target_db_password};"
 )
 
-# Process name (used to identify the process in the metadata table)
-process_name = "metrics_calculator"
+# Connection pool for the metrics queries and the metadata reads/updates
+db_pool.register_pool("target", db_pool.pyodbc_backend(target_conn_str))
 
-# Function to fetch data from the target database
-def fetch_data(last_processed_timestamp):
-    try:
-        conn = pyodbc.connect(target_conn_str)
+# Process name (used to identify the process in the metadata table)
+process_name = METRICS_WATERMARK
+
+# Natural key of a device_consumption_metrics row
+METRIC_KEY_COLUMNS = ["device_id", "day", "hour", "interval_start"]
+
+# How far back a cold start looks for each device's last reading before the watermark
+seed_lookback = timedelta(hours=int(os.getenv("METRICS_SEED_LOOKBACK_HOURS", "24")))
+
+# 0 aggregates in this process, N partitions the devices over N worker processes
+metrics_processes = int(os.getenv("METRICS_PROCESSES", "0"))
+
+# Shard workers start from a fresh interpreter (forkserver where available) rather than a fork of this
+# multithreaded process, and register the parent's pools themselves
+worker_context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Seconds to wait for a shard worker's answer before it is taken as hung and the workers are restarted
+shard_timeout = int(os.getenv("METRICS_SHARD_TIMEOUT_SECONDS", "600"))
+
+# Rows held in memory per fetched chunk; the aggregator state between chunks is one entry per device
+fetch_chunk_rows = int(os.getenv("METRICS_FETCH_CHUNK_ROWS", "50000"))
+
+# Function to stream rows from the target database in chunks of at most fetch_chunk_rows, as DataFrames
+# (rows at the position are re-read; the aggregator skips them). until_timestamp bounds the range (exclusive).
+# Each chunk is its own keyset page on (timestamp, id), so no cursor stays open while the caller writes.
+def fetch_data(last_processed_timestamp, until_timestamp=None):
+    upper_bound = "AND timestamp < ?" if until_timestamp is not None else ""
+    page = "LIMIT ?" if db_pool.get_pool("target").dialect == "sqlite" else "OFFSET 0 ROWS FETCH NEXT ? ROWS ONLY"
+    query = f"""
+        SELECT id, device_id, timestamp, processed,
+               total_energy_consumed, current_power_consumption,
+               phase1_energy, phase2_energy, phase3_energy,
+               phase1_voltage, phase2_voltage, phase3_voltage,
+               phase1_current, phase2_current, phase3_current,
+               reactive_energy_consumed, tariff1_energy, tariff2_energy
+        FROM mqtt_raw_data
+        WHERE timestamp >= ? AND (timestamp > ? OR id > ?) {upper_bound}
+        ORDER BY timestamp, id
+        {page}
+    """
+    position_timestamp, position_id = last_processed_timestamp, -1  # Every row at the start timestamp
+    while True:
+        params = [position_timestamp, position_timestamp, position_id]
+        if until_timestamp is not None:
+            params.append(until_timestamp)
+        try:
+            with db_pool.connection("target") as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, (*params, fetch_chunk_rows))
+                rows = cursor.fetchmany(fetch_chunk_rows)
+                columns = [column[0] for column in cursor.description]
+        except Exception as e:
+            logging.error(f"Error fetching data: {e}")
+            return
+        if not rows:
+            return
+
+        # Row tuples straight into typed columns for the aggregator
+        yield pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns)
+        if len(rows) < fetch_chunk_rows:
+            return
+        position_timestamp, position_id = rows[-1][2], rows[-1][0]
+
+# Function to stream the same rows from the local Parquet store instead of the database, a day at a time
+def fetch_data_from_store(last_processed_timestamp, until_timestamp):
+    day = last_processed_timestamp
+    while day < until_timestamp:
+        day_end = min(datetime.combine(day.date(), datetime.min.time()) + timedelta(days=1), until_timestamp)
+        data = parquet_store.read_readings(day, day_end)
+        if len(data):
+            yield data
+        day = day_end
+
+# Function to rebuild the aggregator after a restart: each device's last readings before the watermark
+# become the interval baselines. Intervals recomputed from there replace the rows already written.
+def seed_aggregator(watermark, from_store=False):
+    aggregator = IntervalAggregator()
+    load_meter_registry(aggregator)
+    if from_store:
+        readings = parquet_store.read_readings(watermark - seed_lookback, watermark, columns=["device_id", "timestamp", *REGISTERS])
+        latest = readings.groupby("device_id").tail(1).astype(object)
+        for device_id, timestamp, *registers in latest.where(latest.notna(), None).itertuples(index=False, name=None):
+            aggregator.seed(device_id, timestamp.to_pydatetime(), dict(zip(REGISTERS, registers)))
+        logging.info(f"Seeded {len(aggregator.registers)} devices from {watermark} (Parquet store).")
+        return aggregator
+
+    with db_pool.connection("target") as conn:
         cursor = conn.cursor()
-
-        query = """
-            SELECT id, device_id, timestamp, processed,
-                   total_energy_consumed, current_power_consumption,
-                   phase1_energy, phase2_energy, phase3_energy,
-                   phase1_voltage, phase2_voltage, phase3_voltage,
-                   phase1_current, phase2_current, phase3_current,
-                   reactive_energy_consumed, tariff1_energy, tariff2_energy
-            FROM mqtt_raw_data
-            WHERE timestamp > ?
-            ORDER BY timestamp
-        """
-        cursor.execute(query, last_processed_timestamp)
-        rows = cursor.fetchall()
-
-        # Convert rows to a list of dictionaries
-        data = [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
-        return data
+        cursor.execute(f"""
+            SELECT device_id, timestamp, {", ".join(REGISTERS)}
+            FROM (
+                SELECT device_id, timestamp, {", ".join(REGISTERS)},
+                       ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY timestamp DESC) AS reading_rank
+                FROM mqtt_raw_data
+                WHERE timestamp >= ? AND timestamp < ?
+            ) latest
+            WHERE reading_rank = 1
+        """, (watermark - seed_lookback, watermark))
+        for device_id, timestamp, *registers in cursor.fetchall():
+            aggregator.seed(device_id, timestamp, dict(zip(REGISTERS, registers)))
+    logging.info(f"Seeded {len(aggregator.registers)} devices from {watermark}.")
+    return aggregator
+
+# Function to load the register rollover values recorded per device in the meter registry
+def load_meter_registry(aggregator):
+    try:
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT device_id, max_value FROM meter_registry")
+            aggregator.max_values.update((device_id, max_value) for device_id, max_value in cursor.fetchall())
     except Exception as e:
-        logging.error(f"Error fetching data: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
+        logging.error(f"Error loading the meter registry: {e}")
 
-# Function to calculate metrics and insert into the new table
-def calculate_and_insert_metrics(data):
-    if not data:
-        logging.info("No data to process.")
+# Function to record the register rollover values the aggregator learned from the readings
+def save_meter_registry(aggregator):
+    if not aggregator.widened:
         return
-
-    # Group data by device_id, day, and 10-minute intervals
-    grouped_data = defaultdict(list)
-    for item in data:
-        timestamp = item["timestamp"]  # Already a datetime object
-        day = timestamp.date()
-        hour = timestamp.hour
-        interval_start = (timestamp.minute // 10) * 10  # 0, 10, 20, etc.
-        key = (item["device_id"], day, hour, interval_start)
-        grouped_data[key].append(item)
-
-    # Calculate metrics for each group
-    metrics = []
-    for key, group in grouped_data.items():
-        device_id, day, hour, interval_start = key
-
-        # Sort group by timestamp
-        group.sort(key=lambda x: x["timestamp"])
-
-        # Skip groups with NULL values in required fields
-        if (
-            group[0]["total_energy_consumed"] is None or
-            group[-1]["total_energy_consumed"] is None or
-            group[0]["reactive_energy_consumed"] is None or
-            group[-1]["reactive_energy_consumed"] is None or
-            group[0]["tariff1_energy"] is None or
-            group[-1]["tariff1_energy"] is None or
-            group[0]["tariff2_energy"] is None or
-            group[-1]["tariff2_energy"] is None
-        ):
-            logging.warning(f"Skipping group {key} due to NULL values.")
-            continue
-
-        # Calculate consumption (last value - first value)
-        power_consumption = group[-1]["total_energy_consumed"] - group[0]["total_energy_consumed"]
-
-        # Debug print to log the values
-        print(f"Device: {device_id}, Day: {day}, Hour: {hour}, Interval Start: {interval_start}")
-        print(f"First Current Power Consumption: {group[0]['total_energy_consumed']}")
-        print(f"Last Current Power Consumption: {group[-1]['total_energy_consumed']}")
-        print(f"Calculated Power Consumption: {round(power_consumption,3)}")
-        print("-" * 50)  # Separator for readability
-
-        # Handle potential meter resets (assuming a maximum value of 9999)
-        max_meter_value = 9999  # Adjust this based on your meter's maximum value
-        if power_consumption < 0:
-            power_consumption += max_meter_value  # Adjust for meter reset
-            print(f"Adjusted Power Consumption (after reset handling): {power_consumption}")
-            print("-" * 50)  # Separator for readability
-
-        reactive_energy_consumed = group[-1]["reactive_energy_consumed"] - group[0]["reactive_energy_consumed"]
-        if reactive_energy_consumed < 0:
-            reactive_energy_consumed += max_meter_value  # Adjust for meter reset
-
-        tariff1_energy = group[-1]["tariff1_energy"] - group[0]["tariff1_energy"]
-        if tariff1_energy < 0:
-            tariff1_energy += max_meter_value  # Adjust for meter reset
-
-        tariff2_energy = group[-1]["tariff2_energy"] - group[0]["tariff2_energy"]
-        if tariff2_energy < 0:
-            tariff2_energy += max_meter_value  # Adjust for meter reset
-
-        # Calculate averages (skip NULL values)
-        avg_phase1_voltage = sum(item["phase1_voltage"] for item in group if item["phase1_voltage"] is not None) / len(group)
-        avg_phase2_voltage = sum(item["phase2_voltage"] for item in group if item["phase2_voltage"] is not None) / len(group)
-        avg_phase3_voltage = sum(item["phase3_voltage"] for item in group if item["phase3_voltage"] is not None) / len(group)
-        avg_phase1_current = sum(item["phase1_current"] for item in group if item["phase1_current"] is not None) / len(group)
-        avg_phase2_current = sum(item["phase2_current"] for item in group if item["phase2_current"] is not None) / len(group)
-        avg_phase3_current = sum(item["phase3_current"] for item in group if item["phase3_current"] is not None) / len(group)
-
-        # Append metrics
-        metrics.append({
-        "device_id": device_id,
-        "day": day,
-        "hour": hour,
-        "interval_start": interval_start,
-        "power_consumption": round(power_consumption, 3),
-        "reactive_energy_consumed": round(reactive_energy_consumed, 3),
-        "tariff1_energy": round(tariff1_energy, 3),
-        "tariff2_energy": round(tariff2_energy, 3),
-        "avg_phase1_voltage": round(avg_phase1_voltage, 3),
-        "avg_phase2_voltage": round(avg_phase2_voltage, 3),
-        "avg_phase3_voltage": round(avg_phase3_voltage, 3),
-        "avg_phase1_current": round(avg_phase1_current, 3),
-        "avg_phase2_current": round(avg_phase2_current, 3),
-        "avg_phase3_current": round(avg_phase3_current, 3),
-    })
-
-    # Insert metrics into the new table
     try:
-        conn = pyodbc.connect(target_conn_str)
-        cursor = conn.cursor()
-
-        insert_query = """
-            INSERT INTO device_consumption_metrics (
-                device_id, day, hour, interval_start,
-                power_consumption, reactive_energy_consumed,
-                tariff1_energy, tariff2_energy,
-                avg_phase1_voltage, avg_phase2_voltage, avg_phase3_voltage,
-                avg_phase1_current, avg_phase2_current, avg_phase3_current
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
-
-        # Prepare the data for batch insertion
-        insert_data = [
-            (
-                item["device_id"],
-                item["day"],
-                item["hour"],
-                item["interval_start"],
-                item["power_consumption"],
-                item["reactive_energy_consumed"],
-                item["tariff1_energy"],
-                item["tariff2_energy"],
-                item["avg_phase1_voltage"],
-                item["avg_phase2_voltage"],
-                item["avg_phase3_voltage"],
-                item["avg_phase1_current"],
-                item["avg_phase2_current"],
-                item["avg_phase3_current"]
-            )
-            for item in metrics
-        ]
-
-        # Execute the batch insert
-        cursor.executemany(insert_query, insert_data)
-        conn.commit()
-        logging.info(f"Inserted {len(metrics)} metrics records successfully.")
+        with db_pool.connection("target") as conn:
+            dialect = db_pool.get_pool("target").dialect
+            merge_rows(conn, "meter_registry", ["device_id", "max_value"], ["device_id"], list(aggregator.widened.items()), dialect)
+        aggregator.widened.clear()
     except Exception as e:
-        logging.error(f"Error inserting metrics: {e}")
-    finally:
-        if conn:
-            conn.close()
-
+        # Kept in widened and saved with the next batch
+        logging.error(f"Error saving the meter registry: {e}")
 
+# Function to move a process_metadata marker row (see schema.py) to the current time
+def touch_marker(conn, name, dialect):
+    merge_rows(conn, "process_metadata", ["process_name", "last_fetched_timestamp"], ["process_name"],
+               [(name, datetime.now(timezone.utc))], dialect)
 
+# Function to upsert metrics rows on (device_id, day, hour, interval_start); returns True when committed.
+# Rewritten intervals replace the stored rows, so reruns and late data amend instead of duplicating.
+def upsert_metrics(metrics):
+    try:
+        with db_pool.connection("target") as conn:
+            dialect = db_pool.get_pool("target").dialect
+            rows = [tuple(item[column] for column in METRIC_COLUMNS) for item in metrics]
+            with instrumentation.timer("metrics_upsert_seconds"):
+                written, rejected = merge_rows(conn, "device_consumption_metrics", METRIC_COLUMNS, METRIC_KEY_COLUMNS, rows, dialect)
+            instrumentation.inc("metrics_intervals_written_total", written)
+            # Tell cached readers (apiagg) that stored intervals may have changed
+            if written:
+                touch_marker(conn, METRICS_AMENDED, dialect)
+            logging.info(f"Upserted {written} metrics records successfully ({len(rejected)} rejected).")
+
+            # Recompute the hourly, daily and monthly buckets these intervals fall in. A closed interval's
+            # buckets are not touched again, so a failure fails the whole write and the chunk is retried
+            # (the interval upserts are idempotent).
+            try:
+                with instrumentation.timer("metrics_rollup_seconds"):
+                    update_rollups(conn, metrics, dialect)
+            except Exception as e:
+                logging.error(f"Error updating rollups: {e}")
+                return False
+            return True
+    except Exception as e:
+        logging.error(f"Error upserting metrics: {e}")
+        return False
+
+# Function to calculate metrics and upsert them into the metrics table.
+# With an aggregator, closed intervals and provisional rows for open ones are written; without one
+# the rows are taken as complete and every interval is written. Returns True unless the write failed.
+def calculate_and_insert_metrics(data, aggregator=None):
+    one_shot = aggregator is None
+    if one_shot:
+        aggregator = IntervalAggregator()
+
+    with instrumentation.timer("metrics_aggregate_seconds"):
+        metrics = aggregator.process(data, provisional=not one_shot)
+    instrumentation.inc("metrics_rows_aggregated_total", len(data))
+    if one_shot:
+        metrics += aggregator.close_all()
+    save_meter_registry(aggregator)
+
+    if not metrics:
+        logging.info("No intervals to write.")
+        return True
+    return upsert_metrics(metrics)
+
+# Function to pick a device's shard (the same hash batch_process shards the parsing by)
+def shard_of(device_id, shards):
+    return zlib.crc32(str(device_id).encode()) % shards
+
+# Function to split the seeded device state of an aggregator into one aggregator per shard
+def split_aggregator(aggregator, shards):
+    parts = [IntervalAggregator() for _ in range(shards)]
+    for device_id, max_value in aggregator.max_values.items():
+        parts[shard_of(device_id, shards)].max_values[device_id] = max_value
+    for device_id, timestamp in aggregator.last_seen.items():
+        parts[shard_of(device_id, shards)].seed(device_id, timestamp, aggregator.registers.get(device_id, {}))
+    return parts
+
+# Function to summarize an aggregator for checkpoint: its restart point, newest reading and open intervals
+def shard_status(aggregator):
+    return {"watermark": aggregator.watermark(), "read_position": aggregator.read_position, "open": len(aggregator.open)}
+
+# Device state of the shard this worker process owns, kept between chunks
+_shard_aggregator = None
+
+# Function to prepare a shard worker process with the pools of its parent (see db_pool.pool_settings)
+def init_shard_worker(pools):
+    db_pool.register_pools(pools)
+
+# Function to give a shard worker its (seeded) aggregator; returns its status
+def load_shard(aggregator):
+    global _shard_aggregator
+    _shard_aggregator = aggregator
+    return shard_status(aggregator)
+
+# Function to aggregate and upsert one chunk of this worker's shard.
+# Returns whether the intervals were committed, the shard status and the metrics recorded meanwhile.
+def process_shard(data, read_position):
+    metrics = _shard_aggregator.process(data, read_position=read_position)
+    save_meter_registry(_shard_aggregator)
+    committed = upsert_metrics(metrics) if metrics else True
+    return committed, shard_status(_shard_aggregator), instrumentation.drain()
+
+# Function to start one single-process pool per shard, so each shard's state stays in one process
+def start_shard_workers(shards):
+    pools = db_pool.pool_settings()
+    return [
+        ProcessPoolExecutor(max_workers=1, mp_context=worker_context, initializer=init_shard_worker, initargs=(pools,))
+        for _ in range(shards)
+    ]
+
+# Function to stop the shard workers without waiting on one that hangs
+def stop_shard_workers(workers):
+    for worker in workers:
+        processes = list((worker._processes or {}).values())  # The executor has no public way to end its processes
+        worker.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+            process.join()
+
+# Function to send the seeded shard aggregators to their workers; returns the shard statuses
+def load_shards(workers, aggregators):
+    futures = [worker.submit(load_shard, aggregator) for worker, aggregator in zip(workers, aggregators)]
+    return [future.result(timeout=shard_timeout) for future in futures]
+
+# Function to run one chunk across the shard workers in parallel, updating statuses in place.
+# Only the shard's rows go to each worker; returns True when every shard committed.
+def process_sharded(data, workers, statuses):
+    shards = len(workers)
+    frames = [data.iloc[0:0]] * shards
+    if len(data):
+        for shard, frame in data.groupby(data["device_id"].map(lambda device_id: shard_of(device_id, shards)), sort=False):
+            frames[shard] = frame
+        read_position = pd.Timestamp(data["timestamp"].max()).to_pydatetime()
+    else:
+        read_position = max((status["read_position"] for status in statuses if status["read_position"]), default=None)
+
+    committed = True
+    with instrumentation.timer("metrics_aggregate_seconds"):
+        futures = [worker.submit(process_shard, frame, read_position) for worker, frame in zip(workers, frames)]
+        for shard, future in enumerate(futures):
+            shard_committed, statuses[shard], recorded = future.result(timeout=shard_timeout)
+            instrumentation.merge(recorded)  # Upsert and rollup timings and counts from the worker
+            committed = committed and shard_committed
+    instrumentation.inc("metrics_rows_aggregated_total", len(data))
+    return committed
+
+# Function to recompute every interval in [start, end) from the raw rows, e.g. after late data or a backfill.
+# Ranges can be reprocessed in parallel; the live watermark is not touched. With from_store the readings
+# come from the local Parquet store, so only the metrics writes reach the database.
+def reprocess_range(start, end, from_store=False):
+    try:
+        aggregator = seed_aggregator(start, from_store)
+        for data in fetch_data_from_store(start, end) if from_store else fetch_data(start, end):
+            if not calculate_and_insert_metrics(data, aggregator):
+                return False
+        # The range is complete: its last intervals are final, not provisional
+        metrics = aggregator.close_all()
+        return upsert_metrics(metrics) if metrics else True
+    finally:
+        # Closed intervals may have been rewritten; readers caching them drop their copies
+        try:
+            with db_pool.connection("target") as conn:
+                touch_marker(conn, METRICS_REPROCESSED, db_pool.get_pool("target").dialect)
+        except Exception as e:
+            logging.error(f"Error marking the reprocessed range: {e}")
 
 # Function to get the last processed timestamp from the metadata table
 def get_last_processed_timestamp():
     try:
-        conn = pyodbc.connect(target_conn_str)
-        cursor = conn.cursor()
-
-        query = """
-            SELECT last_fetched_timestamp
-            FROM process_metadata
-            WHERE process_name = ?
-        """
-        cursor.execute(query, process_name)
-        row = cursor.fetchone()
-
-        if row:
-            return row[0]
-        else:
-            # If no record exists, insert a default timestamp (e.g., 1 hour ago)
-            default_timestamp = datetime.now(timezone.utc) - timedelta(hours=1)
-            cursor.execute("""
-                INSERT INTO process_metadata (process_name, last_fetched_timestamp)
-                VALUES (?, ?)
-            """, process_name, default_timestamp)
-            conn.commit()
-            return default_timestamp
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+
+            query = """
+                SELECT last_fetched_timestamp
+                FROM process_metadata
+                WHERE process_name = ?
+            """
+            cursor.execute(query, (process_name,))
+            row = cursor.fetchone()
+
+            if row:
+                return row[0]
+            else:
+                # If no record exists, insert a default timestamp (1 hour ago, naive UTC like the stored timestamps)
+                default_timestamp = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=1)
+                cursor.execute("""
+                    INSERT INTO process_metadata (process_name, last_fetched_timestamp)
+                    VALUES (?, ?)
+                """, (process_name, default_timestamp))
+                conn.commit()
+                return default_timestamp
     except Exception as e:
         logging.error(f"Error fetching last processed timestamp: {e}")
-        return datetime.now(timezone.utc) - timedelta(hours=1)
-    finally:
-        if conn:
-            conn.close()
+        return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=1)
 
 # Function to update the last processed timestamp in the metadata table
 def update_last_processed_timestamp(new_timestamp):
     try:
-        conn = pyodbc.connect(target_conn_str)
-        cursor = conn.cursor()
-
-        query = """
-            UPDATE process_metadata
-            SET last_fetched_timestamp = ?
-            WHERE process_name = ?
-        """
-        cursor.execute(query, new_timestamp, process_name)
-        conn.commit()
-        logging.info(f"Updated last_fetched_timestamp to {new_timestamp}.")
+        with db_pool.connection("target") as conn:
+            cursor = conn.cursor()
+
+            query = """
+                UPDATE process_metadata
+                SET last_fetched_timestamp = ?
+                WHERE process_name = ?
+            """
+            cursor.execute(query, (new_timestamp, process_name))
+            conn.commit()
+            logging.info(f"Updated last_fetched_timestamp to {new_timestamp}.")
     except Exception as e:
         logging.error(f"Error updating last processed timestamp: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+# Function to store the restart point once a chunk is committed: the oldest open interval of any shard,
+# which is rebuilt from the raw rows after a restart. Takes the shard_status of every shard.
+def checkpoint(statuses):
+    watermarks = [status["watermark"] for status in statuses if status["watermark"] is not None]
+    if watermarks:
+        watermark = min(watermarks)
+        read_position = max(status["read_position"] for status in statuses if status["read_position"] is not None)
+        update_last_processed_timestamp(watermark)
+        # Gap between the stored restart point and the newest reading, and freshness of the newest reading
+        instrumentation.set_gauge("metrics_watermark_gap_seconds", (read_position - watermark).total_seconds())
+        instrumentation.set_gauge("metrics_lag_seconds", instrumentation.seconds_since(read_position))
+    instrumentation.set_gauge("metrics_open_intervals", sum(status["open"] for status in statuses))
 
 # Main function to run the metrics calculation process
 def run_metrics_process():
+    instrumentation.start_server()
+    # Create the rollup tables and indexes if they are missing
+    try:
+        with db_pool.connection("target") as conn:
+            ensure_schema(conn, TARGET_SCHEMA)
+            report_duplicate_intervals(conn)
+    except Exception as e:
+        logging.error(f"Error connecting to apply schema changes: {e}")
+
+    # Run when the ingest workers signal new committed rows, polling only when they are silent
+    listener = watermark_signal.listen()
+    workers = None
+    statuses = None
     while True:
         try:
-            # Get the last processed timestamp
-            last_processed_timestamp = get_last_processed_timestamp()
-
-            # Fetch data from the target database
-            data = fetch_data(last_processed_timestamp)
-
-            # Calculate metrics and insert into the new table
-            calculate_and_insert_metrics(data)
-
-            # Update the last processed timestamp
-            if data:
-                new_timestamp = max(item["timestamp"] for item in data)
-                update_last_processed_timestamp(new_timestamp)
+            # (Re)build the running interval state from the stored watermark, one aggregator per device shard
+            if statuses is None:
+                last_processed_timestamp = get_last_processed_timestamp()
+                aggregator = seed_aggregator(last_processed_timestamp)
+                if metrics_processes > 0:
+                    if workers is None:
+                        workers = start_shard_workers(metrics_processes)
+                    statuses = load_shards(workers, split_aggregator(aggregator, metrics_processes))
+                else:
+                    statuses = [shard_status(aggregator)]
+
+            # Stream the rows after the newest one every shard has processed, checkpointing after each chunk
+            read_positions = [status["read_position"] for status in statuses]
+            chunks = fetch_data(last_processed_timestamp if None in read_positions else min(read_positions))
+            while True:
+                with instrumentation.timer("metrics_fetch_seconds"):
+                    data = next(chunks, None)
+                if data is None:
+                    break
+                instrumentation.inc("metrics_rows_fetched_total", len(data))
+
+                # Fold them in and upsert the closed and still-open intervals
+                if workers is not None:
+                    committed = process_sharded(data, workers, statuses)
+                else:
+                    committed = calculate_and_insert_metrics(data, aggregator)
+                    statuses = [shard_status(aggregator)]
+                if not committed:
+                    # Some intervals were not written; rebuild every shard from the stored watermark
+                    statuses = None
+                    chunks.close()
+                    break
+                checkpoint(statuses)
         except Exception as e:
             logging.error(f"Error in metrics process: {e}")
+            statuses = None
+            if workers is not None:
+                # A worker may have died; start fresh ones with the next run
+                stop_shard_workers(workers)
+                workers = None
 
-        # Wait for 10 minutes before the next run
-        time.sleep(600)
-
-# Run the metrics process
+        # Wait for the next committed batch (debounced), or at most METRICS_MAX_IDLE_SECONDS
+        try:
+            signalled = listener is not None and listener.wait()
+        except Exception as e:
+            logging.error(f"Error waiting for watermark notifications: {e}")
+            signalled = False
+            time.sleep(watermark_signal.max_idle)
+        if not signalled:
+            if listener is None:
+                time.sleep(watermark_signal.max_idle)
+            logging.info("No new rows signalled; running in case a notification was missed.")
+
+# Run the metrics process, or recompute a past range with --reprocess START END
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculate interval metrics from the parsed readings.")
+    parser.add_argument("--reprocess", nargs=2, type=datetime.fromisoformat, metavar=("START", "END"),
+                        help="Recompute the intervals in [START, END) and exit")
+    parser.add_argument("--from-store", action="store_true", help="Read the readings from the Parquet store (PARQUET_STORE_DIR)")
+    args = parser.parse_args()
+
+    if args.reprocess:
+        logging.info(f"Reprocessing metrics from {args.reprocess[0]} to {args.reprocess[1]}...")
+        raise SystemExit(0 if reprocess_range(*args.reprocess, from_store=args.from_store) else 1)
+
     logging.info("Starting metrics calculation process...")
     run_metrics_process()
\ No newline at end of file
@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import logging
+import os
+from datetime import datetime, timezone
+
+import batch_process
+import watermark_signal
+from telegram_parser import parse_data
+
+try:
+    import aiomqtt
+except ImportError:  # Optional: only needed to subscribe to a real broker
+    aiomqtt = None
+
+# Direct MQTT ingest: subscribes to the meter topics, parses each telegram on arrival and
+# upserts micro-batches into the target mqtt_raw_data table, skipping the source database
+# and the batch_process polling delay.
+#
+#     python mqtt_ingest.py
+#
+# Run it instead of batch_process for the devices it covers: rows arriving through both
+# paths would be stored twice under different ids.
+
+# Broker settings
+mqtt_host = os.getenv("MQTT_HOST", "localhost")
+mqtt_port = int(os.getenv("MQTT_PORT", "1883"))
+mqtt_username = os.getenv("MQTT_USERNAME")
+mqtt_password = os.getenv("MQTT_PASSWORD")
+mqtt_topic = os.getenv("MQTT_TOPIC", "meters/+/telegram")
+device_topic_level = int(os.getenv("MQTT_DEVICE_TOPIC_LEVEL", "1"))  # Topic level holding the device id
+
+# Micro-batching: a batch is written when it is full or its oldest row has waited max_batch_delay
+max_batch_rows = int(os.getenv("MQTT_BATCH_SIZE", "500"))
+max_batch_delay = float(os.getenv("MQTT_BATCH_MAX_DELAY", "0.5"))  # Seconds
+queue_size = int(os.getenv("MQTT_QUEUE_SIZE", "10000"))  # Messages buffered while a batch is being written
+
+# A batch that could not be written is retried, waiting from retry_delay up to retry_max_delay between
+# attempts; meanwhile the queue fills and the broker stream is no longer read (backpressure).
+# A lost broker connection is re-established with the same backoff.
+retry_delay = float(os.getenv("MQTT_RETRY_DELAY", "1"))  # Seconds
+retry_max_delay = float(os.getenv("MQTT_RETRY_MAX_DELAY", "60"))  # Seconds
+
+# Ids of directly ingested rows live above 2**62 so they never collide with source ids
+direct_id_base = 2**62
+
+
+# Function to check an MQTT topic against a subscription filter with + and # wildcards
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+# In-process stand-in for a broker, used to exercise the subscriber without a network
+class LocalBroker:
+    def __init__(self):
+        self._subscriptions = []
+
+    async def publish(self, topic, payload):
+        for topic_filter, messages in self._subscriptions:
+            if topic_matches(topic_filter, topic):
+                await messages.put((topic, payload))
+
+    # Function to close every subscription, ending the message streams
+    async def close(self):
+        for _, messages in self._subscriptions:
+            await messages.put(None)
+
+    # Function to subscribe; messages published from now on are yielded as (topic, payload)
+    def messages(self, topic_filter):
+        messages = asyncio.Queue()
+        self._subscriptions.append((topic_filter, messages))
+        return self._stream(messages)
+
+    async def _stream(self, messages):
+        while True:
+            message = await messages.get()
+            if message is None:
+                return
+            yield message
+
+
+# Function to stream (topic, payload) pairs from one session with a real broker
+async def client_messages(topic_filter):
+    async with aiomqtt.Client(mqtt_host, port=mqtt_port, username=mqtt_username, password=mqtt_password) as client:
+        await client.subscribe(topic_filter, qos=1)
+        async for message in client.messages:
+            yield message.topic.value, message.payload
+
+
+# Function to stream (topic, payload) pairs from a broker, reconnecting after errors with a capped backoff.
+# connect opens one session (client_messages by default); the stream ends when a session ends cleanly.
+async def broker_messages(topic_filter, connect=None):
+    if connect is None:
+        if aiomqtt is None:
+            raise RuntimeError("aiomqtt is not installed; install it to subscribe to an MQTT broker")
+        connect = client_messages
+    delay = retry_delay
+    while True:
+        try:
+            async for message in connect(topic_filter):
+                delay = retry_delay  # Connected again
+                yield message
+            return
+        except Exception as e:
+            logging.error(f"Lost the MQTT broker connection ({e}); reconnecting in {delay:g} s.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, retry_max_delay)
+
+
+# Function to turn one MQTT message into a target mqtt_raw_data row, or None if it cannot be parsed
+def build_row(topic, payload, received_at):
+    levels = topic.split("/")
+    if device_topic_level >= len(levels):
+        logging.warning(f"No device id in topic {topic}")
+        return None
+    device_id = levels[device_topic_level]
+
+    data = payload.decode("utf-8", errors="replace") if isinstance(payload, bytes) else payload
+    parsed_item = parse_data(data)
+    if not parsed_item:
+        return None
+
+    # Redelivered messages hash to the same id, so the upsert drops them
+    digest = hashlib.blake2b(f"{device_id}\n{data}".encode(), digest_size=8).digest()
+    row_id = direct_id_base + int.from_bytes(digest, "big") % direct_id_base
+    return {
+        "id": row_id,
+        "device_id": device_id,
+        "timestamp": received_at,
+        "processed": 0,
+        "data": data,  # Kept for the dead-letter table if the row is rejected
+        **parsed_item,
+    }
+
+
+# Function to read messages into the bounded queue (blocks the broker stream when writes fall behind)
+async def receive(messages, message_queue):
+    try:
+        async for topic, payload in messages:
+            # Naive UTC, like the timestamps batch_process copies from the source table
+            row = build_row(topic, payload, datetime.now(timezone.utc).replace(tzinfo=None))
+            if row:
+                await message_queue.put(row)
+    finally:
+        await message_queue.put(None)
+
+
+# Function to write rows in micro-batches by size or age until the message stream ends
+async def write_batches(message_queue, write=batch_process.insert_parsed_data):
+    loop = asyncio.get_running_loop()
+    batch = []
+    deadline = None
+    finished = False
+    while not finished:
+        timeout = None if not batch else max(0, deadline - loop.time())
+        try:
+            row = await asyncio.wait_for(message_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            row = ...  # Oldest row has waited long enough
+
+        if row is None:
+            finished = True
+        elif row is not ...:
+            if not batch:
+                deadline = loop.time() + max_batch_delay
+            batch.append(row)
+            if len(batch) < max_batch_rows:
+                continue
+
+        if batch:
+            # The blocking database write runs in a thread so messages keep arriving meanwhile.
+            # The messages are already consumed, so the batch is kept until it is written.
+            delay = retry_delay
+            while not await asyncio.to_thread(write, batch):
+                logging.error(f"Could not write a batch of {len(batch)} MQTT readings; retrying in {delay:g} s.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, retry_max_delay)
+            watermark_signal.notify(max(row["timestamp"] for row in batch))
+            batch = []
+
+
+# Function to run the subscriber against a message stream (a real broker by default)
+async def run_subscriber(messages=None, write=batch_process.insert_parsed_data):
+    if messages is None:
+        messages = broker_messages(mqtt_topic)
+    message_queue = asyncio.Queue(maxsize=queue_size)
+    await asyncio.gather(receive(messages, message_queue), write_batches(message_queue, write))
+
+
+if __name__ == "__main__":
+    logging.info(f"Subscribing to {mqtt_topic} on {mqtt_host}:{mqtt_port}...")
+    asyncio.run(run_subscriber())
@@ -1,6 +1,7 @@
 import streamlit as st
 import pandas as pd
 import requests
+import api_client
 import numpy as np
 import plotly.express as px
 from sklearn.cluster import KMeans
@@ -10,11 +11,9 @@ from sklearn.preprocessing import StandardScaler
 
 # Fetch data from the API
 def fetch_data():
-    url = "https://energy-api-momentum-fnc2e5cseaezerh9.swedencentral-01.azurewebsites.net/data"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return pd.DataFrame(response.json())
-    else:
+    try:
+        return api_client.fetch_data()
+    except requests.RequestException:
         st.error("Failed to fetch data from the API")
         return pd.DataFrame()
 
@@ -0,0 +1,374 @@
+import argparse
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+import db_pool
+from telegram_parser import FIELD_NAMES
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # Optional: only needed when the store is enabled
+    pa = None
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows; writers in one process are still serialized
+    fcntl = None
+
+# Local columnar copy of the parsed readings (the target mqtt_raw_data rows), for reprocessing and
+# analysis without database round trips:
+#
+#     PARQUET_STORE_DIR=/data/readings python batch_process.py
+#     python parquet_store.py export --start 2025-01-01 --end 2025-02-01
+#     python parquet_store.py compact
+#     python metrics_calculator.py --reprocess 2025-01-01 2025-02-01 --from-store
+#
+# Layout: <store>/device_id=<device>/day=<YYYY-MM-DD>/part-<n>.parquet (zstd). Committed rows are
+# buffered in memory and a background thread writes one file per device and day once
+# PARQUET_STORE_FLUSH_ROWS rows are buffered or the oldest has waited PARQUET_STORE_FLUSH_SECONDS.
+# The same thread compacts finished days (one file per partition) every PARQUET_STORE_COMPACT_SECONDS.
+# manifest.jsonl lists the files with their time range, so reads only open the files that can match,
+# and the timestamp and device filters are pushed down to the Parquet row groups. Rows written again
+# (replays, backfills) are kept once, from the newest file. Buffered rows are lost if the process dies;
+# export_range refills the gap from the database.
+
+store_dir = os.getenv("PARQUET_STORE_DIR")
+enabled = store_dir is not None
+
+compression = os.getenv("PARQUET_STORE_COMPRESSION", "zstd")
+
+flush_rows = int(os.getenv("PARQUET_STORE_FLUSH_ROWS", "50000"))
+flush_seconds = float(os.getenv("PARQUET_STORE_FLUSH_SECONDS", "300"))
+compact_seconds = float(os.getenv("PARQUET_STORE_COMPACT_SECONDS", "3600"))
+
+# Columns of a stored reading, as in the target mqtt_raw_data table
+COLUMNS = ["id", "device_id", "timestamp", "processed", *FIELD_NAMES]
+
+_lock = threading.Lock()
+
+# Rows waiting for the background writer, by (device_id, day)
+_buffer = defaultdict(list)
+_buffer_lock = threading.Lock()
+_buffered_rows = 0
+_buffered_since = None  # time.monotonic() of the oldest buffered row
+_flush_requested = threading.Event()
+_flusher = None
+
+_manifest_cache = (None, [])  # (stat key of manifest.jsonl, live entries)
+
+
+# Arrow schema of a parsed reading (also the columns of the api.py /data binary responses)
+def arrow_schema():
+    return pa.schema([
+        ("id", pa.int64()),
+        ("device_id", pa.string()),
+        ("timestamp", pa.timestamp("us")),
+        ("processed", pa.int64()),
+        *((name, pa.float64()) for name in FIELD_NAMES),
+    ])
+
+
+def _require():
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed; install it to use the Parquet store")
+    if store_dir is None:
+        raise RuntimeError("PARQUET_STORE_DIR is not set")
+
+
+# Timestamps are stored as naive UTC, like the database columns
+def _naive_utc(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _manifest_path():
+    return os.path.join(store_dir, "manifest.jsonl")
+
+
+class _ManifestLock:
+    def __enter__(self):
+        _lock.acquire()
+        os.makedirs(store_dir, exist_ok=True)
+        self.file = open(os.path.join(store_dir, "manifest.lock"), "a")
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)  # Other writer processes (batch_process, mqtt_ingest)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()  # Releases the flock
+        _lock.release()
+        return False
+
+
+# Function to append manifest operations: {"add": {...file entry...}} or {"remove": path}
+def _append_manifest(operations):
+    with open(_manifest_path(), "a") as f:
+        f.write("".join(json.dumps(operation) + "\n" for operation in operations))
+
+
+# Function to load the live file entries, in write order. The parsed manifest is reused until the file
+# changes (appends grow it, compaction replaces it).
+def load_manifest():
+    global _manifest_cache
+    try:
+        stat = os.stat(_manifest_path())
+    except FileNotFoundError:
+        return []
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if _manifest_cache[0] == key:
+        return list(_manifest_cache[1])
+
+    entries = {}
+    try:
+        with open(_manifest_path()) as f:
+            for line in f:
+                operation = json.loads(line)
+                if "add" in operation:
+                    entries[operation["add"]["path"]] = operation["add"]
+                else:
+                    entries.pop(operation["remove"], None)
+    except FileNotFoundError:
+        pass
+    _manifest_cache = (key, list(entries.values()))
+    return list(entries.values())
+
+
+def _write_file(device_id, day, table):
+    partition = os.path.join(f"device_id={device_id}", f"day={day.isoformat()}")
+    os.makedirs(os.path.join(store_dir, partition), exist_ok=True)
+    path = os.path.join(partition, f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet")
+    pq.write_table(table, os.path.join(store_dir, path), compression=compression)
+    timestamps = table.column("timestamp")
+    return {
+        "path": path,
+        "device_id": device_id,
+        "day": day.isoformat(),
+        "rows": table.num_rows,
+        "min_timestamp": pc.min(timestamps).as_py().isoformat(),
+        "max_timestamp": pc.max(timestamps).as_py().isoformat(),
+    }
+
+
+# Function to add rows to partitions, a {(device_id, day): rows} dict
+def _partition(rows, partitions):
+    for row in rows:
+        timestamp = _naive_utc(row["timestamp"])
+        partitions[(row["device_id"], timestamp.date())].append({**row, "timestamp": timestamp})
+    return partitions
+
+
+# Function to queue parsed rows (dicts with the COLUMNS keys) for the store; the background writer
+# flushes them. Never raises: the store is a copy, and a gap can be refilled with export_range.
+def write_rows(rows):
+    global _buffered_rows, _buffered_since
+    if not enabled or not rows:
+        return 0
+    if pa is None:
+        logging.error(f"Dropped {len(rows)} rows for the Parquet store: pyarrow is not installed.")
+        return 0
+    with _buffer_lock:
+        _partition(rows, _buffer)
+        _buffered_rows += len(rows)
+        if _buffered_since is None:
+            _buffered_since = time.monotonic()
+        full = _buffered_rows >= flush_rows
+    _start_flusher()
+    if full:
+        _flush_requested.set()
+    return len(rows)
+
+
+# Function to write the buffered rows, one file per device and day. Returns the number of rows written.
+def flush():
+    global _buffer, _buffered_rows, _buffered_since
+    with _buffer_lock:
+        partitions, count = _buffer, _buffered_rows
+        _buffer, _buffered_rows, _buffered_since = defaultdict(list), 0, None
+    return _write_partitions(partitions, count)
+
+
+def _write_partitions(partitions, count):
+    if not partitions:
+        return 0
+    try:
+        schema = arrow_schema()
+        entries = [
+            _write_file(device_id, day, pa.Table.from_pylist(partition_rows, schema=schema))
+            for (device_id, day), partition_rows in partitions.items()
+        ]
+        with _ManifestLock():
+            _append_manifest([{"add": entry} for entry in entries])
+        return count
+    except Exception as e:
+        logging.error(f"Error writing {count} rows to the Parquet store: {e}")
+        return 0
+
+
+# Background writer: flushes full or old buffers and compacts finished days on a schedule
+def _run_flusher():
+    next_compaction = time.monotonic() + compact_seconds
+    while True:
+        _flush_requested.wait(1)
+        _flush_requested.clear()
+        with _buffer_lock:
+            due = _buffered_rows >= flush_rows or (_buffered_since is not None and time.monotonic() - _buffered_since >= flush_seconds)
+        if due:
+            flush()
+        if time.monotonic() >= next_compaction:
+            try:
+                compact()
+            except Exception as e:
+                logging.error(f"Error compacting the Parquet store: {e}")
+            next_compaction = time.monotonic() + compact_seconds
+
+
+def _start_flusher():
+    global _flusher
+    with _buffer_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run_flusher, name="parquet-store", daemon=True)
+            _flusher.start()
+            atexit.register(flush)  # Write what is left on a clean exit
+
+
+# Function to read stored readings with start <= timestamp < end (either bound optional), for the given
+# devices, ordered by (timestamp, id). Returns a DataFrame shaped like the database rows.
+def read_readings(start=None, end=None, devices=None, columns=None):
+    _require()
+    columns = columns or COLUMNS
+    start = _naive_utc(start) if start is not None else None
+    end = _naive_utc(end) if end is not None else None
+
+    for attempt in range(2):
+        entries = [
+            entry for entry in load_manifest()
+            if (devices is None or entry["device_id"] in devices)
+            and (start is None or datetime.fromisoformat(entry["max_timestamp"]) >= start)
+            and (end is None or datetime.fromisoformat(entry["min_timestamp"]) < end)
+        ]
+        if not entries:
+            return pd.DataFrame(columns=columns)
+
+        condition = None
+        for predicate in (
+            ds.field("timestamp") >= start if start is not None else None,
+            ds.field("timestamp") < end if end is not None else None,
+            ds.field("device_id").isin(list(devices)) if devices is not None else None,
+        ):
+            if predicate is not None:
+                condition = predicate if condition is None else condition & predicate
+
+        try:
+            dataset = ds.dataset([os.path.join(store_dir, entry["path"]) for entry in entries], schema=arrow_schema(), format="parquet")
+            # Fragments are read in manifest (write) order, so the last copy of a row is the newest
+            table = dataset.to_table(columns=list(dict.fromkeys(["id", "timestamp", *columns])), filter=condition)
+            break
+        except FileNotFoundError:
+            if attempt:
+                raise
+            # A compaction replaced some files while we listed them; list again
+
+    frame = table.to_pandas()
+    frame = frame.drop_duplicates("id", keep="last").sort_values(["timestamp", "id"], kind="stable")
+    return frame[columns].reset_index(drop=True)
+
+
+# Function to merge the files of each (device, day) partition into one; today's partitions are left
+# alone unless include_today, since they are still being appended to. One process compacts at a time.
+def compact(include_today=False):
+    _require()
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, "compact.lock"), "a") as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("Another process is compacting the Parquet store; skipped.")
+                return 0
+        return _compact(include_today)
+
+
+def _compact(include_today):
+    today = datetime.now(timezone.utc).date().isoformat()
+    by_partition = defaultdict(list)
+    for entry in load_manifest():
+        by_partition[(entry["device_id"], entry["day"])].append(entry)
+
+    compacted = 0
+    for (device_id, day), entries in by_partition.items():
+        if len(entries) < 2 or (day >= today and not include_today):
+            continue
+        table = read_readings(devices={device_id}, start=datetime.fromisoformat(day), end=datetime.fromisoformat(day) + timedelta(days=1))
+        merged = _write_file(device_id, datetime.fromisoformat(day).date(), pa.Table.from_pandas(table, schema=arrow_schema(), preserve_index=False))
+        with _ManifestLock():
+            _append_manifest([{"add": merged}, *({"remove": entry["path"]} for entry in entries)])
+        for entry in entries:
+            try:
+                os.remove(os.path.join(store_dir, entry["path"]))
+            except FileNotFoundError:
+                pass
+        compacted += 1
+
+    # Rewrite the manifest with only the live entries
+    with _ManifestLock():
+        live = load_manifest()
+        with open(_manifest_path() + ".tmp", "w") as f:
+            f.write("".join(json.dumps({"add": entry}) + "\n" for entry in live))
+        os.replace(_manifest_path() + ".tmp", _manifest_path())
+    logging.info(f"Compacted {compacted} partitions; {len(live)} files in the store.")
+    return compacted
+
+
+# Function to copy [start, end) of the target mqtt_raw_data table into the store, a day at a time
+def export_range(start, end):
+    _require()
+    exported = 0
+    day = start
+    while day < end:
+        day_end = min(day + timedelta(days=1), end)
+        with db_pool.connection("target") as conn:
+            frame = pd.read_sql(f"""
+                SELECT {", ".join(COLUMNS)}
+                FROM mqtt_raw_data
+                WHERE timestamp >= ? AND timestamp < ?
+                ORDER BY timestamp, id
+            """, conn, params=[day, day_end])
+        rows = frame.astype(object).where(frame.notna(), None).to_dict("records")
+        for row in rows:
+            row["timestamp"] = pd.Timestamp(row["timestamp"]).to_pydatetime()
+        exported += _write_partitions(_partition(rows, defaultdict(list)), len(rows))
+        logging.info(f"Exported {len(rows)} readings from {day} to {day_end}.")
+        day = day_end
+    return exported
+
+
+if __name__ == "__main__":
+    import batch_process  # Registers the target pool (imported here: batch_process imports this module)
+
+    parser = argparse.ArgumentParser(description="Maintain the local Parquet copy of the parsed readings.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Copy a time range from the target database")
+    export.add_argument("--start", type=datetime.fromisoformat, required=True)
+    export.add_argument("--end", type=datetime.fromisoformat, required=True)
+    compact_command = commands.add_parser("compact", help="Merge the files of each device and day")
+    compact_command.add_argument("--include-today", action="store_true")
+    args = parser.parse_args()
+
+    _require()
+    if args.command == "export":
+        logging.info(f"Exported {export_range(args.start, args.end)} readings.")
+    else:
+        compact(args.include_today)
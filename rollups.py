@@ -0,0 +1,147 @@
+import logging
+from datetime import timedelta
+
+import pandas as pd
+
+from bulk_writer import merge_rows
+from interval_aggregator import AVERAGE_COLUMNS, DELTA_COLUMNS, QUALITY_REPLACED, QUALITY_RESET, QUALITY_ROLLOVER, QUALITY_WIDENED
+
+# Coarser views of device_consumption_metrics, kept up to date by metrics_calculator:
+#
+#     device_consumption_metrics (10 min) -> device_consumption_hourly -> device_consumption_daily -> device_consumption_monthly
+#
+# Each level is derived from the level below it, and only the buckets touched by newly written
+# intervals are recomputed: the finer rows of those buckets are read back (joined on the touched
+# keys, which lead with device_id like the finer tables' keys), aggregated and upserted.
+# Energy columns are sums; averages are means weighted by the number of 10-minute intervals.
+# NULL values (reset or replaced registers, missing readings) are left out of sums and means, and
+# quality_flag holds every bit set on the intervals of the bucket, so a sum that is missing an
+# interval's energy is marked as such.
+
+ENERGY_COLUMNS = [metric for metric, _ in DELTA_COLUMNS]
+MEAN_COLUMNS = [metric for metric, _ in AVERAGE_COLUMNS]
+
+# (table, bucket key columns, finer table it is derived from)
+ROLLUPS = [
+    ("device_consumption_hourly", ["device_id", "day", "hour"], "device_consumption_metrics"),
+    ("device_consumption_daily", ["device_id", "day"], "device_consumption_hourly"),
+    ("device_consumption_monthly", ["device_id", "month"], "device_consumption_daily"),
+]
+
+ROLLUP_TABLES = [table for table, _, _ in ROLLUPS]
+
+QUALITY_BITS = [QUALITY_ROLLOVER, QUALITY_RESET, QUALITY_REPLACED, QUALITY_WIDENED]
+
+
+# Function to map finer rows to the bucket keys of a level
+def bucket_keys(frame, key_columns):
+    keys = frame[["device_id"]].copy()
+    if "month" in key_columns:
+        keys["month"] = [day.replace(day=1) for day in frame["day"]]
+    else:
+        for column in key_columns[1:]:
+            keys[column] = frame[column]
+    return keys
+
+
+# Key columns of the temporary table holding the touched buckets of a level, with their SQL Server types
+KEY_TYPES = {"device_id": "NVARCHAR(100)", "day": "DATE", "hour": "INT", "month": "DATE", "month_end": "DATE"}
+
+
+# Function to load the touched bucket keys into a per-connection temporary table; returns its name
+def stage_keys(conn, touched, dialect):
+    keys = touched.copy()
+    if "month" in keys:
+        keys["month_end"] = [(month + timedelta(days=32)).replace(day=1) for month in keys["month"]]
+    columns = list(keys.columns)
+    definitions = ", ".join(f"{column} {KEY_TYPES[column]}" for column in columns)
+    rows = list(keys.astype(object).itertuples(index=False, name=None))
+
+    cursor = conn.cursor()
+    if dialect == "sqlite":
+        table = "temp.rollup_keys"
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"CREATE TEMP TABLE rollup_keys ({definitions})")
+    else:
+        table = "#rollup_keys"
+        cursor.execute(f"IF OBJECT_ID('tempdb..{table}') IS NOT NULL DROP TABLE {table}")
+        cursor.execute(f"CREATE TABLE {table} ({definitions})")
+        cursor.fast_executemany = True
+    cursor.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})", rows)
+    return table
+
+
+# Function to read the finer rows of the touched buckets, joined on their keys so only those devices'
+# rows are read (through the finer table's device-first key)
+def read_finer(conn, table, key_columns, touched, dialect="mssql"):
+    keys = stage_keys(conn, touched, dialect)
+    if "hour" in key_columns:
+        match = "f.day = k.day AND f.hour = k.hour"
+    elif "month" in key_columns:
+        match = "f.day >= k.month AND f.day < k.month_end"
+    else:
+        match = "f.day = k.day"
+
+    weight = "1 AS interval_count" if table == "device_consumption_metrics" else "f.interval_count"
+    query = f"""
+        SELECT f.device_id, f.day{", f.hour" if "hour" in key_columns else ""},
+               {", ".join(f"f.{column}" for column in ENERGY_COLUMNS + MEAN_COLUMNS)}, f.quality_flag, {weight}
+        FROM {table} f
+        JOIN {keys} k ON f.device_id = k.device_id AND {match}
+    """
+    finer = pd.read_sql(query, conn)
+    conn.cursor().execute(f"DROP TABLE {keys}")
+    # Ends the read transaction, so the upsert that follows can take the write lock (SQLite would
+    # otherwise fail the upgrade while another shard writes)
+    conn.commit()
+    return finer
+
+
+# Function to aggregate finer rows into buckets: energy sums, interval-weighted means of the known
+# values and the union of the quality bits
+def aggregate(finer, key_columns):
+    frame = bucket_keys(finer, key_columns)
+    weights = finer["interval_count"].astype(float)
+    for column in ENERGY_COLUMNS:
+        frame[column] = finer[column].astype(float)
+    for column in MEAN_COLUMNS:
+        values = finer[column].astype(float)
+        frame[column] = values * weights
+        frame[f"{column}_weight"] = weights.where(values.notna(), 0)
+    flags = finer["quality_flag"].fillna(0).astype(int)
+    for bit in QUALITY_BITS:
+        frame[f"quality_{bit}"] = flags & bit
+    frame["interval_count"] = weights
+
+    grouped = frame.groupby(key_columns, sort=False).sum(min_count=1)  # All-NULL stays NULL
+    for column in MEAN_COLUMNS:
+        grouped[column] = grouped[column] / grouped.pop(f"{column}_weight").where(lambda weight: weight > 0)
+    grouped["quality_flag"] = 0
+    for bit in QUALITY_BITS:
+        grouped["quality_flag"] |= (grouped.pop(f"quality_{bit}") > 0).astype(int) * bit
+    grouped[ENERGY_COLUMNS + MEAN_COLUMNS] = grouped[ENERGY_COLUMNS + MEAN_COLUMNS].round(3)
+    grouped["interval_count"] = grouped["interval_count"].astype(int)
+    return grouped.reset_index()
+
+
+# Function to recompute the rollup buckets touched by newly written 10-minute metrics rows, level by level.
+# Returns the number of buckets written per table.
+def update_rollups(conn, metrics, dialect="mssql"):
+    written = {}
+    touched = pd.DataFrame(metrics, columns=["device_id", "day", "hour"])
+    for table, key_columns, finer_table in ROLLUPS:
+        touched = bucket_keys(touched, key_columns).drop_duplicates()
+        if touched.empty:
+            break
+
+        finer = read_finer(conn, finer_table, key_columns, touched, dialect)
+        buckets = aggregate(finer, key_columns).merge(touched, on=key_columns)
+        columns = [*key_columns, *ENERGY_COLUMNS, *MEAN_COLUMNS, "interval_count", "quality_flag"]
+        values = buckets[columns].astype(object)
+        rows = list(values.where(values.notna(), None).itertuples(index=False, name=None))  # Plain Python values (NaN as NULL) for the driver
+        written[table], rejected = merge_rows(conn, table, columns, key_columns, rows, dialect)
+
+        # The next level reads this one back, keyed on the day of each bucket
+        touched = buckets[key_columns]
+    logging.info(f"Updated rollups: {written}.")
+    return written
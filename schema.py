@@ -0,0 +1,154 @@
+import logging
+
+# Idempotent DDL applied by the workers at start-up. Every statement checks the
+# current schema first, so running it against an up-to-date database is a no-op.
+
+# process_metadata row that metrics_calculator moves to the write time whenever it writes metrics rows,
+# so readers that cache device_consumption_metrics rows can tell when an interval was amended
+METRICS_AMENDED = "metrics_amended"
+
+# process_metadata row that metrics_calculator moves when a reprocess run rewrites closed intervals
+METRICS_REPROCESSED = "metrics_reprocessed"
+
+# process_metadata row holding metrics_calculator's restart point: the start of its oldest open interval.
+# Intervals starting before it are closed and only change again through a reprocess run.
+METRICS_WATERMARK = "metrics_calculator"
+
+# Source database (raw telegrams)
+SOURCE_SCHEMA = [
+    # Keyset pagination in batch_process reads mqtt_raw_data in (timestamp, id) order
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_mqtt_raw_data_timestamp_id')
+        CREATE INDEX IX_mqtt_raw_data_timestamp_id ON mqtt_raw_data (timestamp, id)
+    """,
+]
+
+# Value columns shared by the rollup tables of device_consumption_metrics
+_ROLLUP_VALUES = """
+            power_consumption FLOAT, reactive_energy_consumed FLOAT, tariff1_energy FLOAT, tariff2_energy FLOAT,
+            avg_phase1_voltage FLOAT, avg_phase2_voltage FLOAT, avg_phase3_voltage FLOAT,
+            avg_phase1_current FLOAT, avg_phase2_current FLOAT, avg_phase3_current FLOAT,
+            interval_count INT NOT NULL, quality_flag INT,"""
+
+
+def _rollup_table(table, key_definitions, key_columns):
+    return f"""
+    IF OBJECT_ID('{table}', 'U') IS NULL
+        CREATE TABLE {table} (
+            device_id NVARCHAR(100) NOT NULL, {key_definitions},{_ROLLUP_VALUES}
+            CONSTRAINT PK_{table} PRIMARY KEY ({key_columns})
+        )
+    """
+
+
+# Target database (parsed readings, metrics and process metadata)
+TARGET_SCHEMA = [
+    # Second half of the (timestamp, id) keyset cursor; NULL means "everything at last_fetched_timestamp is done"
+    """
+    IF COL_LENGTH('process_metadata', 'last_fetched_id') IS NULL
+        ALTER TABLE process_metadata ADD last_fetched_id BIGINT NULL
+    """,
+    # metrics_calculator streams the parsed readings in (timestamp, id) keyset pages
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_mqtt_raw_data_timestamp_id')
+        CREATE INDEX IX_mqtt_raw_data_timestamp_id ON mqtt_raw_data (timestamp, id)
+    """,
+    # Hourly, daily and monthly rollups maintained by metrics_calculator (see rollups.py)
+    _rollup_table("device_consumption_hourly", "day DATE NOT NULL, hour INT NOT NULL", "device_id, day, hour"),
+    _rollup_table("device_consumption_daily", "day DATE NOT NULL", "device_id, day"),
+    _rollup_table("device_consumption_monthly", "month DATE NOT NULL", "device_id, month"),
+    # Metrics are upserted on their interval key. The unique index is not built while intervals written
+    # twice before it exist; report_duplicate_intervals lists them so they can be merged first.
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'UX_device_consumption_metrics_interval')
+        AND NOT EXISTS (
+            SELECT 1 FROM device_consumption_metrics
+            GROUP BY device_id, day, hour, interval_start HAVING COUNT(*) > 1
+        )
+        CREATE UNIQUE INDEX UX_device_consumption_metrics_interval
+            ON device_consumption_metrics (device_id, day, hour, interval_start)
+    """,
+    # Rollover, reset and replacement bits of each interval (see interval_aggregator.py)
+    """
+    IF COL_LENGTH('device_consumption_metrics', 'quality_flag') IS NULL
+        ALTER TABLE device_consumption_metrics ADD quality_flag INT NULL
+    """,
+    # Rollups carry the bits of the intervals they cover
+    *(
+        f"""
+    IF COL_LENGTH('{table}', 'quality_flag') IS NULL
+        ALTER TABLE {table} ADD quality_flag INT NULL
+    """
+        for table in ("device_consumption_hourly", "device_consumption_daily", "device_consumption_monthly")
+    ),
+    # Dead letters: parsed rows the target rejected (bulk_writer isolates them), kept with their raw
+    # telegram for batch_process --replay-rejects once the cause is fixed
+    """
+    IF OBJECT_ID('mqtt_raw_data_rejects', 'U') IS NULL
+        CREATE TABLE mqtt_raw_data_rejects (
+            id BIGINT NOT NULL CONSTRAINT PK_mqtt_raw_data_rejects PRIMARY KEY,
+            device_id NVARCHAR(100), timestamp DATETIME2, data NVARCHAR(MAX),
+            error NVARCHAR(MAX), rejected_at DATETIME2 NOT NULL
+        )
+    """,
+    # Register maximum (the value it wraps to zero at) per device, where it differs from METER_MAX_VALUE
+    """
+    IF OBJECT_ID('meter_registry', 'U') IS NULL
+        CREATE TABLE meter_registry (
+            device_id NVARCHAR(100) NOT NULL CONSTRAINT PK_meter_registry PRIMARY KEY,
+            max_value FLOAT NOT NULL
+        )
+    """,
+    # Rollups read the intervals of the touched (device_id, day, hour) buckets (the hourly and daily
+    # levels read theirs through the primary keys). The earlier day-first index served range reads
+    # that scanned every device and is dropped.
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_device_consumption_metrics_device_day_hour')
+        CREATE INDEX IX_device_consumption_metrics_device_day_hour ON device_consumption_metrics (device_id, day, hour)
+    """,
+    """
+    IF EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_device_consumption_metrics_day_hour')
+        DROP INDEX IX_device_consumption_metrics_day_hour ON device_consumption_metrics
+    """,
+]
+
+
+# Function to apply a list of DDL statements on an open connection
+def ensure_schema(conn, statements):
+    try:
+        cursor = conn.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Error applying schema changes: {e}")
+        conn.rollback()
+
+
+# Function to log the metrics intervals stored more than once while the unique index is missing.
+# Returns the number of duplicated intervals (0 once the index exists).
+def report_duplicate_intervals(conn, limit=20):
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sys.indexes WHERE name = 'UX_device_consumption_metrics_interval'")
+        if cursor.fetchone():
+            return 0
+        cursor.execute("""
+            SELECT device_id, day, hour, interval_start, COUNT(*) AS copies, MIN(id), MAX(id)
+            FROM device_consumption_metrics
+            GROUP BY device_id, day, hour, interval_start HAVING COUNT(*) > 1
+            ORDER BY device_id, day, hour, interval_start
+        """)
+        duplicates = cursor.fetchall()
+        cursor.close()
+    except Exception as e:
+        logging.error(f"Error checking for duplicate metrics intervals: {e}")
+        return 0
+    if duplicates:
+        logging.error(
+            f"{len(duplicates)} metrics intervals are stored more than once, so UX_device_consumption_metrics_interval "
+            f"was not built and upserts update every copy. Merge or delete the extra rows, then restart."
+        )
+        for device_id, day, hour, interval_start, copies, first_id, last_id in duplicates[:limit]:
+            logging.error(f"Duplicate interval {device_id} {day} {hour:02d}:{interval_start:02d}: {copies} rows (ids {first_id}..{last_id})")
+    return len(duplicates)
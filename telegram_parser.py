@@ -0,0 +1,71 @@
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+
+# Declarative field table: (column name, OBIS code, unit) for every value we store.
+# A column is filled from the first matching OBIS object in the telegram.
+# Several columns may read the same OBIS code (tariff1_energy mirrors 1-0:1.8.0).
+FIELDS = [
+    ("total_energy_consumed", "1-0:1.8.0", "kWh"),
+    ("current_power_consumption", "1-0:1.7.0", "kW"),
+    ("phase1_energy", "1-0:21.7.0", "kW"),
+    ("phase2_energy", "1-0:41.7.0", "kW"),
+    ("phase3_energy", "1-0:61.7.0", "kW"),
+    ("phase1_voltage", "1-0:32.7.0", "V"),
+    ("phase2_voltage", "1-0:52.7.0", "V"),
+    ("phase3_voltage", "1-0:72.7.0", "V"),
+    ("phase1_current", "1-0:31.7.0", "A"),
+    ("phase2_current", "1-0:51.7.0", "A"),
+    ("phase3_current", "1-0:71.7.0", "A"),
+    ("reactive_energy_consumed", "1-0:3.8.0", "kVArh"),
+    ("tariff1_energy", "1-0:1.8.0", "kWh"),
+    ("tariff2_energy", "1-0:2.8.0", "kWh"),
+]
+
+FIELD_NAMES = [name for name, _, _ in FIELDS]
+
+# OBIS code -> [(column name, unit), ...]
+_FIELDS_BY_CODE = {}
+for _name, _code, _unit in FIELDS:
+    _FIELDS_BY_CODE.setdefault(_code, []).append((_name, _unit))
+
+# Any of the OBIS codes listed in FIELDS with its value and unit, e.g. "1-0:1.8.0(001234.567*kWh)".
+# Unrelated objects are skipped by the regex engine.
+_STORED_VALUE = re.compile(
+    r"(" + "|".join(re.escape(code) for code in _FIELDS_BY_CODE) + r")\((\d+\.\d+)\*(\w+)\)"
+)
+
+
+# Function to parse the data field into the stored columns (missing values are None)
+def parse_data(data):
+    parsed_data = dict.fromkeys(FIELD_NAMES)
+    try:
+        for code, value, unit in _STORED_VALUE.findall(data):
+            for name, expected_unit in _FIELDS_BY_CODE[code]:
+                if unit == expected_unit and parsed_data[name] is None:
+                    parsed_data[name] = float(value)
+    except Exception as e:
+        logging.error(f"Error parsing data: {e}")
+        parsed_data = {}  # Return an empty dict if parsing fails
+
+    return parsed_data
+
+
+# Function to parse a whole column of telegrams into float64 columns (missing values are NaN).
+# Each field gets one preallocated NaN array that the tokens of every telegram are written into,
+# without building a dict per row. (A single regex pass over the joined column measured slower.)
+def parse_column(telegrams):
+    index = telegrams.index if isinstance(telegrams, pd.Series) else pd.RangeIndex(len(telegrams))
+    columns = {name: np.full(len(index), np.nan) for name in FIELD_NAMES}
+    targets = {code: [(columns[name], unit) for name, unit in fields] for code, fields in _FIELDS_BY_CODE.items()}
+    for row, data in enumerate(telegrams):
+        if not isinstance(data, str):
+            continue
+        # Written last to first, so a field keeps its first matching object as in parse_data
+        for code, value, unit in reversed(_STORED_VALUE.findall(data)):
+            for column, expected_unit in targets[code]:
+                if unit == expected_unit:
+                    column[row] = float(value)
+    return pd.DataFrame(columns, index=index)
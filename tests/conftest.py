@@ -0,0 +1,78 @@
+import pytest
+
+import db_pool
+from batch_process import parsed_columns
+from interval_aggregator import METRIC_COLUMNS
+from rollups import ENERGY_COLUMNS, MEAN_COLUMNS, ROLLUPS
+
+# SQLite versions of the tables the services read and write. Columns come from the lists the code
+# writes with, and the keys and indexes follow schema.py, so the tests fail when the two drift apart.
+
+SOURCE_TABLES = [
+    "CREATE TABLE mqtt_raw_data (id INTEGER PRIMARY KEY, device_id TEXT, timestamp TIMESTAMP, processed INTEGER, data TEXT)",
+    "CREATE INDEX IX_mqtt_raw_data_timestamp_id ON mqtt_raw_data (timestamp, id)",
+]
+
+_METRIC_TYPES = {"device_id": "TEXT", "day": "DATE", "hour": "INTEGER", "interval_start": "INTEGER", "quality_flag": "INTEGER"}
+
+TARGET_TABLES = [
+    f"""
+    CREATE TABLE mqtt_raw_data (
+        id INTEGER PRIMARY KEY, device_id TEXT, timestamp TIMESTAMP, processed INTEGER,
+        {", ".join(f"{column} REAL" for column in parsed_columns[4:])}
+    )
+    """,
+    "CREATE INDEX IX_mqtt_raw_data_timestamp_id ON mqtt_raw_data (timestamp, id)",
+    f"""
+    CREATE TABLE device_consumption_metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        {", ".join(f"{column} {_METRIC_TYPES.get(column, 'REAL')}" for column in METRIC_COLUMNS)}
+    )
+    """,
+    "CREATE UNIQUE INDEX UX_device_consumption_metrics_interval ON device_consumption_metrics (device_id, day, hour, interval_start)",
+    "CREATE INDEX IX_device_consumption_metrics_device_day_hour ON device_consumption_metrics (device_id, day, hour)",
+    *(
+        f"""
+        CREATE TABLE {table} (
+            device_id TEXT NOT NULL, {"month DATE NOT NULL" if "month" in key_columns else "day DATE NOT NULL"},
+            {"hour INTEGER NOT NULL," if "hour" in key_columns else ""}
+            {", ".join(f"{column} REAL" for column in ENERGY_COLUMNS + MEAN_COLUMNS)},
+            interval_count INTEGER NOT NULL, quality_flag INTEGER,
+            PRIMARY KEY ({", ".join(key_columns)})
+        )
+        """
+        for table, key_columns, _ in ROLLUPS
+    ),
+    """
+    CREATE TABLE mqtt_raw_data_rejects (
+        id INTEGER PRIMARY KEY, device_id TEXT, timestamp TIMESTAMP, data TEXT, error TEXT, rejected_at TIMESTAMP NOT NULL
+    )
+    """,
+    "CREATE TABLE meter_registry (device_id TEXT PRIMARY KEY, max_value REAL NOT NULL)",
+    "CREATE TABLE process_metadata (process_name TEXT PRIMARY KEY, last_fetched_timestamp TIMESTAMP, last_fetched_id INTEGER)",
+]
+
+
+# Source and target pools on fresh SQLite databases, for every test that uses them
+@pytest.fixture
+def standins(tmp_path):
+    for name, tables in (("source", SOURCE_TABLES), ("target", TARGET_TABLES)):
+        pool = db_pool.register_pool(name, db_pool.sqlite_backend(str(tmp_path / f"{name}.db")), replace=True)
+        with pool.connection() as conn:
+            for statement in tables:
+                conn.execute(statement)
+            conn.commit()
+    return tmp_path
+
+
+# Function to insert source rows (dicts as made by benchmarks.telegram_generator) into the source stand-in
+@pytest.fixture
+def load_source(standins):
+    def load(rows):
+        with db_pool.connection("source") as conn:
+            conn.executemany(
+                "INSERT INTO mqtt_raw_data (id, device_id, timestamp, processed, data) VALUES (?, ?, ?, ?, ?)",
+                [(row["id"], row["device_id"], row["timestamp"], row["processed"], row["data"]) for row in rows],
+            )
+            conn.commit()
+    return load
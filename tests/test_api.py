@@ -0,0 +1,50 @@
+import contextlib
+import json
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("httpx")  # Needed by the FastAPI test client
+from fastapi.testclient import TestClient
+
+import api
+from benchmarks.telegram_generator import generate_rows
+
+
+@pytest.fixture
+def frames(monkeypatch):
+    # api.py reads the source with SQL Server paging; the tests feed it the fetched chunks instead
+    rows = [{**row, "processed": bool(row["processed"])} for row in generate_rows(30, devices=3)]
+    chunks = [pd.DataFrame(rows[i:i + 12]) for i in range(0, len(rows), 12)]
+    monkeypatch.setattr(api, "fetch_frames", lambda query: iter(chunks))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def test_data_streams_ndjson(frames):
+    response = TestClient(api.app).get("/data", headers={"Accept": "application/x-ndjson"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert records == json.loads(json.dumps(api.build_records(frames), default=lambda value: value.isoformat()))
+
+
+@pytest.mark.parametrize("accept", ["application/vnd.apache.arrow.stream", "application/vnd.apache.parquet"])
+def test_data_negotiates_arrow_and_parquet(frames, accept):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    response = TestClient(api.app).get("/data", headers={"Accept": accept})
+    assert response.headers["content-type"] == accept
+    buffer = pa.py_buffer(response.content)
+    table = pa.ipc.open_stream(buffer).read_all() if "arrow" in accept else pq.read_table(buffer)
+    assert table.schema == api.parquet_store.arrow_schema()
+    assert table.column("id").to_pylist() == frames["id"].tolist()
+    assert table.column("total_energy_consumed").to_pylist() == [row["total_energy_consumed"] for row in api.build_records(frames)]
+
+
+def test_data_is_json_without_an_accepted_format(frames, monkeypatch):
+    monkeypatch.setattr(api, "pa", None)  # As without pyarrow installed
+    monkeypatch.setattr(api.pd, "read_sql", lambda query, conn: frames)
+    monkeypatch.setattr(api.db_pool, "connection", lambda name: contextlib.nullcontext())
+    response = TestClient(api.app).get("/data", headers={"Accept": "application/vnd.apache.arrow.stream"})
+    assert response.headers["content-type"] == "application/json"
+    assert [record["id"] for record in response.json()] == frames["id"].tolist()
@@ -0,0 +1,169 @@
+import json
+from datetime import date, datetime
+
+import pytest
+
+pytest.importorskip("httpx")  # Needed by the FastAPI test client
+from fastapi.testclient import TestClient
+
+import apiagg
+import db_pool
+import metrics_calculator
+from interval_aggregator import METRIC_COLUMNS
+
+
+def metric(device_id, day, hour, interval_start, power):
+    row = dict.fromkeys(METRIC_COLUMNS, 0.0)
+    row.update(device_id=device_id, day=day, hour=hour, interval_start=interval_start, power_consumption=power, quality_flag=0)
+    return row
+
+
+@pytest.fixture
+def client(standins, monkeypatch):
+    monkeypatch.setattr(apiagg, "response_cache_dir", str(standins / "responses"))
+    monkeypatch.setattr(apiagg, "amended_check_seconds", 0)
+    monkeypatch.setattr(apiagg, "_metrics_version_checked", None)
+    apiagg._row_cache.clear()
+    metrics = [
+        metric(device_id, day, hour, minute, float(hour))
+        for device_id in ("a", "b", "c")
+        for day in (date(2025, 1, 1), date(2025, 1, 2))
+        for hour in (6, 7, 8, 9)
+        for minute in (0, 10)
+    ]
+    assert metrics_calculator.upsert_metrics(metrics)
+    return TestClient(apiagg.app)
+
+
+def test_data_filters_and_projects(client):
+    params = {"device_id": ["b", "a"], "start_day": "2025-01-02", "start_hour": 7, "end_hour": 8, "columns": "device_id,hour,power_consumption"}
+    rows = client.get("/data", params=params).json()
+    assert len(rows) == 2 * 2 * 2
+    assert {row["device_id"] for row in rows} == {"a", "b"}
+    assert {row["hour"] for row in rows} == {7, 8}
+    assert all(set(row) == {"id", "device_id", "hour", "power_consumption"} for row in rows)
+    assert [row["id"] for row in rows] == sorted(row["id"] for row in rows)
+
+    assert client.get("/data", params={"columns": "nope"}).status_code == 400
+    assert client.get("/data", params={"start_hour": 24}).status_code == 422
+
+
+def test_data_pages_by_cursor(client):
+    everything = client.get("/data").json()
+    pages, cursor = [], None
+    while True:
+        response = client.get("/data", params={"limit": 10, **({"cursor": cursor} if cursor else {})})
+        pages += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert pages == everything
+
+
+def test_data_revalidates_with_etag(client, monkeypatch):
+    first = client.get("/data", params={"device_id": "a"})
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and first.headers["Last-Modified"]
+
+    # Unchanged metrics: 304, or the cached body for the same query in any order, without a query
+    queries = []
+    fetch_data_from_db = apiagg.fetch_data_from_db
+    monkeypatch.setattr(apiagg, "fetch_data_from_db", lambda *args: queries.append(args) or fetch_data_from_db(*args))
+    assert client.get("/data", params={"device_id": "a"}, headers={"If-None-Match": etag}).status_code == 304
+    cached = client.get("/data", params={"device_id": ["a", "a"]})
+    assert cached.headers["ETag"] == etag and cached.content == first.content
+    assert queries == []
+
+    # A metrics write changes the version, so the old ETag gets the new rows
+    assert metrics_calculator.upsert_metrics([metric("a", date(2025, 1, 1), 6, 0, 99.0)])
+    changed = client.get("/data", params={"device_id": "a"}, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()[0]["power_consumption"] == 99.0
+    assert len(queries) == 1
+
+
+def test_if_modified_since_needs_the_full_version(client, monkeypatch):
+    versions = iter([datetime(2025, 1, 2, 12), datetime(2025, 1, 2, 12), datetime(2025, 1, 2, 12, 0, 0, 400000), datetime(2025, 1, 2, 12, 0, 0, 400000)])
+    monkeypatch.setattr(apiagg, "metrics_version", lambda: next(versions))
+    first = client.get("/data", params={"device_id": "a"})
+    last_modified = first.headers["Last-Modified"]
+    assert client.get("/data", params={"device_id": "a"}, headers={"If-Modified-Since": last_modified}).status_code == 304
+
+    # A write later in the same second has the same Last-Modified, but is still a change
+    changed = client.get("/data", params={"device_id": "a"}, headers={"If-Modified-Since": last_modified})
+    assert changed.status_code == 200 and changed.headers["Last-Modified"] == last_modified
+
+    # If-None-Match decides when both are sent, even with a date that would match
+    stale = client.get("/data", params={"device_id": "a"}, headers={"If-None-Match": first.headers["ETag"], "If-Modified-Since": "Fri, 03 Jan 2025 00:00:00 GMT"})
+    assert stale.status_code == 200
+
+
+def test_closed_rows_are_served_from_the_row_cache(client):
+    rows = {(row["day"], row["hour"], row["interval_start"], row["device_id"]): row["id"] for row in client.get("/data").json()}
+    closed, still_open = rows[("2025-01-01", 6, 0, "a")], rows[("2025-01-02", 9, 10, "a")]
+    metrics_calculator.get_last_processed_timestamp()  # Creates the watermark row
+    metrics_calculator.update_last_processed_timestamp(datetime(2025, 1, 2))
+
+    assert client.get(f"/data/{closed}").json()["power_consumption"] == 6.0
+    assert client.get(f"/data/{still_open}").json()["power_consumption"] == 9.0
+    assert list(apiagg._row_cache) == [closed]
+    assert client.get("/data/999999").status_code == 404
+
+    # A reprocess run rewrites closed intervals: only then is the cached row dropped
+    with db_pool.connection("target") as conn:
+        conn.execute("UPDATE device_consumption_metrics SET power_consumption = 60.0 WHERE id = ?", (closed,))
+        conn.commit()
+    assert client.get(f"/data/{closed}").json()["power_consumption"] == 6.0
+    with db_pool.connection("target") as conn:
+        metrics_calculator.touch_marker(conn, metrics_calculator.METRICS_REPROCESSED, "sqlite")
+    assert client.get(f"/data/{closed}").json()["power_consumption"] == 60.0
+
+
+def test_data_streams_ndjson(client, monkeypatch):
+    monkeypatch.setattr(apiagg, "stream_chunk_rows", 7)  # Several chunks
+    params = {"device_id": "b", "columns": "day,hour,power_consumption"}
+    response = client.get("/data", params=params, headers={"Accept": "application/x-ndjson"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line) for line in response.text.splitlines()] == client.get("/data", params=params).json()
+
+
+@pytest.mark.parametrize("accept", ["application/vnd.apache.arrow.stream", "application/vnd.apache.parquet"])
+def test_data_negotiates_arrow_and_parquet(client, monkeypatch, accept):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    monkeypatch.setattr(apiagg, "stream_chunk_rows", 7)
+    params = {"device_id": ["a", "c"], "columns": "device_id,day,hour,power_consumption"}
+    response = client.get("/data", params=params, headers={"Accept": f"{accept}, application/json;q=0.5"})
+    assert response.headers["content-type"] == accept
+    assert response.headers["ETag"] != client.get("/data", params=params).headers["ETag"]  # Cached per format
+
+    buffer = pa.py_buffer(response.content)
+    table = pa.ipc.open_stream(buffer).read_all() if "arrow" in accept else pq.read_table(buffer)
+    assert table.schema.names == ["id", "device_id", "day", "hour", "power_consumption"]
+    assert table.to_pylist() == client.get("/data", params=params).json()
+
+
+def test_api_client_loads_arrow_and_reuses_unchanged_results(client, monkeypatch):
+    pytest.importorskip("pyarrow")
+    import api_client
+
+    responses = []
+
+    class Session:
+        def get(self, *args, **kwargs):
+            responses.append(client.get(*args, **kwargs))
+            return responses[-1]
+
+    monkeypatch.setattr(api_client, "_session", Session())
+    monkeypatch.setattr(api_client, "_cache", {})
+    monkeypatch.setattr(api_client, "api_url", "")
+
+    params = {"device_id": "a", "columns": "day,hour,power_consumption"}
+    first = api_client.fetch_data(**params)
+    assert first.to_dict("records") == client.get("/data", params=params).json()
+    again = api_client.fetch_data(**params)
+    assert again.equals(first) and again is not first
+    assert [response.status_code for response in responses] == [200, 304]
+    assert responses[0].headers["content-type"] == api_client.ARROW_STREAM
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import backfill
+import batch_process
+import db_pool
+from benchmarks.telegram_generator import generate_rows
+
+
+def stored_ids():
+    with db_pool.connection("target") as conn:
+        return {row[0] for row in conn.execute("SELECT id FROM mqtt_raw_data")}
+
+
+def test_split_range_covers_the_range_once():
+    start = datetime(2025, 1, 1)
+    assert backfill.split_range(start, start + timedelta(hours=5), timedelta(hours=2)) == [
+        (start, start + timedelta(hours=2)),
+        (start + timedelta(hours=2), start + timedelta(hours=4)),
+        (start + timedelta(hours=4), start + timedelta(hours=5)),
+    ]
+
+
+def test_interrupted_chunk_resumes_from_its_checkpoint(load_source, monkeypatch):
+    rows = list(generate_rows(200, devices=4))
+    load_source(rows)
+    chunk_start, chunk_end = rows[20]["timestamp"], rows[150]["timestamp"]
+    expected = {row["id"] for row in rows if chunk_start <= row["timestamp"] < chunk_end}
+
+    # The third batch is not committed: the run stops after the checkpoint of the second
+    insert_parsed_data = batch_process.insert_parsed_data
+    batches = []
+    monkeypatch.setattr(batch_process, "insert_parsed_data", lambda parsed: (batches.append(parsed) or len(batches) < 3) and insert_parsed_data(parsed))
+    with pytest.raises(RuntimeError):
+        backfill.backfill_chunk(chunk_start, chunk_end, batch_size=25)
+    assert len(stored_ids()) == 50
+
+    monkeypatch.setattr(batch_process, "insert_parsed_data", insert_parsed_data)
+    assert backfill.backfill_chunk(chunk_start, chunk_end, batch_size=25) == len(expected) - 50
+    assert stored_ids() == expected
+    assert backfill.backfill_chunk(chunk_start, chunk_end, batch_size=25) == 0  # Done chunks are skipped
+    assert batch_process.get_last_fetched_position()[1] is None  # The live watermark is not touched
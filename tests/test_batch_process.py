@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import batch_process
+import db_pool
+from benchmarks.telegram_generator import generate_rows
+
+
+def fetch_all(batch_size, until_timestamp=None):
+    fetched, timestamp, row_id = [], datetime(2000, 1, 1), None
+    while True:
+        rows = batch_process.fetch_rows(timestamp, row_id, batch_size, until_timestamp)
+        if not rows:
+            return fetched
+        fetched += rows
+        timestamp, row_id = rows[-1]["timestamp"], rows[-1]["id"]
+
+
+def test_fetch_rows_pages_through_timestamp_ties(load_source):
+    # Seven rows share every timestamp, so most batches end inside a run of ties
+    start = datetime(2025, 1, 1)
+    rows = [
+        {"id": 100 - i, "device_id": f"device-{i % 7}", "timestamp": start + timedelta(seconds=i // 7), "processed": 0, "data": ""}
+        for i in range(50)
+    ]
+    load_source(rows)
+
+    for batch_size in (1, 3, 7, 10, 100):
+        fetched = fetch_all(batch_size)
+        assert [row["id"] for row in fetched] == [row["id"] for row in sorted(rows, key=lambda row: (row["timestamp"], row["id"]))]
+
+    until = start + timedelta(seconds=3)
+    assert {row["id"] for row in fetch_all(4, until)} == {row["id"] for row in rows if row["timestamp"] < until}
+
+
+def test_batch_size_adapts_to_the_backlog(monkeypatch):
+    monkeypatch.setattr(batch_process, "min_batch_size", 100)
+    monkeypatch.setattr(batch_process, "max_batch_size", 400)
+    assert batch_process.next_batch_size(100, 100) == 200
+    assert batch_process.next_batch_size(300, 300) == 400
+    assert batch_process.next_batch_size(200, 150) == 200
+    assert batch_process.next_batch_size(400, 10) == 200
+    assert batch_process.next_batch_size(100, 0) == 100
+
+
+def test_insert_parsed_data_keeps_rejects_for_replay(standins):
+    data = batch_process.parse_batch(list(generate_rows(20, devices=2)))
+    with db_pool.connection("target") as conn:
+        conn.execute("""
+            CREATE TRIGGER reject_row BEFORE INSERT ON mqtt_raw_data
+            WHEN NEW.id = 5 BEGIN SELECT RAISE(ABORT, 'bad row'); END
+        """)
+        conn.commit()
+
+    assert batch_process.insert_parsed_data(data)
+    with db_pool.connection("target") as conn:
+        assert conn.execute("SELECT COUNT(*) FROM mqtt_raw_data").fetchone()[0] == len(data) - 1
+        assert conn.execute("SELECT id, data FROM mqtt_raw_data_rejects").fetchall() == [(5, data[4]["data"])]
+        conn.execute("DROP TRIGGER reject_row")
+        conn.commit()
+
+    assert batch_process.replay_rejects() == (data[4]["timestamp"], data[4]["timestamp"])
+    with db_pool.connection("target") as conn:
+        assert conn.execute("SELECT COUNT(*) FROM mqtt_raw_data").fetchone()[0] == len(data)
+        assert conn.execute("SELECT COUNT(*) FROM mqtt_raw_data_rejects").fetchone()[0] == 0
+
+
+def test_watermark_round_trip(standins):
+    default_timestamp, default_id = batch_process.get_last_fetched_position()
+    assert default_id is None and default_timestamp.tzinfo is None
+    assert batch_process.get_last_fetched_position() == (default_timestamp, None)  # Stored, not recomputed
+
+    batch_process.update_last_fetched_position(datetime(2025, 1, 1, 12, 30), 42)
+    assert batch_process.get_last_fetched_position() == (datetime(2025, 1, 1, 12, 30), 42)
+
+
+def test_sharded_parsing_matches_parse_batch(monkeypatch):
+    monkeypatch.setattr(batch_process, "parse_processes", 3)
+    rows = list(generate_rows(300, devices=7))
+    executor = ProcessPoolExecutor(max_workers=3, mp_context=batch_process.worker_context)
+    try:
+        assert batch_process.parse_batch_sharded(rows, executor) == batch_process.parse_batch(rows)
+    finally:
+        batch_process.stop_parse_workers(executor)
+
+
+# Function to run write_target over batches queued in the given sequence order; returns the calls it made
+def write_batches(monkeypatch, order, failing=None):
+    calls = []
+    monkeypatch.setattr(batch_process, "insert_parsed_data", lambda rows: calls.append(("insert", rows[0])) or rows[0] != failing)
+    monkeypatch.setattr(batch_process, "update_last_fetched_position", lambda timestamp, row_id: calls.append(("watermark", row_id)))
+    monkeypatch.setattr(batch_process.watermark_signal, "notify", lambda timestamp: None)
+
+    write_queue, stop_event = queue.Queue(), threading.Event()
+    for sequence in order:
+        write_queue.put((sequence, [sequence], (datetime(2025, 1, 1), sequence)))
+    writer = threading.Thread(target=batch_process.write_target, args=(write_queue, stop_event))
+    writer.start()
+    while not (write_queue.empty() or stop_event.is_set()):
+        time.sleep(0.01)
+    time.sleep(0.05)  # Lets the writer finish the last batch it took
+    stop_event.set()
+    writer.join()
+    return calls
+
+
+def test_writer_commits_in_fetch_order_before_moving_the_watermark(monkeypatch):
+    calls = write_batches(monkeypatch, [2, 0, 3, 1])
+    assert calls == [call for sequence in range(4) for call in (("insert", sequence), ("watermark", sequence))]
+
+
+def test_writer_stops_at_an_uncommitted_batch(monkeypatch):
+    calls = write_batches(monkeypatch, [1, 0, 2], failing=1)
+    assert calls == [("insert", 0), ("watermark", 0), ("insert", 1)]
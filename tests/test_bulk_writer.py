@@ -0,0 +1,40 @@
+import db_pool
+from bulk_writer import merge_rows
+
+COLUMNS = ["process_name", "last_fetched_timestamp", "last_fetched_id"]
+
+
+def stored(conn):
+    return dict((name, last_id) for name, _, last_id in conn.execute(f"SELECT {', '.join(COLUMNS)} FROM process_metadata"))
+
+
+def test_merge_rows_inserts_and_updates(standins):
+    with db_pool.connection("target") as conn:
+        assert merge_rows(conn, "process_metadata", COLUMNS, ["process_name"], [("a", None, 1), ("b", None, 2)], "sqlite") == (2, [])
+        written, rejected = merge_rows(conn, "process_metadata", COLUMNS, ["process_name"], [("b", None, 20), ("c", None, 3)], "sqlite")
+        assert (written, rejected) == (2, [])
+        assert stored(conn) == {"a": 1, "b": 20, "c": 3}
+
+
+def test_merge_rows_keeps_the_last_duplicate_key(standins):
+    with db_pool.connection("target") as conn:
+        written, _ = merge_rows(conn, "process_metadata", COLUMNS, ["process_name"], [("a", None, 1), ("a", None, 2)], "sqlite")
+        assert written == 1
+        assert stored(conn) == {"a": 2}
+
+
+def test_merge_rows_isolates_bad_rows(standins):
+    with db_pool.connection("target") as conn:
+        # Negative ids stand for rows the database refuses
+        conn.execute("""
+            CREATE TRIGGER reject_negative BEFORE INSERT ON process_metadata
+            WHEN NEW.last_fetched_id < 0 BEGIN SELECT RAISE(ABORT, 'negative id'); END
+        """)
+        conn.commit()
+        rows = [(f"p{i:02d}", None, -i if i in (3, 4, 17) else i) for i in range(20)]
+        written, rejected = merge_rows(conn, "process_metadata", COLUMNS, ["process_name"], rows, "sqlite")
+
+        assert written == 17
+        assert sorted(row[0] for row, _ in rejected) == ["p03", "p04", "p17"]
+        assert all("negative id" in str(error) for _, error in rejected)
+        assert stored(conn) == {f"p{i:02d}": i for i in range(20) if i not in (3, 4, 17)}
@@ -0,0 +1,45 @@
+import pytest
+
+import db_pool
+
+
+def test_connections_are_reused_and_rolled_back():
+    pool = db_pool.ConnectionPool("test", db_pool.sqlite_backend(), max_size=2)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.commit()
+        conn.execute("INSERT INTO t VALUES (1)")  # Not committed: discarded on release
+        first = conn
+    with pool.connection() as conn:
+        assert conn is first
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+    assert pool.metrics()["created"] == 1 and pool.metrics()["reused"] == 1
+
+
+def test_dead_connections_are_replaced_on_checkout():
+    pool = db_pool.ConnectionPool("test", db_pool.sqlite_backend(), check_after=0)
+    with pool.connection() as conn:
+        dead = conn
+    dead.close()
+    with pool.connection() as conn:
+        assert conn is not dead
+        conn.execute("SELECT 1")
+    assert pool.metrics()["failed_checks"] == 1
+
+
+def test_acquire_times_out_at_max_size():
+    pool = db_pool.ConnectionPool("test", db_pool.sqlite_backend(), max_size=1, acquire_timeout=0.05)
+    with pool.connection():
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+    with pool.connection():
+        pass
+    assert pool.metrics()["in_use"] == 0
+
+
+def test_register_pool_keeps_an_existing_pool_unless_replaced():
+    first = db_pool.register_pool("test-register", db_pool.sqlite_backend())
+    assert db_pool.register_pool("test-register", db_pool.sqlite_backend()) is first
+    assert db_pool.register_pool("test-register", db_pool.sqlite_backend(), replace=True) is not first
+    with pytest.raises(KeyError):
+        db_pool.get_pool("no-such-pool")
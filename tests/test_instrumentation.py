@@ -0,0 +1,67 @@
+import urllib.request
+
+import pytest
+
+import db_pool
+import instrumentation
+
+
+@pytest.fixture
+def recording(monkeypatch):
+    monkeypatch.setattr(instrumentation, "enabled", True)
+    for registry in ("_counters", "_gauges", "_histograms"):
+        monkeypatch.setattr(instrumentation, registry, {})
+    monkeypatch.setattr(db_pool, "_pools", {})
+
+
+def test_disabled_hooks_record_nothing(monkeypatch):
+    monkeypatch.setattr(instrumentation, "enabled", False)
+    instrumentation.inc("disabled_total")
+    instrumentation.observe("disabled_seconds", 1.0)
+    with instrumentation.timer("disabled_seconds"):
+        pass
+    assert "disabled" not in instrumentation.render()
+
+
+def test_render_in_prometheus_text_format(recording):
+    instrumentation.inc("rows_total", 3)
+    instrumentation.inc("rows_total")
+    instrumentation.set_gauge("queue_depth", 2)
+    for seconds in (0.001, 0.3, 100):
+        instrumentation.observe("batch_seconds", seconds)
+    db_pool.register_pool("test", db_pool.sqlite_backend())
+
+    lines = instrumentation.render().splitlines()
+    assert "rows_total 4" in lines and "queue_depth 2" in lines
+    assert 'batch_seconds_bucket{le="0.005"} 1' in lines
+    assert 'batch_seconds_bucket{le="0.5"} 2' in lines
+    assert 'batch_seconds_bucket{le="+Inf"} 3' in lines
+    assert "batch_seconds_count 3" in lines
+    assert 'db_pool_created{pool="test"} 0' in lines
+
+
+def test_worker_metrics_merge_into_the_parent(recording):
+    instrumentation.inc("rows_total", 2)
+    instrumentation.observe("batch_seconds", 0.02)
+    snapshot = instrumentation.drain()
+    assert instrumentation.drain() == {"counters": {}, "gauges": {}, "histograms": {}}
+
+    instrumentation.inc("rows_total", 1)
+    instrumentation.merge(snapshot)
+    instrumentation.merge(snapshot)
+    assert instrumentation._counters == {"rows_total": 5}
+    assert instrumentation._histograms["batch_seconds"][2] == 2
+
+
+def test_metrics_endpoint(recording, monkeypatch):
+    monkeypatch.setattr(instrumentation, "port", "0")  # Any free port
+    monkeypatch.setattr(instrumentation, "_server", None)
+    instrumentation.inc("served_total")
+    instrumentation.start_server()
+    try:
+        host, port = instrumentation._server.server_address
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+            assert "served_total 1" in response.read().decode().splitlines()
+    finally:
+        instrumentation._server.shutdown()
+        instrumentation._server.server_close()
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import interval_aggregator
+from interval_aggregator import (
+    QUALITY_REPLACED, QUALITY_RESET, QUALITY_ROLLOVER, QUALITY_WIDENED, READINGS, REGISTERS, IntervalAggregator,
+)
+
+START = datetime(2025, 1, 1)
+
+
+def reading(device_id, minutes, total, voltage=230.0):
+    row = {"device_id": device_id, "timestamp": START + timedelta(minutes=minutes), **{column: None for column in REGISTERS + READINGS}}
+    row.update(total_energy_consumed=total, tariff1_energy=total, tariff2_energy=1.0, reactive_energy_consumed=1.0, phase1_voltage=voltage)
+    return row
+
+
+# Function to feed each device's totals, one reading every 5 minutes, and return {(device, interval minute): metric}
+def run(totals, batch_rows=None):
+    rows = sorted(
+        (reading(device_id, 5 * i, total) for device_id, values in totals.items() for i, total in enumerate(values)),
+        key=lambda row: row["timestamp"],
+    )
+    aggregator = IntervalAggregator()
+    batch_rows = batch_rows or len(rows)
+    metrics = []
+    for i in range(0, len(rows), batch_rows):
+        metrics += aggregator.process(rows[i:i + batch_rows], provisional=False)
+    metrics += aggregator.close_all()
+    return {(metric["device_id"], metric["hour"] * 60 + metric["interval_start"]): metric for metric in metrics}, aggregator
+
+
+def test_plain_deltas_chain_across_intervals():
+    metrics, _ = run({"a": [100.0, 100.2, 100.5, 100.6]})
+    assert metrics[("a", 0)]["power_consumption"] == pytest.approx(0.2)
+    assert metrics[("a", 10)]["power_consumption"] == pytest.approx(0.4)  # Measured from the last reading before it
+    assert metrics[("a", 10)]["avg_phase1_voltage"] == 230.0
+    assert all(metric["quality_flag"] == 0 for metric in metrics.values())
+
+
+def test_register_changes_are_classified():
+    metrics, _ = run({
+        "rollover": [9999.8, 9999.9, 0.1, 0.2],
+        "reset": [5000.0, 5000.2, 0.1, 0.3],
+        "replaced_down": [5000.0, 5000.2, 2500.0, 2500.3],
+        "replaced_up": [100.0, 100.2, 7000.0, 7000.1],
+    })
+    rollover = metrics[("rollover", 10)]
+    assert rollover["quality_flag"] == QUALITY_ROLLOVER
+    assert rollover["power_consumption"] == pytest.approx(0.3)  # Wraps at 10000
+    assert metrics[("reset", 10)]["quality_flag"] == QUALITY_RESET
+    assert metrics[("replaced_down", 10)]["quality_flag"] == QUALITY_REPLACED
+    assert metrics[("replaced_up", 10)]["quality_flag"] == QUALITY_REPLACED
+    for device_id in ("reset", "replaced_down", "replaced_up"):
+        assert metrics[(device_id, 10)]["power_consumption"] is None
+        assert metrics[(device_id, 0)]["quality_flag"] == 0
+
+
+@pytest.mark.parametrize("batch_rows", [None, 1, 3])
+def test_register_widens_only_on_persisting_readings(batch_rows):
+    metrics, aggregator = run({
+        "wide": [99999.0, 99999.5, 99999.7, 99999.9, 0.3, 0.6],
+        "spike": [5000.0, 5000.1, 12000.0, 5000.2, 5000.3, 5000.4],
+    }, batch_rows)
+    assert aggregator.widened == {"wide": 100000.0}
+    assert [metrics[("wide", minute)]["quality_flag"] for minute in (0, 10, 20)] == [0, QUALITY_WIDENED, QUALITY_ROLLOVER]
+    assert metrics[("wide", 20)]["power_consumption"] == pytest.approx(0.7)
+    assert all(metrics[("spike", minute)]["quality_flag"] == 0 for minute in (0, 10, 20))
+
+
+def test_refetched_rows_are_not_counted_twice():
+    aggregator = IntervalAggregator()
+    rows = [reading("a", minutes, 100.0 + minutes / 10) for minutes in (0, 5, 10, 15)]
+    first = aggregator.process(rows[:3], provisional=False)
+    again = aggregator.process(rows, provisional=False) + aggregator.close_all()
+    assert aggregator.skipped == 3
+    assert [metric["power_consumption"] for metric in first + again] == [pytest.approx(0.5), pytest.approx(1.0)]
+
+
+def test_quiet_device_closes_after_grace(monkeypatch):
+    monkeypatch.setattr(interval_aggregator, "close_grace", timedelta(minutes=5))
+    aggregator = IntervalAggregator()
+    aggregator.process([reading("quiet", 0, 1.0), reading("quiet", 5, 1.1)], provisional=False)
+    assert aggregator.watermark() == START
+    closed = aggregator.process([reading("busy", 20, 1.0)], provisional=False)
+    assert [metric["device_id"] for metric in closed] == ["quiet"]
+    assert aggregator.watermark() == START + timedelta(minutes=20)
+
+
+def test_open_intervals_are_emitted_as_provisional_rows():
+    aggregator = IntervalAggregator()
+    provisional = aggregator.process([reading("a", 0, 100.0), reading("a", 5, 100.2)])
+    assert [(metric["interval_start"], metric["power_consumption"]) for metric in provisional] == [(0, pytest.approx(0.2))]
+    final = aggregator.process([reading("a", 10, 100.3)], provisional=False)
+    assert [(metric["interval_start"], metric["power_consumption"]) for metric in final] == [(0, pytest.approx(0.2))]
+    assert list(aggregator.open) == ["a"]
@@ -0,0 +1,66 @@
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+import batch_process
+import db_pool
+import metrics_calculator
+from benchmarks.telegram_generator import generate_rows
+from interval_aggregator import IntervalAggregator
+
+
+def test_watermark_round_trip(standins):
+    default_timestamp = metrics_calculator.get_last_processed_timestamp()
+    assert default_timestamp.tzinfo is None
+    assert metrics_calculator.get_last_processed_timestamp() == default_timestamp  # Stored, not recomputed
+
+    metrics_calculator.update_last_processed_timestamp(datetime(2025, 1, 1, 12, 30))
+    assert metrics_calculator.get_last_processed_timestamp() == datetime(2025, 1, 1, 12, 30)
+
+
+# Function to read and then clear the metrics and rollups written so far
+def take_metrics():
+    with db_pool.connection("target") as conn:
+        metrics = conn.execute("SELECT * FROM device_consumption_metrics ORDER BY device_id, day, hour, interval_start").fetchall()
+        daily = conn.execute("SELECT * FROM device_consumption_daily ORDER BY device_id, day").fetchall()
+        for table in ("device_consumption_metrics", "device_consumption_hourly", "device_consumption_daily", "device_consumption_monthly"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.commit()
+    return [row[1:] for row in metrics], daily  # Without the autoincrement id
+
+
+def test_sharded_workers_write_what_one_process_writes(standins):
+    rows = batch_process.parse_batch(list(generate_rows(2000, devices=8)))
+    assert batch_process.insert_parsed_data(rows)
+    start = rows[0]["timestamp"] - timedelta(seconds=1)
+    chunks = [pd.DataFrame(rows[i:i + 500]) for i in range(0, len(rows), 500)]
+
+    aggregator = IntervalAggregator()
+    for data in chunks:
+        assert metrics_calculator.calculate_and_insert_metrics(data, aggregator)
+    single = take_metrics()
+    assert single[0] and single[1]
+
+    workers = metrics_calculator.start_shard_workers(3)
+    try:
+        statuses = metrics_calculator.load_shards(workers, metrics_calculator.split_aggregator(IntervalAggregator(), 3))
+        for data in chunks:
+            assert metrics_calculator.process_sharded(data, workers, statuses)
+    finally:
+        metrics_calculator.stop_shard_workers(workers)
+    assert take_metrics() == single
+    assert min(status["watermark"] for status in statuses) == aggregator.watermark() > start
+
+
+def test_hung_shard_workers_time_out_and_are_stopped(standins, monkeypatch):
+    monkeypatch.setattr(metrics_calculator, "shard_timeout", 0.5)
+    workers = metrics_calculator.start_shard_workers(1)
+    workers[0].submit(time.sleep, 60)
+    with pytest.raises(TimeoutError):
+        metrics_calculator.load_shards(workers, [IntervalAggregator()])
+
+    started = time.monotonic()
+    metrics_calculator.stop_shard_workers(workers)
+    assert time.monotonic() - started < 10
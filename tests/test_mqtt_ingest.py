@@ -0,0 +1,82 @@
+import asyncio
+
+import db_pool
+import mqtt_ingest
+from benchmarks.telegram_generator import generate_rows
+
+TELEGRAMS = [row["data"] for row in generate_rows(10, devices=2)]
+
+
+# Function to publish telegrams through a LocalBroker into the subscriber and return what write received
+def ingest(telegrams, write, pause_after=None):
+    async def main():
+        broker = mqtt_ingest.LocalBroker()
+        subscriber = asyncio.create_task(mqtt_ingest.run_subscriber(broker.messages(mqtt_ingest.mqtt_topic), write))
+        await asyncio.sleep(0)
+        for i, telegram in enumerate(telegrams):
+            await broker.publish(f"meters/device-{i % 2}/telegram", telegram)
+            if i == pause_after:
+                await asyncio.sleep(0.1)  # Longer than max_batch_delay
+        await broker.publish("other/topic", telegrams[0])
+        await broker.close()
+        await subscriber
+    asyncio.run(main())
+
+
+def test_batches_by_size_and_age(monkeypatch):
+    monkeypatch.setattr(mqtt_ingest, "max_batch_rows", 4)
+    monkeypatch.setattr(mqtt_ingest, "max_batch_delay", 0.02)
+    batches = []
+    ingest(TELEGRAMS, lambda batch: batches.append(list(batch)) or True, pause_after=1)
+
+    assert [len(batch) for batch in batches] == [2, 4, 4]  # Aged out, full, full
+    rows = [row for batch in batches for row in batch]
+    assert [row["data"] for row in rows] == TELEGRAMS
+    assert [row["device_id"] for row in rows] == [f"device-{i % 2}" for i in range(10)]
+    assert all(row["id"] >= mqtt_ingest.direct_id_base for row in rows)
+    assert all(row["timestamp"].tzinfo is None for row in rows)  # Naive UTC, like batch_process rows
+
+
+def test_failed_batches_are_retried(monkeypatch):
+    monkeypatch.setattr(mqtt_ingest, "retry_delay", 0.001)
+    attempts = []
+
+    def flaky_write(batch):
+        attempts.append(len(batch))
+        return len(attempts) > 2
+
+    ingest(TELEGRAMS, flaky_write)
+    assert attempts == [10, 10, 10]
+
+
+def test_redelivered_messages_are_stored_once(standins):
+    ingest(TELEGRAMS + TELEGRAMS[:3], mqtt_ingest.batch_process.insert_parsed_data)
+    with db_pool.connection("target") as conn:
+        assert conn.execute("SELECT COUNT(*) FROM mqtt_raw_data").fetchone()[0] == len(TELEGRAMS)
+
+
+def test_broker_errors_reconnect_with_backoff(monkeypatch, caplog):
+    monkeypatch.setattr(mqtt_ingest, "retry_delay", 0.001)
+    sessions = []
+
+    # Sessions: two messages then a dropped connection, a refused connection, then a clean end
+    async def connect(topic_filter):
+        sessions.append(topic_filter)
+        if len(sessions) == 1:
+            yield "meters/a/telegram", TELEGRAMS[0]
+            yield "meters/a/telegram", TELEGRAMS[1]
+            raise ConnectionError("connection lost")
+        if len(sessions) == 2:
+            raise ConnectionError("connection refused")
+        yield "meters/a/telegram", TELEGRAMS[2]
+
+    async def main():
+        return [message async for message in mqtt_ingest.broker_messages("meters/+/telegram", connect)]
+
+    messages = asyncio.run(main())
+    assert [payload for _, payload in messages] == TELEGRAMS[:3]
+    assert len(sessions) == 3
+    assert [record.getMessage() for record in caplog.records if "reconnecting" in record.getMessage()] == [
+        "Lost the MQTT broker connection (connection lost); reconnecting in 0.001 s.",
+        "Lost the MQTT broker connection (connection refused); reconnecting in 0.002 s.",
+    ]
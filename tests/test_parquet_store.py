@@ -0,0 +1,74 @@
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import batch_process
+import parquet_store
+from benchmarks.telegram_generator import generate_rows
+
+START = datetime(2025, 1, 1)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(parquet_store, "store_dir", str(tmp_path / "store"))
+    monkeypatch.setattr(parquet_store, "enabled", True)
+    monkeypatch.setattr(parquet_store, "_buffer", defaultdict(list))
+    monkeypatch.setattr(parquet_store, "_buffered_rows", 0)
+    monkeypatch.setattr(parquet_store, "_manifest_cache", (None, []))
+    monkeypatch.setattr(parquet_store, "_start_flusher", lambda: None)  # Flushed by the tests
+    return tmp_path / "store"
+
+
+# Parsed readings over two days, in (timestamp, id) order
+def readings(count=200):
+    rows = batch_process.parse_batch(list(generate_rows(count, devices=3, start=START, interval_seconds=1800)))
+    return [{column: row[column] for column in parquet_store.COLUMNS} for row in rows]
+
+
+def test_reads_filter_order_and_keep_the_newest_copy(store):
+    rows = readings()
+    parquet_store.write_rows(rows[100:])
+    parquet_store.write_rows(rows[:100])
+    assert parquet_store.flush() == len(rows)
+
+    # A replayed row is written again with new values
+    replayed = {**rows[5], "total_energy_consumed": -1.0}
+    parquet_store.write_rows([replayed])
+    parquet_store.flush()
+
+    start, end = rows[3]["timestamp"], rows[150]["timestamp"]
+    frame = parquet_store.read_readings(start, end, devices={rows[5]["device_id"]})
+    expected = [row["id"] for row in rows if start <= row["timestamp"] < end and row["device_id"] == rows[5]["device_id"]]
+    assert frame["id"].tolist() == expected
+    assert frame.loc[frame["id"] == rows[5]["id"], "total_energy_consumed"].tolist() == [-1.0]
+
+
+def test_compaction_leaves_one_file_per_partition(store):
+    rows = readings()
+    for i in range(0, len(rows), 50):
+        parquet_store.write_rows(rows[i:i + 50])
+        parquet_store.flush()
+    before = parquet_store.read_readings()
+
+    assert parquet_store.compact() > 0
+    entries = parquet_store.load_manifest()
+    assert len(entries) == len({(entry["device_id"], entry["day"]) for entry in entries})
+    assert sorted(os.path.relpath(path, store) for path in store.rglob("*.parquet")) == sorted(entry["path"] for entry in entries)
+    assert parquet_store.read_readings().equals(before)
+
+
+def test_export_range_copies_the_target_rows(store, standins, monkeypatch):
+    rows = readings(60)
+    monkeypatch.setattr(parquet_store, "enabled", False)  # Only the export writes to the store
+    assert batch_process.insert_parsed_data(rows)
+    monkeypatch.setattr(parquet_store, "enabled", True)
+
+    assert parquet_store.export_range(START, START + timedelta(days=3)) == len(rows)
+    frame = parquet_store.read_readings()
+    assert frame["id"].tolist() == [row["id"] for row in rows]
+    assert frame["phase1_voltage"].tolist() == pytest.approx([row["phase1_voltage"] for row in rows], nan_ok=True)
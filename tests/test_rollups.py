@@ -0,0 +1,71 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import db_pool
+import metrics_calculator
+import rollups
+from interval_aggregator import METRIC_COLUMNS, QUALITY_RESET, QUALITY_ROLLOVER
+
+
+def metric(device_id, day, hour, interval_start, power, voltage=230.0, quality_flag=0):
+    row = dict.fromkeys(METRIC_COLUMNS, 0.0)
+    row.update(device_id=device_id, day=day, hour=hour, interval_start=interval_start,
+               power_consumption=power, avg_phase1_voltage=voltage, quality_flag=quality_flag)
+    return row
+
+
+def read(table):
+    with db_pool.connection("target") as conn:
+        return pd.read_sql(f"SELECT * FROM {table}", conn)
+
+
+def test_rollups_sum_energy_and_weight_means(standins):
+    metrics = [
+        metric("a", date(2025, 1, 31), 23, 0, 1.0, voltage=220.0),
+        metric("a", date(2025, 1, 31), 23, 10, None, voltage=None, quality_flag=QUALITY_RESET),
+        metric("a", date(2025, 1, 31), 23, 20, 2.0, voltage=240.0, quality_flag=QUALITY_ROLLOVER),
+        metric("a", date(2025, 2, 1), 0, 0, 4.0),
+        metric("b", date(2025, 1, 31), 23, 0, None, voltage=None, quality_flag=QUALITY_RESET),
+    ]
+    assert metrics_calculator.upsert_metrics(metrics)
+
+    hourly = read("device_consumption_hourly").set_index(["device_id", "hour"])
+    assert hourly.loc[("a", 23), "power_consumption"] == 3.0
+    assert hourly.loc[("a", 23), "avg_phase1_voltage"] == 230.0  # NULL means are left out
+    assert hourly.loc[("a", 23), "interval_count"] == 3
+    assert hourly.loc[("a", 23), "quality_flag"] == QUALITY_RESET | QUALITY_ROLLOVER
+    assert pd.isna(hourly.loc[("b", 23), "power_consumption"])  # All-NULL stays NULL
+
+    monthly = read("device_consumption_monthly").set_index(["device_id", "month"]).sort_index()
+    assert list(monthly.index) == [("a", date(2025, 1, 1)), ("a", date(2025, 2, 1)), ("b", date(2025, 1, 1))]
+    assert monthly.loc[("a", date(2025, 1, 1)), "power_consumption"] == 3.0
+    assert monthly.loc[("a", date(2025, 2, 1)), "power_consumption"] == 4.0
+
+    # Amending one interval recomputes its buckets at every level
+    assert metrics_calculator.upsert_metrics([metric("a", date(2025, 1, 31), 23, 10, 5.0)])
+    daily = read("device_consumption_daily").set_index(["device_id", "day"])
+    assert daily.loc[("a", date(2025, 1, 31)), "power_consumption"] == 8.0
+    assert daily.loc[("a", date(2025, 1, 31)), "quality_flag"] == QUALITY_ROLLOVER
+    assert read("device_consumption_monthly").set_index(["device_id", "month"]).loc[("a", date(2025, 1, 1)), "power_consumption"] == 8.0
+
+
+@pytest.mark.parametrize("table, key_columns, touched", [
+    ("device_consumption_metrics", ["device_id", "day", "hour"], {"device_id": ["a"], "day": [date(2025, 1, 1)], "hour": [6]}),
+    ("device_consumption_hourly", ["device_id", "day"], {"device_id": ["a"], "day": [date(2025, 1, 1)]}),
+    ("device_consumption_daily", ["device_id", "month"], {"device_id": ["a"], "month": [date(2025, 1, 1)]}),
+])
+def test_read_finer_reads_only_the_touched_buckets(standins, table, key_columns, touched):
+    assert metrics_calculator.upsert_metrics([
+        metric(device_id, day, hour, 0, 1.0)
+        for device_id in ("a", "b")
+        for day in (date(2025, 1, 1), date(2025, 2, 1))
+        for hour in (6, 7)
+    ])
+    with db_pool.connection("target") as conn:
+        finer = rollups.read_finer(conn, table, key_columns, pd.DataFrame(touched), "sqlite")
+    assert set(finer["device_id"]) == {"a"}
+    assert set(finer["day"]) == {date(2025, 1, 1)}
+    if "hour" in key_columns:
+        assert set(finer["hour"]) == {6}
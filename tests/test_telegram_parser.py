@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+from benchmarks.telegram_generator import generate_rows
+from telegram_parser import FIELD_NAMES, parse_column, parse_data
+
+
+def test_parse_column_matches_parse_data():
+    # Generated telegrams include dropped and corrupted value lines; the last one repeats an object with another unit
+    telegrams = [row["data"] for row in generate_rows(500, devices=5)]
+    telegrams += [None, "not a telegram", "1-0:1.8.0(000001.000*Wh)\r\n1-0:1.8.0(000002.000*kWh)\r\n1-0:1.8.0(000003.000*kWh)"]
+    column = parse_column(pd.Series(telegrams, index=range(10, 10 + len(telegrams))))
+
+    expected = pd.DataFrame(
+        [parse_data(data) if isinstance(data, str) else dict.fromkeys(FIELD_NAMES) for data in telegrams],
+        columns=FIELD_NAMES, index=column.index, dtype=np.float64,
+    )
+    pd.testing.assert_frame_equal(column, expected)
+    assert column.iloc[-1]["total_energy_consumed"] == column.iloc[-1]["tariff1_energy"] == 2.0
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import watermark_signal
+
+
+@pytest.fixture
+def listener(monkeypatch):
+    listener = watermark_signal.Listener("127.0.0.1", 0)
+    monkeypatch.setattr(watermark_signal, "notify_host", "127.0.0.1")
+    monkeypatch.setattr(watermark_signal, "notify_port", listener.socket.getsockname()[1])
+    monkeypatch.setattr(watermark_signal, "debounce", 0.05)
+    yield listener
+    listener.close()
+
+
+def test_naive_and_aware_notifications_are_compared_in_utc(listener):
+    # batch_process sends naive UTC timestamps, mqtt_ingest aware ones
+    naive = datetime(2025, 1, 1, 12, 0)
+    watermark_signal.notify(naive)
+    watermark_signal.notify(datetime(2025, 1, 1, 13, 30, tzinfo=timezone(timedelta(hours=2))))  # 11:30 UTC
+    watermark_signal.notify(datetime(2025, 1, 1, 12, 5, tzinfo=timezone.utc))
+    assert listener.wait(idle=1)
+    assert listener.watermark == datetime(2025, 1, 1, 12, 5)
+
+
+def test_wait_times_out_without_notifications(listener):
+    assert not listener.wait(idle=0.05)
+    assert listener.watermark is None
+
+
+def test_malformed_notifications_are_ignored(listener):
+    listener.socket.sendto(b"not a timestamp", listener.socket.getsockname())
+    assert listener.wait(idle=1)
+    assert listener.watermark is None
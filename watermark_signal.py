@@ -0,0 +1,87 @@
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timezone
+
+# Wake-up signal from the ingest workers to metrics_calculator, sent over localhost UDP:
+#
+#     batch_process / mqtt_ingest --(committed watermark)--> metrics_calculator
+#
+# A notification is one datagram holding the timestamp of the newest committed row, as naive UTC like
+# the stored timestamps (mqtt_ingest and batch_process may both notify the same listener). Sending never
+# blocks and never fails the sender; a lost datagram only delays the run until the fallback poll.
+# The listener debounces bursts of commits into one run, bounded by a maximum latency.
+
+notify_host = os.getenv("METRICS_NOTIFY_HOST", "127.0.0.1")
+notify_port = int(os.getenv("METRICS_NOTIFY_PORT", "9201"))
+debounce = float(os.getenv("METRICS_DEBOUNCE_SECONDS", "5"))  # Run once commits have been quiet this long
+max_latency = float(os.getenv("METRICS_MAX_LATENCY_SECONDS", "60"))  # ... but no later than this after the first one
+max_idle = float(os.getenv("METRICS_MAX_IDLE_SECONDS", "600"))  # Run anyway when nothing was signalled for this long
+
+_sender = None
+
+
+# Function to express a timestamp as naive UTC (naive timestamps already are)
+def naive_utc(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+# Function to tell metrics_calculator that rows up to timestamp are committed
+def notify(timestamp):
+    global _sender
+    try:
+        if _sender is None:
+            _sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _sender.sendto(naive_utc(timestamp).isoformat().encode(), (notify_host, notify_port))
+    except (OSError, AttributeError) as e:
+        logging.debug(f"Could not send the watermark notification: {e}")
+
+
+class Listener:
+    def __init__(self, host=notify_host, port=notify_port):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.watermark = None  # Newest committed timestamp signalled so far
+
+    # Function to wait for the next run: returns True once signalled commits have settled (debounce,
+    # bounded by max_latency), or False when nothing was signalled within idle seconds
+    def wait(self, idle=max_idle):
+        if not self._receive(idle):
+            return False
+        first = time.monotonic()
+        while True:
+            remaining = first + max_latency - time.monotonic()
+            if remaining <= 0 or not self._receive(min(debounce, remaining)):
+                return True
+
+    def close(self):
+        self.socket.close()
+
+    def _receive(self, timeout):
+        self.socket.settimeout(max(timeout, 0.001))
+        try:
+            payload = self.socket.recv(64)
+        except socket.timeout:
+            return False
+        try:
+            timestamp = naive_utc(datetime.fromisoformat(payload.decode()))
+        except ValueError:
+            logging.warning(f"Ignored a malformed watermark notification: {payload!r}")
+            return True
+        if self.watermark is None or timestamp > self.watermark:
+            self.watermark = timestamp
+        return True
+
+
+# Function to open the listener, or None (plain polling) when the port is taken or unavailable
+def listen():
+    try:
+        listener = Listener()
+    except OSError as e:
+        logging.warning(f"Watermark notifications unavailable ({e}); polling every {max_idle:.0f} s instead.")
+        return None
+    logging.info(f"Waiting for watermark notifications on {notify_host}:{notify_port}.")
+    return listener